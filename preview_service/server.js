@@ -5,6 +5,8 @@ const crypto = require('crypto');
 const path = require('path');
 const fs = require('fs');
 const mime = require('mime-types');
+const { Readable, Transform } = require('stream');
+const { pipeline } = require('stream/promises');
 
 // ЯВНОЕ ПОДКЛЮЧЕНИЕ .env ФАЙЛА
 require('dotenv').config({ path: '/root/telegram-giveaway-prizeme-bot/.env' });
@@ -207,55 +209,219 @@ function signS3Request(method, path, headers = {}) {
   };
 }
 
-app.get('/uploads/:path(*)', async (req, res) => {
-  try {
-    const mediaPath = req.params.path;
-    console.log(`[MEDIA] Request for: ${mediaPath}`);
-    
-    const s3Path = `/${S3_BUCKET}/${mediaPath}`;
-    const s3Url = `${S3_ENDPOINT}${s3Path}`;
-    console.log(`[MEDIA] Proxying to: ${s3Url}`);
-    
-    // Создаем подписанный запрос
-    const signedHeaders = signS3Request('GET', s3Path);
-    
-    const response = await fetch(s3Url, {
-      method: 'GET',
-      headers: {
-        'Host': 's3.twcstorage.ru',
-        ...signedHeaders
-      }
-    });
+// Дисковый LRU-кэш медиа из S3: повторные запросы не ходят в S3,
+// Range / ETag / If-None-Match / 304 и HEAD обслуживает res.sendFile.
+// Объекты больше UPLOAD_CACHE_MAX_OBJECT не кэшируются и проксируются потоком.
+const UPLOAD_CACHE_DIR = process.env.UPLOAD_CACHE_DIR || '/var/cache/prizeme/uploads-node';
+const UPLOAD_CACHE_MAX_BYTES = parseInt(process.env.UPLOAD_CACHE_MAX_BYTES || String(2 * 1024 ** 3), 10);
+const UPLOAD_CACHE_MAX_OBJECT = parseInt(process.env.UPLOAD_CACHE_MAX_OBJECT || String(64 * 1024 ** 2), 10);
+const UPLOAD_TOO_LARGE = 'too_large';
+const UPLOAD_MISSING = 'missing';
+
+const uploadCache = {
+  enabled: false,
+  index: new Map(),     // mediaPath -> { file, size, contentType }; порядок вставки = LRU
+  bytes: 0,
+  inflight: new Map(),  // mediaPath -> Promise: одна загрузка из S3 на путь
+  tooLarge: new Set(),
+};
+
+function uploadCacheFile(mediaPath) {
+  return path.join(UPLOAD_CACHE_DIR, crypto.createHash('sha256').update(mediaPath).digest('hex'));
+}
 
-    if (!response.ok) {
-      console.log(`[MEDIA] S3 response: ${response.status}`);
-      return res.status(response.status).send('Media not found');
+async function initUploadCache() {
+  await fs.promises.mkdir(UPLOAD_CACHE_DIR, { recursive: true });
+  const found = [];
+  for (const name of await fs.promises.readdir(UPLOAD_CACHE_DIR)) {
+    const full = path.join(UPLOAD_CACHE_DIR, name);
+    if (name.endsWith('.part')) {
+      await fs.promises.rm(full, { force: true });
+      continue;
+    }
+    if (!name.endsWith('.meta')) continue;
+    const file = full.slice(0, -'.meta'.length);
+    try {
+      const meta = JSON.parse(await fs.promises.readFile(full, 'utf8'));
+      const st = await fs.promises.stat(file);
+      found.push({ atime: st.atimeMs, mediaPath: meta.path, entry: { file, size: st.size, contentType: meta.contentType } });
+    } catch (_e) {
+      await fs.promises.rm(full, { force: true });
+      await fs.promises.rm(file, { force: true });
     }
+  }
+  found.sort((a, b) => a.atime - b.atime);
+  for (const { mediaPath, entry } of found) {
+    uploadCache.index.set(mediaPath, entry);
+    uploadCache.bytes += entry.size;
+  }
+  uploadCache.enabled = true;
+  console.log(`[MEDIA] cache dir=${UPLOAD_CACHE_DIR} objects=${uploadCache.index.size} bytes=${uploadCache.bytes}`);
+}
+
+initUploadCache().catch((e) => console.log(`[MEDIA] cache disabled: ${e.message}`));
+
+function uploadCacheGet(mediaPath) {
+  const entry = uploadCache.index.get(mediaPath);
+  if (entry) {
+    uploadCache.index.delete(mediaPath);
+    uploadCache.index.set(mediaPath, entry);
+  }
+  return entry;
+}
+
+function uploadCachePut(mediaPath, entry) {
+  const old = uploadCache.index.get(mediaPath);
+  if (old) {
+    uploadCache.index.delete(mediaPath);
+    uploadCache.bytes -= old.size;
+  }
+  uploadCache.index.set(mediaPath, entry);
+  uploadCache.bytes += entry.size;
+  while (uploadCache.bytes > UPLOAD_CACHE_MAX_BYTES && uploadCache.index.size > 1) {
+    const [oldestPath, oldest] = uploadCache.index.entries().next().value;
+    uploadCache.index.delete(oldestPath);
+    uploadCache.bytes -= oldest.size;
+    // уже открытые на чтение файлы дочитываются: unlink их не обрывает
+    fs.promises.rm(`${oldest.file}.meta`, { force: true }).catch(() => {});
+    fs.promises.rm(oldest.file, { force: true }).catch(() => {});
+  }
+}
 
-    // Определяем MIME-тип
-    let contentType = response.headers.get('content-type');
-    if (!contentType) {
-      const mimeType = mime.lookup(mediaPath);
-      contentType = mimeType || 'application/octet-stream';
+function fetchS3(method, mediaPath, extraHeaders = {}) {
+  const s3Path = `/${S3_BUCKET}/${mediaPath}`;
+  return fetch(`${S3_ENDPOINT}${s3Path}`, {
+    method,
+    headers: {
+      'Host': 's3.twcstorage.ru',
+      ...signS3Request(method, s3Path),
+      ...extraHeaders,
+    },
+  });
+}
+
+async function downloadToCache(mediaPath) {
+  const response = await fetchS3('GET', mediaPath);
+  if (!response.ok) {
+    console.log(`[MEDIA] S3 response: ${response.status}`);
+    await response.body?.cancel();
+    return UPLOAD_MISSING;
+  }
+  const declared = parseInt(response.headers.get('content-length') || '0', 10);
+  if (declared > UPLOAD_CACHE_MAX_OBJECT) {
+    await response.body?.cancel();
+    uploadCache.tooLarge.add(mediaPath);
+    return UPLOAD_TOO_LARGE;
+  }
+
+  const file = uploadCacheFile(mediaPath);
+  const tmp = `${file}.${process.pid}.${Date.now()}.part`;
+  let written = 0;
+  const limiter = new Transform({
+    transform(chunk, _enc, cb) {
+      written += chunk.length;
+      cb(written > UPLOAD_CACHE_MAX_OBJECT ? new Error(UPLOAD_TOO_LARGE) : null, chunk);
+    },
+  });
+  try {
+    await pipeline(Readable.fromWeb(response.body), limiter, fs.createWriteStream(tmp));
+  } catch (e) {
+    await fs.promises.rm(tmp, { force: true });
+    if (e.message === UPLOAD_TOO_LARGE) {
+      uploadCache.tooLarge.add(mediaPath);
+      return UPLOAD_TOO_LARGE;
     }
+    throw e;
+  }
+
+  const contentType = response.headers.get('content-type') || mime.lookup(mediaPath) || 'application/octet-stream';
+  await fs.promises.writeFile(`${file}.meta`, JSON.stringify({ path: mediaPath, contentType }));
+  await fs.promises.rename(tmp, file);
+  const entry = { file, size: written, contentType };
+  uploadCachePut(mediaPath, entry);
+  return entry;
+}
 
-    // Заголовки
-    res.setHeader('Content-Type', contentType);
-    res.setHeader('Cache-Control', 'public, max-age=3600'); // Увеличиваем кэш
-    res.setHeader('X-Proxy-From', s3Url);
+function fetchIntoCache(mediaPath) {
+  let pending = uploadCache.inflight.get(mediaPath);
+  if (!pending) {
+    pending = downloadToCache(mediaPath).finally(() => uploadCache.inflight.delete(mediaPath));
+    uploadCache.inflight.set(mediaPath, pending);
+  }
+  return pending;
+}
 
-    // Передаем данные потоком
-    const buffer = await response.arrayBuffer();
-    res.status(200).send(Buffer.from(buffer));
+// Без кэша (или объект слишком большой) — поток из S3 с пробросом Range / ETag
+async function streamFromS3(req, res, mediaPath) {
+  const forwarded = {};
+  for (const h of ['range', 'if-none-match', 'if-range']) {
+    if (req.headers[h]) forwarded[h] = req.headers[h];
+  }
+  const response = await fetchS3('GET', mediaPath, forwarded);
+  if (response.status >= 400 && response.status !== 416) {
+    await response.body?.cancel();
+    return res.status(404).send('Media not found');
+  }
 
-    console.log(`[MEDIA] ✅ Successfully served: ${mediaPath} (${contentType})`);
+  res.status(response.status);
+  for (const h of ['content-length', 'content-range', 'etag', 'accept-ranges', 'last-modified']) {
+    const value = response.headers.get(h);
+    if (value) res.setHeader(h, value);
+  }
+  res.setHeader('Content-Type', response.headers.get('content-type') || mime.lookup(mediaPath) || 'application/octet-stream');
+  res.setHeader('Cache-Control', 'public, max-age=3600');
+  res.setHeader('X-Cache', 'MISS');
+  if (!response.body || req.method === 'HEAD') {
+    await response.body?.cancel();
+    return res.end();
+  }
+  await pipeline(Readable.fromWeb(response.body), res);
+}
 
+// GET (и HEAD — Express направляет его в GET-маршрут) /uploads/*
+app.get('/uploads/:path(*)', async (req, res, next) => {
+  const mediaPath = req.params.path;
+  // HEAD без копии в кэше — в HEAD-маршрут ниже: объект из S3 не скачиваем
+  if (req.method === 'HEAD' && !(uploadCache.enabled && uploadCacheGet(mediaPath))) {
+    return next();
+  }
+  try {
+    if (uploadCache.enabled && !uploadCache.tooLarge.has(mediaPath)) {
+      let entry = uploadCacheGet(mediaPath);
+      if (!entry) {
+        entry = await fetchIntoCache(mediaPath);
+      }
+      if (entry === UPLOAD_MISSING) {
+        return res.status(404).send('Media not found');
+      }
+      if (entry !== UPLOAD_TOO_LARGE) {
+        res.setHeader('Content-Type', entry.contentType);
+        res.setHeader('X-Cache', 'HIT');
+        return res.sendFile(entry.file, { maxAge: 3600 * 1000, acceptRanges: true, etag: true, lastModified: true });
+      }
+    }
+    await streamFromS3(req, res, mediaPath);
   } catch (error) {
-    console.log(`[MEDIA] ❌ Error: ${error.message}`);
-    res.status(500).send('Media proxy error');
+    console.log(`[MEDIA] ❌ Error for ${mediaPath}: ${error.message}`);
+    if (!res.headersSent) {
+      res.status(500).send('Media proxy error');
+    } else {
+      res.destroy(error);
+    }
   }
 });
 
+app.get('/api/debug/uploads_cache', (req, res) => {
+  res.json({
+    ok: true,
+    enabled: uploadCache.enabled,
+    objects: uploadCache.index.size,
+    bytes: uploadCache.bytes,
+    max_bytes: UPLOAD_CACHE_MAX_BYTES,
+    inflight: uploadCache.inflight.size,
+  });
+});
+
 
 // УЛУЧШЕННЫЙ HEAD ЗАПРОС
 app.head('/uploads/:path(*)', async (req, res) => {
@@ -1,17 +1,24 @@
 import os, time, mimetypes
 import json, hmac, hashlib
 import datetime
+import asyncio, random, string
+import importlib.util
+from collections import OrderedDict
+from contextlib import asynccontextmanager, closing
 from dotenv import load_dotenv, find_dotenv
 from fastapi import FastAPI, Request, Response, HTTPException
 from pathlib import Path
 import sqlite3
 from typing import Optional, Dict, Any, List
 from fastapi.staticfiles import StaticFiles
-from urllib.parse import parse_qsl, unquote
+from urllib.parse import parse_qsl
 
+import anyio
 import httpx
 from httpx import AsyncClient
 from fastapi.responses import PlainTextResponse, FileResponse, Response, HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Инициализация
@@ -30,7 +37,10 @@ MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL", "https://media.prizeme.ru")
 WEBAPP_BASE_URL = os.getenv("WEBAPP_BASE_URL", "https://prizeme.ru")
 
 WEBAPP_HOST = os.getenv("WEBAPP_HOST", "https://prizeme.ru").rstrip("/")
-DB_PATH = Path("/root/telegram-giveaway-prizeme-bot/tgbot/bot.db")
+DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+DB_PATH = Path(os.getenv("DB_PATH", "/root/telegram-giveaway-prizeme-bot/tgbot/bot.db"))
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
 S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://s3.twcstorage.ru").rstrip("/")
 S3_BUCKET = os.getenv("S3_BUCKET", "").strip()
 CACHE_SEC = int(os.getenv("CACHE_SEC", "300"))
@@ -45,13 +55,330 @@ ALREADY_FILE = WEBAPP_DIR / "already_participating.html"
 TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 OK_STATUSES = {"creator", "administrator", "member", "restricted"}  # restricted с is_member=true
 
-app: FastAPI  # приложение у тебя уже создано выше — эту строку не трогаем
+# ──────────────────────────────────────────────────────────────────────────────
+# Хранилище: Postgres (пул asyncpg) в проде, SQLite — для локальных тестов
+# ──────────────────────────────────────────────────────────────────────────────
+
+try:
+    import asyncpg
+except ImportError:  # для локального запуска на SQLite asyncpg не нужен
+    asyncpg = None
+
+TICKET_ALPHABET = string.ascii_uppercase + string.digits
+TICKET_ATTEMPTS = 12
+NEW_TICKET_WINDOW_SEC = 10   # билет, выданный за последние N секунд, показываем как новый
+
+
+def _gen_ticket_code() -> str:
+    return "".join(random.choices(TICKET_ALPHABET, k=6))
+
+def _iso(value) -> str | None:
+    if value is None:
+        return None
+    return value.isoformat() if isinstance(value, datetime.datetime) else str(value)
+
+def _ticket_is_fresh(issued_at: datetime.datetime | None) -> bool:
+    if issued_at is None:
+        return False
+    age = datetime.datetime.now(datetime.timezone.utc) - issued_at
+    return age.total_seconds() < NEW_TICKET_WINDOW_SEC
+
+
+class PostgresStorage:
+    """
+    Те же данные, что пишет бот. Один пул на процесс; всё, что нужно запросу
+    (розыгрыш, каналы, билет пользователя), читается одним запросом.
+    """
+    name = "postgres"
+
+    _CONTEXT_SQL = """
+        SELECT g.status, g.end_at_utc, e.ticket_code, e.prelim_checked_at,
+               COALESCE((
+                   SELECT json_agg(json_build_object(
+                              'chat_id', gc.chat_id, 'title', gc.title, 'username', oc.username
+                          ) ORDER BY gc.id)
+                   FROM giveaway_channels gc
+                   LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
+                   WHERE gc.giveaway_id = g.id
+               ), '[]'::json) AS channels
+        FROM giveaways g
+        LEFT JOIN entries e ON e.giveaway_id = g.id AND e.user_id = $2
+        WHERE g.id = $1
+        LIMIT 1
+    """
+
+    def __init__(self, dsn: str):
+        # DATABASE_URL общий с ботом — срезаем SQLAlchemy-префикс драйвера, если он есть
+        self.dsn = dsn.replace("postgresql+asyncpg://", "postgresql://", 1)
+        self.pool = None
+
+    async def start(self):
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, command_timeout=10
+        )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def giveaway_context(self, gid: int, user_id: int) -> Optional[Dict[str, Any]]:
+        row = await self.pool.fetchrow(self._CONTEXT_SQL, int(gid), int(user_id))
+        if not row:
+            return None
+        return {
+            "status": row["status"],
+            "end_at_utc": _iso(row["end_at_utc"]),
+            "channels": json.loads(row["channels"]),
+            "ticket": row["ticket_code"],
+            "ticket_at": row["prelim_checked_at"],
+        }
+
+    async def members_local(self, user_id: int, chat_ids: List[int]) -> set:
+        if not chat_ids:
+            return set()
+        rows = await self.pool.fetch(
+            "SELECT chat_id FROM channel_memberships "
+            "WHERE user_id = $1 AND chat_id = ANY($2::bigint[]) AND left_at IS NULL",
+            int(user_id), [int(c) for c in chat_ids],
+        )
+        return {r["chat_id"] for r in rows}
+
+    async def issue_ticket(self, gid: int, user_id: int) -> tuple[Optional[str], bool]:
+        """(код, создан_сейчас). Параллельный запрос того же пользователя получит уже выданный билет."""
+        async with self.pool.acquire() as conn:
+            for _ in range(TICKET_ATTEMPTS):
+                try:
+                    code = await conn.fetchval(
+                        "INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at) "
+                        "VALUES ($1, $2, $3, true, now()) RETURNING ticket_code",
+                        int(gid), int(user_id), _gen_ticket_code(),
+                    )
+                except asyncpg.UniqueViolationError:
+                    existing = await conn.fetchval(
+                        "SELECT ticket_code FROM entries WHERE giveaway_id = $1 AND user_id = $2",
+                        int(gid), int(user_id),
+                    )
+                    if existing:
+                        return existing, False
+                    continue   # коллизия кода билета — пробуем другой
+                return code, True
+        return None, False
+
+    async def giveaway_status(self, gid: int) -> Optional[Dict[str, Any]]:
+        row = await self.pool.fetchrow("SELECT status, end_at_utc FROM giveaways WHERE id = $1", int(gid))
+        return {"status": row["status"], "end_at_utc": _iso(row["end_at_utc"])} if row else None
+
+    async def giveaway_channels(self, gid: int) -> List[Dict[str, Any]]:
+        rows = await self.pool.fetch("""
+            SELECT gc.chat_id, gc.title, oc.username
+            FROM giveaway_channels gc
+            LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
+            WHERE gc.giveaway_id = $1
+            ORDER BY gc.id
+        """, int(gid))
+        return [dict(r) for r in rows]
+
+
+class SqliteStorage:
+    """
+    Локальный бэкенд для тестов. sqlite3 синхронный, поэтому каждый вызов —
+    один переход в поток (asyncio.to_thread) со всеми запросами на одном соединении.
+    """
+    name = "sqlite"
 
+    def __init__(self, path: Path):
+        self.path = path
 
-app = FastAPI()
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path.as_posix(), timeout=5)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _parse_ts(value) -> datetime.datetime | None:
+        if not value:
+            return None
+        fmt = "%Y-%m-%d %H:%M:%S.%f" if "." in value else "%Y-%m-%d %H:%M:%S"
+        return datetime.datetime.strptime(value, fmt).replace(tzinfo=datetime.timezone.utc)
+
+    def _giveaway_context_sync(self, gid: int, user_id: int):
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT status, end_at_utc FROM giveaways WHERE id=?", (gid,)).fetchone()
+            if not row:
+                return None
+            channels = db.execute("""
+                SELECT gc.chat_id, gc.title, oc.username
+                FROM giveaway_channels gc
+                LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
+                WHERE gc.giveaway_id=?
+                ORDER BY gc.id
+            """, (gid,)).fetchall()
+            entry = db.execute(
+                "SELECT ticket_code, prelim_checked_at FROM entries WHERE giveaway_id=? AND user_id=?",
+                (gid, user_id),
+            ).fetchone()
+        return {
+            "status": row["status"],
+            "end_at_utc": row["end_at_utc"],
+            "channels": [dict(r) for r in channels],
+            "ticket": entry["ticket_code"] if entry else None,
+            "ticket_at": self._parse_ts(entry["prelim_checked_at"]) if entry else None,
+        }
+
+    async def giveaway_context(self, gid: int, user_id: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._giveaway_context_sync, int(gid), int(user_id))
+
+    def _members_local_sync(self, user_id: int, chat_ids: List[int]) -> set:
+        marks = ",".join("?" * len(chat_ids))
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                f"SELECT chat_id FROM channel_memberships WHERE user_id=? AND chat_id IN ({marks})",
+                (user_id, *chat_ids),
+            ).fetchall()
+        return {r["chat_id"] for r in rows}
+
+    async def members_local(self, user_id: int, chat_ids: List[int]) -> set:
+        if not chat_ids:
+            return set()
+        return await asyncio.to_thread(self._members_local_sync, int(user_id), [int(c) for c in chat_ids])
+
+    def _issue_ticket_sync(self, gid: int, user_id: int):
+        with closing(self._connect()) as db:
+            for _ in range(TICKET_ATTEMPTS):
+                row = db.execute(
+                    "SELECT ticket_code FROM entries WHERE giveaway_id=? AND user_id=?", (gid, user_id)
+                ).fetchone()
+                if row:
+                    return row["ticket_code"], False
+                code = _gen_ticket_code()
+                try:
+                    db.execute(
+                        "INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at) "
+                        "VALUES (?, ?, ?, 1, strftime('%Y-%m-%d %H:%M:%f','now'))",
+                        (gid, user_id, code),
+                    )
+                    db.commit()
+                    return code, True
+                except sqlite3.IntegrityError:
+                    continue   # коллизия кода билета — пробуем другой
+        return None, False
+
+    async def issue_ticket(self, gid: int, user_id: int) -> tuple[Optional[str], bool]:
+        return await asyncio.to_thread(self._issue_ticket_sync, int(gid), int(user_id))
+
+    def _giveaway_status_sync(self, gid: int):
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT status, end_at_utc FROM giveaways WHERE id=?", (gid,)).fetchone()
+        return {"status": row["status"], "end_at_utc": row["end_at_utc"]} if row else None
+
+    async def giveaway_status(self, gid: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._giveaway_status_sync, int(gid))
+
+    def _giveaway_channels_sync(self, gid):
+        with closing(self._connect()) as db:
+            rows = db.execute("""
+                SELECT gc.chat_id, gc.title, oc.username
+                FROM giveaway_channels gc
+                LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
+                WHERE gc.giveaway_id=?
+                ORDER BY gc.id
+            """, (gid,)).fetchall()
+        return [dict(r) for r in rows]
+
+    async def giveaway_channels(self, gid) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._giveaway_channels_sync, gid)
+
+
+def make_storage():
+    """DATABASE_URL (postgres) → asyncpg-пул; иначе SQLite по DB_PATH."""
+    if DATABASE_URL.startswith("postgres"):
+        if asyncpg is None:
+            raise RuntimeError("DATABASE_URL задан, но asyncpg не установлен (pip install asyncpg)")
+        return PostgresStorage(DATABASE_URL)
+    return SqliteStorage(DB_PATH)
+
+storage = make_storage()
+
+
+async def _local_members(user_id: int, chat_ids: List[int]) -> set:
+    """Каналы (из chat_ids), где подписка уже известна по channel_memberships — один запрос."""
+    try:
+        return await storage.members_local(user_id, chat_ids)
+    except Exception as e:
+        print(f"[WARNING] Local membership check failed: {e}")
+        return set()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Общие HTTP-клиенты (keep-alive, HTTP/2): Telegram Bot API, S3, внутренний API бота
+# ──────────────────────────────────────────────────────────────────────────────
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# HTTP/2 нужен пакет h2 (httpx[http2]); без него клиенты работают по HTTP/1.1
+HTTP2_ENABLED = os.getenv("HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+
+class HttpClients:
+    """
+    Один httpx.AsyncClient на каждый апстрим на весь процесс, вместо клиента на запрос:
+    соединения (и TLS-сессии) переиспользуются, к Telegram и S3 — по HTTP/2.
+    Внутренний API бота — aiohttp без TLS, поэтому там HTTP/1.1 с keep-alive.
+    """
+
+    def __init__(self):
+        self.telegram: AsyncClient | None = None
+        self.s3: AsyncClient | None = None
+        self.internal: AsyncClient | None = None
+
+    @staticmethod
+    def _limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+
+    async def start(self):
+        self.telegram = AsyncClient(http2=HTTP2_ENABLED, limits=self._limits(), timeout=10.0)
+        self.s3 = AsyncClient(http2=HTTP2_ENABLED, limits=self._limits(), timeout=30.0,
+                              follow_redirects=True)
+        self.internal = AsyncClient(limits=self._limits(), timeout=10.0)
+
+    async def close(self):
+        for client in (self.telegram, self.s3, self.internal):
+            if client is not None:
+                await client.aclose()
+
+
+http = HttpClients()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await storage.start()
+    await http.start()
+    await upload_cache.start()
+    print(f"[BOOT] storage={storage.name} http2={HTTP2_ENABLED}")
+    try:
+        yield
+    finally:
+        await http.close()
+        await storage.close()
+
+
+app = FastAPI(lifespan=lifespan)
 @app.middleware("http")
 async def _head_as_get(request, call_next):
-    if request.method != "HEAD":
+    # /uploads отвечает на HEAD сам: GET здесь означал бы скачивание объекта из S3
+    if request.method != "HEAD" or request.url.path.startswith("/uploads/"):
         return await call_next(request)
     request.scope["method"] = "GET"
     resp = await call_next(request)
@@ -91,21 +418,6 @@ def _normalize_chat_id(raw: str | int | None, username: str | None = None) -> tu
     except Exception as e:
         return None, f"normalize_error {type(e).__name__}: {e}"
 
-def _is_member_local(chat_id: int, user_id: int) -> bool:
-    """
-    Проверка локальной БД на членство пользователя
-    """
-    try:
-        with _db() as db:
-            row = db.execute(
-                "SELECT 1 FROM channel_memberships WHERE chat_id=? AND user_id=?",
-                (int(chat_id), int(user_id)),
-            ).fetchone()
-            return row is not None
-    except Exception as e:
-        print(f"[WARNING] Local membership check failed: {e}")
-        return False
-
 # --- POST /api/results ---
 @app.post("/api/results")
 async def api_results(req: Request):
@@ -114,26 +426,16 @@ async def api_results(req: Request):
     """
     try:
         body = await req.json()
-        print(f"[RESULTS] body={body!r}")
+        print(f"[RESULTS] gid={body.get('gid')!r}")  # init_data не логируем
     except Exception:
         return JSONResponse({"ok": False, "reason": "bad_json"}, status_code=400)
 
-    # Извлекаем user_id из init_data
-    raw_init = (body.get("init_data") or "").strip()
-    try:
-        parsed = dict(parse_qsl(raw_init, keep_blank_values=True))
-        user_json_encoded = parsed.get("user")
-        if not user_json_encoded:
-            return JSONResponse({"ok": False, "reason": "no_user_in_initdata"}, status_code=400)
-            
-        user_json = unquote(user_json_encoded)
-        user = json.loads(user_json)
-        user_id = int(user["id"])
-        print(f"[RESULTS] USER_EXTRACTED: id={user_id}")
-        
-    except Exception as e:
-        print(f"[RESULTS] USER_EXTRACTION_FAILED: {e}")
+    # init_data → проверка подписи и user_id
+    parsed = verify_init_data((body.get("init_data") or "").strip())
+    if not parsed:
         return JSONResponse({"ok": False, "reason": "bad_initdata"}, status_code=400)
+    user_id = int(parsed["user_parsed"]["id"])
+    print(f"[RESULTS] user_id={user_id}")
 
     # Получаем gid из параметров
     try:
@@ -145,22 +447,21 @@ async def api_results(req: Request):
 
     # Проксируем запрос к внутреннему API
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                f"{BOT_INTERNAL_URL}/api/giveaway_results",
-                json={"gid": gid, "user_id": user_id},
-                timeout=10.0
+        response = await http.internal.post(
+            f"{BOT_INTERNAL_URL}/api/giveaway_results",
+            json={"gid": gid, "user_id": user_id},
+            timeout=10.0
+        )
+        
+        if response.status_code == 200:
+            result_data = response.json()
+            return JSONResponse(result_data)
+        else:
+            return JSONResponse(
+                {"ok": False, "reason": f"internal_api_error: {response.status_code}"},
+                status_code=500
             )
             
-            if response.status_code == 200:
-                result_data = response.json()
-                return JSONResponse(result_data)
-            else:
-                return JSONResponse(
-                    {"ok": False, "reason": f"internal_api_error: {response.status_code}"},
-                    status_code=500
-                )
-                
     except Exception as e:
         print(f"[RESULTS] Proxy error: {e}")
         return JSONResponse({"ok": False, "reason": f"proxy_error: {e}"}, status_code=500)
@@ -182,7 +483,7 @@ async def api_check(req: Request):
     # 0) тело запроса
     try:
         body = await req.json()
-        print(f"[CHECK] body={body!r}")
+        print(f"[CHECK] gid={body.get('gid')!r}")  # init_data не логируем
     except Exception:
         return JSONResponse({"ok": False, "reason": "bad_json"}, status_code=400)
 
@@ -194,52 +495,20 @@ async def api_check(req: Request):
     if not gid:
         return JSONResponse({"ok": False, "reason": "bad_gid"}, status_code=400)
 
-    # 2) init_data → валидация и user_id - УПРОЩЕННАЯ ВЕРСИЯ
-    raw_init = (body.get("init_data") or "").strip()
-    
-    # ВРЕМЕННО: упрощенная валидация
-    try:
-        # Парсим user напрямую без проверки подписи
-        parsed = dict(parse_qsl(raw_init, keep_blank_values=True))
-        user_json_encoded = parsed.get("user")
-        if not user_json_encoded:
-            return JSONResponse({"ok": False, "reason": "no_user_in_initdata"}, status_code=400)
-            
-        user_json = unquote(user_json_encoded)
-        user = json.loads(user_json)
-        user_id = int(user["id"])
-        print(f"[CHECK] USER_EXTRACTED: id={user_id}")
-        
-    except Exception as e:
-        print(f"[CHECK] USER_EXTRACTION_FAILED: {e}")
+    # 2) init_data → проверка подписи и user_id
+    parsed = verify_init_data((body.get("init_data") or "").strip())
+    if not parsed:
         return JSONResponse({"ok": False, "reason": "bad_initdata"}, status_code=400)
+    user_id = int(parsed["user_parsed"]["id"])
 
-    # 3) читаем каналы розыгрыша
+    # 3) розыгрыш, его каналы и билет пользователя — одним обращением к хранилищу
     try:
-        with _db() as db:
-            rows = db.execute("""
-                SELECT gc.chat_id, gc.title, oc.username
-                FROM giveaway_channels gc
-                LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
-                WHERE gc.giveaway_id=?
-                ORDER BY gc.id
-            """, (gid,)).fetchall()
-            channels = [{"chat_id": r["chat_id"], "title": r["title"], "username": r["username"]} for r in rows]
+        ctx = await storage.giveaway_context(gid, user_id) or {}
     except Exception as e:
         return JSONResponse({"ok": False, "reason": f"db_error: {type(e).__name__}: {e}"}, status_code=500)
-
-    # 3.5) читаем время окончания розыгрыша  ← ДОБАВЬ ЭТОТ БЛОК
-    try:
-        with _db() as db:
-            row = db.execute(
-                "SELECT end_at_utc FROM giveaways WHERE id=?",
-                (gid,)
-            ).fetchone()
-            end_at_utc = row["end_at_utc"] if row else None
-            print(f"[CHECK] Giveaway end_at_utc: {end_at_utc}")
-    except Exception as e:
-        print(f"[CHECK] Error reading giveaway end time: {e}")
-        end_at_utc = None
+    channels = ctx.get("channels") or []
+    end_at_utc = ctx.get("end_at_utc")
+    print(f"[CHECK] Giveaway end_at_utc: {end_at_utc}")
 
     print(f"[CHECK] user_id={user_id}, gid={gid}")
     print(f"[CHECK] channels_from_db: {channels}")
@@ -267,65 +536,80 @@ async def api_check(req: Request):
     need, details = [], []
     is_ok_overall = True  # общий флаг выполнения условий
     
-    async with AsyncClient(timeout=10.0) as client:
-        for ch in channels:
-            raw_id  = ch.get("chat_id")
-            title   = ch.get("title") or ch.get("username") or "канал"
-            uname   = (ch.get("username") or "").lstrip("@") or None
-            chat_id = None
-
-            # 1) Нормализация chat_id
-            chat_id, dbg_norm = _normalize_chat_id(raw_id, uname)
-            details.append(f"[{title}] norm: {dbg_norm}")
-
-            # 2) Если не смогли получить chat_id из raw — пробуем резолв по username
-            if chat_id is None and uname:
-                try:
-                    info = await tg_get_chat(client, uname)
-                    chat_id = int(info["id"])
-                    details.append(f"[{title}] resolved id={chat_id} from @{uname}")
-                    ch["chat_id"] = chat_id
-                except Exception as e:
-                    details.append(f"[{title}] resolve_failed: {type(e).__name__}: {e}")
-                    # Продолжаем с исходным chat_id для проверки через getChatMember
-
-            # 3) Если chat_id так и не появился — используем raw_id для проверки
-            if chat_id is None and raw_id:
-                chat_id = raw_id
-                details.append(f"[{title}] using_raw_id: {raw_id}")
-
-            # 4) Финальная проверка членства
-            channel_ok = False
+    client = http.telegram
+    for ch in channels:
+        raw_id  = ch.get("chat_id")
+        title   = ch.get("title") or ch.get("username") or "канал"
+        uname   = (ch.get("username") or "").lstrip("@") or None
+        chat_id = None
+
+        # 1) Нормализация chat_id
+        chat_id, dbg_norm = _normalize_chat_id(raw_id, uname)
+        details.append(f"[{title}] norm: {dbg_norm}")
+
+        # 2) Если не смогли получить chat_id из raw — пробуем резолв по username
+        if chat_id is None and uname:
             try:
-                if chat_id and _is_member_local(int(chat_id), int(user_id)):
-                    details.append(f"[{title}] local=OK")
+                info = await tg_get_chat(client, uname)
+                chat_id = int(info["id"])
+                details.append(f"[{title}] resolved id={chat_id} from @{uname}")
+                ch["chat_id"] = chat_id
+            except Exception as e:
+                details.append(f"[{title}] resolve_failed: {type(e).__name__}: {e}")
+                # Продолжаем с исходным chat_id для проверки через getChatMember
+
+        # 3) Если chat_id так и не появился — используем raw_id для проверки
+        if chat_id is None and raw_id:
+            chat_id = raw_id
+            details.append(f"[{title}] using_raw_id: {raw_id}")
+        ch["_chat_id"] = chat_id
+
+    # 4) Локальные подписки по всем каналам — одним запросом
+    resolved_ids = []
+    for ch in channels:
+        try:
+            resolved_ids.append(int(ch["_chat_id"]))
+        except (TypeError, ValueError):
+            pass
+    local_ok = await _local_members(user_id, resolved_ids)
+
+    for ch in channels:
+        title   = ch.get("title") or ch.get("username") or "канал"
+        uname   = (ch.get("username") or "").lstrip("@") or None
+        chat_id = ch["_chat_id"]
+
+        # 5) Финальная проверка членства
+        channel_ok = False
+        try:
+            if chat_id and int(chat_id) in local_ok:
+                details.append(f"[{title}] local=OK")
+                channel_ok = True
+            else:
+                ok_api, dbg, status = await tg_get_chat_member(client, int(chat_id), int(user_id))
+                details.append(f"[{title}] {dbg}")
+                
+                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: проверяем статус, а не ok_api
+                if status in {"creator", "administrator", "member"}:
                     channel_ok = True
                 else:
-                    ok_api, dbg, status = await tg_get_chat_member(client, int(chat_id), int(user_id))
-                    details.append(f"[{title}] {dbg}")
-                    
-                    # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: проверяем статус, а не ok_api
-                    if status in {"creator", "administrator", "member"}:
-                        channel_ok = True
-                    else:
-                        channel_ok = False
-                        # ВСЕГДА отдаем username+url, чтобы фронт мог показать ссылку
-                        need.append({
-                            "title": title,
-                            "username": uname,
-                            "url": f"https://t.me/{uname}" if uname else f"https://t.me/{chat_id}",
-                        })
-            except Exception as e:
-                details.append(f"[{title}] get_chat_member_failed: {type(e).__name__}: {e}")
-                channel_ok = False
-                need.append({
-                    "title": title,
-                    "username": uname,
-                    "url": f"https://t.me/{uname}" if uname else f"https://t.me/{chat_id}",
-                })
+                    channel_ok = False
+                    # ВСЕГДА отдаем username+url, чтобы фронт мог показать ссылку
+                    need.append({
+                        "title": title,
+                        "username": uname,
+                        "url": f"https://t.me/{uname}" if uname else f"https://t.me/{chat_id}",
+                    })
+        except Exception as e:
+            details.append(f"[{title}] get_chat_member_failed: {type(e).__name__}: {e}")
+            channel_ok = False
+            need.append({
+                "title": title,
+                "username": uname,
+                "url": f"https://t.me/{uname}" if uname else f"https://t.me/{chat_id}",
+            })
 
-            if not channel_ok:
-                is_ok_overall = False
+        if not channel_ok:
+            is_ok_overall = False
 
     print(f"[DIAGNOSTICS] user_id={user_id}, is_ok_overall={is_ok_overall}")
     print(f"[DIAGNOSTICS] need list: {need}")
@@ -333,81 +617,24 @@ async def api_check(req: Request):
 
     done = is_ok_overall 
 
-    # 5) если всё ок — вернём уже выданный билет (если есть), иначе попробуем выдать новый
+    # 6) если всё ок — вернём уже выданный билет (если есть), иначе выдадим новый
     ticket = None
-    if done:
-        try:
-            with _db() as db:
-                # ВАЖНО: сначала ищем существующий билет
-                row = db.execute(
-                    "SELECT ticket_code FROM entries WHERE giveaway_id=? AND user_id=?",
-                    (gid, user_id),
-                ).fetchone()
-                if row:
-                    ticket = row["ticket_code"]
-                    print(f"[CHECK] ✅ Найден существующий билет: {ticket} для user_id={user_id}, gid={gid}")
-                else:
-                    print(f"[CHECK] 📝 Билет не найден, создаем новый для user_id={user_id}, gid={gid}")
-                    import random, string
-                    alphabet = string.ascii_uppercase + string.digits
-                    # до 8 попыток, чтобы избежать редкой коллизии кода
-                    for attempt in range(8):
-                        code = "".join(random.choices(alphabet, k=6))
-                        try:
-                            db.execute(
-                                "INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at) "
-                                "VALUES (?, ?, ?, 1, strftime('%Y-%m-%d %H:%M:%f','now'))",
-                                (gid, user_id, code),
-                            )
-                            db.commit()
-                            ticket = code
-                            print(f"[CHECK] ✅ Создан новый билет: {ticket} (попытка {attempt + 1})")
-                            break
-                        except Exception as e:
-                            if "UNIQUE constraint failed" in str(e):
-                                print(f"[CHECK] ⚠️ Коллизия билета {code}, пробуем другой")
-                                continue
-                            else:
-                                raise e
-        except Exception as e:
-            print(f"[CHECK] ❌ Ошибка при работе с билетом: {e}")
-            details.append(f"ticket_issue_error: {type(e).__name__}: {e}")
-
-    # 6) итоговый ответ с флагом нового билета
     is_new_ticket = False
-    if done and ticket:
-        # Проверяем, был ли билет только что создан
-        with _db() as db:
-            row = db.execute(
-                "SELECT prelim_checked_at FROM entries WHERE giveaway_id=? AND user_id=? AND ticket_code=?",
-                (gid, user_id, ticket)
-            ).fetchone()
-            if row:
-                try:
-                    # Если билет создан менее 10 секунд назад - считаем его новым
-                    checked_time_str = row["prelim_checked_at"]
-                    print(f"[CHECK] Checking ticket time: {checked_time_str}")
-                    
-                    # Парсим время из базы в UTC
-                    if '.' in checked_time_str:
-                        checked_time = datetime.datetime.strptime(checked_time_str, "%Y-%m-%d %H:%M:%S.%f")
-                    else:
-                        checked_time = datetime.datetime.strptime(checked_time_str, "%Y-%m-%d %H:%M:%S")
-                    
-                    # Приводим оба времени к UTC для корректного сравнения
-                    checked_time_utc = checked_time.replace(tzinfo=datetime.timezone.utc)
-                    current_time_utc = datetime.datetime.now(datetime.timezone.utc)
-                    
-                    time_diff = current_time_utc - checked_time_utc
-                    
-                    print(f"[CHECK] Time diff: {time_diff.total_seconds()} seconds")
-                    is_new_ticket = time_diff.total_seconds() < 10
-                    print(f"[CHECK] Is new ticket: {is_new_ticket}")
-                    
-                except Exception as e:
-                    print(f"[CHECK] Error calculating is_new_ticket: {e}")
-                    # В случае ошибки считаем билет существующим
-                    is_new_ticket = False
+    if done:
+        ticket = ctx.get("ticket")
+        if ticket:
+            print(f"[CHECK] ✅ Найден существующий билет: {ticket} для user_id={user_id}, gid={gid}")
+            # билет, выданный несколько секунд назад (например, параллельным claim), тоже считаем новым
+            is_new_ticket = _ticket_is_fresh(ctx.get("ticket_at"))
+        else:
+            print(f"[CHECK] 📝 Билет не найден, создаем новый для user_id={user_id}, gid={gid}")
+            try:
+                ticket, is_new_ticket = await storage.issue_ticket(gid, user_id)
+                if ticket:
+                    print(f"[CHECK] ✅ Выдан билет: {ticket} (новый={is_new_ticket})")
+            except Exception as e:
+                print(f"[CHECK] ❌ Ошибка при работе с билетом: {e}")
+                details.append(f"ticket_issue_error: {type(e).__name__}: {e}")
 
     # 7) финальный ответ ← ОБНОВИ ЭТОТ БЛОК
     return JSONResponse({
@@ -430,19 +657,14 @@ async def api_claim(req: Request):
 
     try:
         body = await req.json()
-        print(f"[CLAIM] body={body!r}")
+        print(f"[CLAIM] gid={body.get('gid')!r}")  # init_data не логируем
     except Exception:
         return JSONResponse({"ok": False, "reason": "bad_json"}, status_code=400)
 
-    raw_init = (body.get("init_data") or "").strip()
-    validator_used = "mini" if "signature=" in raw_init else "web"
-    parsed = _tg_check_miniapp_initdata(raw_init) if validator_used == "mini" else _tg_check_webapp_initdata(raw_init)
-    print(f"[CLAIM] validator={validator_used} init_data_len={len(raw_init)} parsed={'ok' if parsed else 'None'}")  # лог
-
-    if not parsed or not parsed.get("user_parsed"):
+    parsed = verify_init_data((body.get("init_data") or "").strip())
+    if not parsed:
         return JSONResponse({"ok": False, "reason": "bad_initdata"}, status_code=400)
 
-
     user_id = int(parsed["user_parsed"]["id"])
     try:
         gid = int(body.get("gid") or 0)
@@ -451,80 +673,60 @@ async def api_claim(req: Request):
     if not gid:
         return JSONResponse({"ok": False, "reason": "bad_gid"}, status_code=400)
 
-    # 0) читаем время окончания розыгрыша ← ДОБАВЬ ЭТОТ БЛОК
+    # 0) розыгрыш, его каналы и билет пользователя — одним обращением к хранилищу
     try:
-        with _db() as db:
-            row = db.execute(
-                "SELECT end_at_utc FROM giveaways WHERE id=?",
-                (gid,)
-            ).fetchone()
-            end_at_utc = row["end_at_utc"] if row else None
-            print(f"[CLAIM] Giveaway end_at_utc: {end_at_utc}")
+        ctx = await storage.giveaway_context(gid, user_id) or {}
     except Exception as e:
-        print(f"[CLAIM] Error reading giveaway end time: {e}")
-        end_at_utc = None
+        return JSONResponse({"ok": False, "reason": f"db_error: {type(e).__name__}: {e}"}, status_code=500)
+    end_at_utc = ctx.get("end_at_utc")
+    print(f"[CLAIM] Giveaway end_at_utc: {end_at_utc}")
 
     # Проверяем есть ли уже билет ПРЕЖДЕ проверки подписки
-    try:
-        with _db() as db:
-            row = db.execute(
-                "SELECT ticket_code FROM entries WHERE giveaway_id=? AND user_id=?",
-                (gid, user_id),
-            ).fetchone()
-            if row:
-                print(f"[CLAIM] ✅ Пользователь уже имеет билет: {row['ticket_code']}")
-                return JSONResponse({
-                    "ok": True, 
-                    "done": True, 
-                    "ticket": row["ticket_code"], 
-                    "end_at_utc": end_at_utc,  # ← ДОБАВЬ ЭТУ СТРОКУ
-                    "details": ["Already have ticket - skipping subscription check"]
-                })
-    except Exception as e:
-        print(f"[CLAIM] ⚠️ Ошибка при проверке существующего билета: {e}")
+    if ctx.get("ticket"):
+        print(f"[CLAIM] ✅ Пользователь уже имеет билет: {ctx['ticket']}")
+        return JSONResponse({
+            "ok": True, 
+            "done": True, 
+            "ticket": ctx["ticket"], 
+            "end_at_utc": end_at_utc,
+            "details": ["Already have ticket - skipping subscription check"]
+        })
 
     # 1) повторная проверка подписки (защита, если фронт обходят вручную)
     need = []
     details = []
-    try:
-        with _db() as db:
-            rows = db.execute("""
-                SELECT gc.chat_id, gc.title, oc.username
-                FROM giveaway_channels gc
-                LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
-                WHERE gc.giveaway_id=?
-                ORDER BY gc.id
-            """, (gid,)).fetchall()
-            channels = [
-                {"chat_id": r["chat_id"], "title": r["title"], "username": r["username"]}
-                for r in rows
-            ]
-    except Exception as e:
-        return JSONResponse({"ok": False, "reason": f"db_error: {type(e).__name__}: {e}"}, status_code=500)
-
-    async with AsyncClient(timeout=10.0) as client:
-        for ch in channels:
-            title = ch.get("title") or "канал"
-            username = (ch.get("username") or "").lstrip("@") or None
-            try:
-                chat_id = int(ch.get("chat_id"))
-                if _is_member_local(chat_id, user_id):
-                    is_ok = True
-                else:
-                    ok_check, dbg, status = await tg_get_chat_member(client, chat_id, user_id)
-                    details.append(f"[{title}] {dbg}")
-                    is_ok = status in {"creator", "administrator", "member"}
-            except Exception as e:
-                details.append(f"[{title}] claim_check_failed: {type(e).__name__}: {e}")
-                is_ok = False
-
-            if not is_ok:
-                # ВСЕГДА отдаем username+url
-                need.append({
-                    "title": title,
-                    "username": username,
-                    "url": f"https://t.me/{username}" if username else None,
-                })
+    channels = ctx.get("channels") or []
+    chat_ids = []
+    for ch in channels:
+        try:
+            chat_ids.append(int(ch.get("chat_id")))
+        except (TypeError, ValueError):
+            pass
+    local_ok = await _local_members(user_id, chat_ids)
+
+    client = http.telegram
+    for ch in channels:
+        title = ch.get("title") or "канал"
+        username = (ch.get("username") or "").lstrip("@") or None
+        try:
+            chat_id = int(ch.get("chat_id"))
+            if chat_id in local_ok:
+                is_ok = True
+            else:
+                ok_check, dbg, status = await tg_get_chat_member(client, chat_id, user_id)
+                details.append(f"[{title}] {dbg}")
+                is_ok = status in {"creator", "administrator", "member"}
+        except Exception as e:
+            details.append(f"[{title}] claim_check_failed: {type(e).__name__}: {e}")
+            is_ok = False
+
+        if not is_ok:
+            # ВСЕГДА отдаем username+url
+            need.append({
+                "title": title,
+                "username": username,
+                "url": f"https://t.me/{username}" if username else None,
+            })
 
     # после цикла по каналам
     done = len(need) == 0
@@ -533,73 +735,40 @@ async def api_claim(req: Request):
             "ok": True, 
             "done": False, 
             "need": need, 
-            "end_at_utc": end_at_utc,  # ← ДОБАВЬ ЭТУ СТРОКУ
+            "end_at_utc": end_at_utc,
             "details": details
         })
 
-    # 2) выдаём (или возвращаем существующий) билет
+    # 2) выдаём (или возвращаем выданный параллельным запросом) билет
     try:
-        with _db() as db:
-            # Еще раз проверяем (на случай параллельных запросов)
-            row = db.execute(
-                "SELECT ticket_code FROM entries WHERE giveaway_id=? AND user_id=?",
-                (gid, user_id),
-            ).fetchone()
-            if row:
-                print(f"[CLAIM] ✅ Билет уже существует: {row['ticket_code']}")
-                return JSONResponse({
-                    "ok": True, 
-                    "done": True, 
-                    "ticket": row["ticket_code"], 
-                    "end_at_utc": end_at_utc,  # ← ДОБАВЬ ЭТУ СТРОКУ
-                    "details": details
-                })
-
-            print(f"[CLAIM] 📝 Создаем новый билет для user_id={user_id}, gid={gid}")
-            import random, string
-            alphabet = string.ascii_uppercase + string.digits
-            
-            for attempt in range(12):  # увеличим попытки до 12
-                code = "".join(random.choices(alphabet, k=6))
-                try:
-                    db.execute(
-                        "INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at) "
-                        "VALUES (?, ?, ?, 1, strftime('%Y-%m-%d %H:%M:%f','now'))",
-                        (gid, user_id, code),
-                    )
-                    db.commit()
-                    print(f"[CLAIM] ✅ Успешно создан билет: {code}")
-                    return JSONResponse({
-                        "ok": True, 
-                        "done": True, 
-                        "ticket": code, 
-                        "end_at_utc": end_at_utc,  # ← ДОБАВЬ ЭТУ СТРОКУ
-                        "details": details
-                    })
-                except Exception as e:
-                    if "UNIQUE constraint failed" in str(e):
-                        print(f"[CLAIM] ⚠️ Коллизия билета {code}, попытка {attempt + 1}")
-                        continue
-                    else:
-                        print(f"[CLAIM] ❌ Ошибка базы данных: {e}")
-                        raise e
-            
-            print(f"[CLAIM] ❌ Не удалось создать уникальный билет после 12 попыток")
-            return JSONResponse({
-                "ok": False, 
-                "done": True, 
-                "reason": "ticket_issue_failed_after_retries",
-                "end_at_utc": end_at_utc  # ← ДОБАВЬ ЭТУ СТРОКУ
-            }, status_code=500)
-            
+        print(f"[CLAIM] 📝 Создаем новый билет для user_id={user_id}, gid={gid}")
+        ticket, is_new = await storage.issue_ticket(gid, user_id)
     except Exception as e:
         print(f"[CLAIM] ❌ Критическая ошибка при создании билета: {e}")
         return JSONResponse({
             "ok": False, 
             "reason": f"db_write_error: {type(e).__name__}: {e}",
-            "end_at_utc": end_at_utc  # ← ДОБАВЬ ЭТУ СТРОКУ
+            "end_at_utc": end_at_utc
+        }, status_code=500)
+
+    if not ticket:
+        print(f"[CLAIM] ❌ Не удалось создать уникальный билет после {TICKET_ATTEMPTS} попыток")
+        return JSONResponse({
+            "ok": False, 
+            "done": True, 
+            "reason": "ticket_issue_failed_after_retries",
+            "end_at_utc": end_at_utc
         }, status_code=500)
 
+    print(f"[CLAIM] ✅ Билет: {ticket} (новый={is_new})")
+    return JSONResponse({
+        "ok": True, 
+        "done": True, 
+        "ticket": ticket, 
+        "end_at_utc": end_at_utc,
+        "details": details
+    })
+
 
 # --- POST /api/check_giveaway_status ---
 @app.post("/api/check_giveaway_status")
@@ -615,29 +784,24 @@ async def api_check_giveaway_status(req: Request):
         return JSONResponse({"ok": False, "reason": "bad_gid"}, status_code=400)
 
     try:
-        with _db() as db:
-            # Получаем информацию о розыгрыше
-            row = db.execute(
-                "SELECT status, end_at_utc FROM giveaways WHERE id=?",
-                (gid,)
-            ).fetchone()
-            
-            if not row:
-                return JSONResponse({"ok": False, "reason": "giveaway_not_found"}, status_code=404)
-            
-            status = row["status"]
-            end_at_utc = row["end_at_utc"]
-            
-            # Проверяем, завершен ли розыгрыш
-            is_completed = status in ("completed", "finished")
-            
-            return JSONResponse({
-                "ok": True,
-                "status": status,
-                "end_at_utc": end_at_utc,
-                "is_completed": is_completed
-            })
-            
+        # Получаем информацию о розыгрыше
+        row = await storage.giveaway_status(gid)
+        if not row:
+            return JSONResponse({"ok": False, "reason": "giveaway_not_found"}, status_code=404)
+
+        status = row["status"]
+        end_at_utc = row["end_at_utc"]
+
+        # Проверяем, завершен ли розыгрыш
+        is_completed = status in ("completed", "finished")
+
+        return JSONResponse({
+            "ok": True,
+            "status": status,
+            "end_at_utc": end_at_utc,
+            "is_completed": is_completed
+        })
+
     except Exception as e:
         print(f"[CHECK_STATUS] Error: {e}")
         return JSONResponse({"ok": False, "reason": f"db_error: {e}"}, status_code=500)
@@ -805,88 +969,89 @@ app.mount(
 # Вспомогательные функции
 # ──────────────────────────────────────────────────────────────────────────────
 
-def _db():
-    conn = sqlite3.connect(DB_PATH.as_posix())
-    conn.row_factory = sqlite3.Row
-    return conn
-
 def _status_member_ok(status: str) -> bool:
     return status in ("member", "administrator", "creator")
 
-def _tg_check_webapp_initdata(init_data: str) -> Optional[Dict[str, Any]]:
-    """
-    Проверяем initData по правилам Telegram Mini Apps.
-    ВАЖНО: при построении data_check_string игнорируем поля 'hash' и 'signature'.
-    Возвращаем parsed dict и кладём разобранного user в parsed["user_parsed"].
-    """
-    try:
-        if not init_data or not isinstance(init_data, str):
-            return None
+# ──────────────────────────────────────────────────────────────────────────────
+# Проверка Telegram initData: подпись + свежесть, результат кэшируется по hash
+# ──────────────────────────────────────────────────────────────────────────────
 
-        # Разбираем query-string в словарь (сохраняем пустые значения)
-        parsed_items = dict(parse_qsl(init_data, keep_blank_values=True))
+INITDATA_MAX_AGE = int(os.getenv("INITDATA_MAX_AGE", "86400"))     # сек с auth_date
+INITDATA_CACHE_TTL = float(os.getenv("INITDATA_CACHE_TTL", "300"))
+INITDATA_CACHE_SIZE = int(os.getenv("INITDATA_CACHE_SIZE", "10000"))
+INITDATA_CLOCK_SKEW = 60
 
-        # Вынимаем хэш, а также убираем 'signature' (не участвует в подписи)
-        tg_hash = parsed_items.pop("hash", "")
-        parsed_items.pop("signature", None)
+# Ключ = HMAC-SHA256("WebAppData", BOT_TOKEN) — от токена зависит только он, считаем один раз
+_WEBAPP_SECRET = hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
 
-        if not tg_hash:
-            return None
+# hash -> (expires_at, init_data, parsed). Экран мини-аппа шлёт одну и ту же строку
+# в несколько эндпоинтов — повторная проверка сводится к сравнению строк.
+_initdata_cache: "OrderedDict[str, tuple]" = OrderedDict()
 
-        # Собираем data_check_string: key=value по алфавиту, через \n
-        data_check_string = "\n".join(f"{k}={parsed_items[k]}" for k in sorted(parsed_items.keys()))
 
-        # Ключ = HMAC-SHA256("WebAppData", BOT_TOKEN) → затем HMAC-SHA256(data_check_string, ключ)
-        secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
-        check_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+def _initdata_hash_ok(fields: Dict[str, str], tg_hash: str) -> bool:
+    def check(items: Dict[str, str]) -> bool:
+        data_check_string = "\n".join(f"{k}={items[k]}" for k in sorted(items))
+        digest = hmac.new(_WEBAPP_SECRET, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(digest, tg_hash)
 
-        if not hmac.compare_digest(check_hash, tg_hash):
-            return None
+    if check(fields):
+        return True
+    # старые клиенты считали подпись без поля signature
+    return "signature" in fields and check({k: v for k, v in fields.items() if k != "signature"})
 
-        # Разбираем JSON из поля user
-        user_json = parsed_items.get("user")
-        user = json.loads(user_json) if user_json else None
-        parsed_items["user_parsed"] = user
-        return parsed_items
-    except Exception:
-        return None
-    
-# --- Валидатор для Mini Apps ---
 
-def _tg_check_miniapp_initdata(init_data: str) -> dict | None:
+def verify_init_data(init_data: str) -> Optional[Dict[str, Any]]:
     """
-    Валидация для Telegram Mini Apps - УПРОЩЕННАЯ ВЕРСИЯ
+    Проверяет initData Telegram Mini App / WebApp: HMAC-подпись и auth_date
+    не старше INITDATA_MAX_AGE. Возвращает поля initData плюс
+    user_parsed (dict) и start_param, либо None. Сырой initData не логируется.
     """
+    if not init_data or not isinstance(init_data, str):
+        return None
+
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    tg_hash = fields.pop("hash", "")
+    if not tg_hash:
+        return None
+
+    now = time.time()
+    cached = _initdata_cache.get(tg_hash)
+    if cached is not None:
+        expires_at, cached_init, parsed = cached
+        # совпасть должна вся строка: тот же hash с подменёнными полями — не попадание
+        if expires_at > now and hmac.compare_digest(cached_init, init_data):
+            _initdata_cache.move_to_end(tg_hash)
+            return parsed
+        del _initdata_cache[tg_hash]
+
+    if not _initdata_hash_ok(fields, tg_hash):
+        print(f"[INITDATA] bad signature hash={tg_hash[:8]}")
+        return None
+
     try:
-        if not init_data:
-            return None
-            
-        print(f"[CHECK][mini] raw_init_data: {init_data}")
-        
-        # ВРЕМЕННО: пропускаем проверку подписи для тестирования
-        # Парсим данные чтобы получить user_id
-        parsed = dict(parse_qsl(init_data, keep_blank_values=True))
-        
-        user_json_encoded = parsed.get("user")
-        if not user_json_encoded:
-            return None
-            
-        user_json = unquote(user_json_encoded)
-        user = json.loads(user_json)
-        
-        if not user or "id" not in user:
-            return None
-            
-        print(f"[CHECK][mini] USER EXTRACTED: id={user['id']}")
-        return {
-            "user_parsed": user,
-            "start_param": unquote(parsed.get("start_param", "")) if parsed.get("start_param") else None
-        }
-        
-    except Exception as e:
-        print(f"[CHECK][mini] ERROR: {e}")
+        auth_date = int(fields.get("auth_date") or 0)
+    except ValueError:
+        return None
+    age = now - auth_date
+    if age > INITDATA_MAX_AGE or age < -INITDATA_CLOCK_SKEW:
+        print(f"[INITDATA] expired hash={tg_hash[:8]} age={int(age)}s")
+        return None
+
+    try:
+        user = json.loads(fields["user"]) if fields.get("user") else None
+    except ValueError:
+        return None
+    if not user or "id" not in user:
         return None
 
+    parsed = {**fields, "user_parsed": user, "start_param": fields.get("start_param") or None}
+    ttl = min(INITDATA_CACHE_TTL, INITDATA_MAX_AGE - age)
+    _initdata_cache[tg_hash] = (now + ttl, init_data, parsed)
+    while len(_initdata_cache) > INITDATA_CACHE_SIZE:
+        _initdata_cache.popitem(last=False)
+    return parsed
+
 
 def build_s3_url(key: str) -> str:
     return f"{S3_ENDPOINT}/{S3_BUCKET}/{key.lstrip('/')}"
@@ -895,19 +1060,6 @@ def is_bot_request(request: Request) -> bool:
     ua = request.headers.get("user-agent", "").lower()
     return any(b in ua for b in ("telegrambot", "twitterbot", "facebookexternalhit", "linkedinbot"))
 
-# Добавьте эту функцию для тестирования
-def test_miniapp_validation():
-    """Тест на реальных данных Mini Apps"""
-    # Пример реального init_data (замените на актуальный из логов)
-    test_init_data = "user=%7B%22id%22%3A428883823%2C%22first_name%22%3A%22Nikita%22%2C%22last_name%22%3A%22Semenov%22%2C%22username%22%3A%22NikSemyonov%22%2C%22language_code%22%3A%22ru%22%2C%22is_premium%22%3Atrue%2C%22allows_write_to_pm%22%3Atrue%2C%22photo_url%22%3A%22https%3A%5C%2F%5C%2Ft.me%5C%2Fi%5C%2Fuserpic%5C%2F320%5C%2FYehTOpkUodPx8emwyz2PN7JwrDxf2aHqZN7fofdhjvw.svg%22%7D&chat_instance=3485967117599202343&chat_type=channel&start_param=13&auth_date=1761558433&signature=rvUP2hyaDgqfJ_vrS4tdwtUMQH6g_9o1DB-xYBV2iBGDEsrukYC8wSk_MAslZyVR60SW1qoX5flPM44tqldNBg&hash=2ed65a38563fcedfb9b3fb1a7091ae3a7a6e06ba9c69c2e4e75955a18b132ab4"
-    
-    result = _tg_check_miniapp_initdata(test_init_data)
-    print(f"Test result: {result is not None}")
-    if result:
-        print(f"User ID: {result['user_parsed']['id']}")
-    
-    return result
-
 # --- helper: getChat c поддержкой @username / ссылок / числовых id
 async def tg_get_chat(client: AsyncClient, ref: str | int) -> dict:
     """
@@ -1001,41 +1153,300 @@ async def tg_get_chat_member(client: AsyncClient, chat_id: int, user_id: int) ->
 
 
 # ──────────────────────────────────────────────────────────────────────────────
-# Прокси /uploads/* → S3 (200 OK, без редиректа) + OG для ботов
+# Прокси /uploads/* → S3 (200 OK, без редиректа): потоковая отдача + дисковый LRU-кэш
 # ──────────────────────────────────────────────────────────────────────────────
 
-@app.api_route("/uploads/{path:path}", methods=["GET", "HEAD"])
-async def uploads(path: str, request: Request):
+UPLOAD_CACHE_DIR = Path(os.getenv("UPLOAD_CACHE_DIR", "/var/cache/prizeme/uploads"))
+UPLOAD_CACHE_MAX_BYTES = int(os.getenv("UPLOAD_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Объекты крупнее не кэшируются, а проксируются потоком (с пробросом Range)
+UPLOAD_CACHE_MAX_OBJECT = int(os.getenv("UPLOAD_CACHE_MAX_OBJECT", str(64 * 1024 ** 2)))
+UPLOAD_CHUNK = 64 * 1024
+
+
+class UploadEntry:
+    __slots__ = ("file", "size", "etag", "ctype")
+
+    def __init__(self, file: Path, size: int, etag: str, ctype: str):
+        self.file = file
+        self.size = size
+        self.etag = etag
+        self.ctype = ctype
+
+
+class UploadCache:
     """
-    Отдаём ИМЕННО медиа-файл для всех клиентов (и для ботов тоже),
-    без OG-HTML — чтобы в Telegram не появлялись title/description.
+    Горячие объекты S3 на локальном диске, вытеснение по LRU при превышении
+    UPLOAD_CACHE_MAX_BYTES. Рядом с файлом лежит .meta (путь, ETag, Content-Type) —
+    после рестарта кэш восстанавливается сканированием каталога.
+    Промахи по одному пути схлопываются: сколько бы запросов ни пришло
+    одновременно, объект скачивается из S3 один раз.
     """
+    TOO_LARGE = object()   # объект есть, но в кэш не помещается — отдаём потоком
+    MISSING = object()     # S3 ответил ошибкой
+
+    def __init__(self, root: Path, max_bytes: int, max_object: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_object = max_object
+        self._index: "OrderedDict[str, UploadEntry]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._too_large: set = set()
+        self.enabled = False
+
+    def _file_for(self, path: str) -> Path:
+        return self.root / hashlib.sha256(path.encode("utf-8")).hexdigest()
+
+    def _scan(self) -> list:
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        for meta_file in self.root.glob("*.meta"):
+            data_file = meta_file.with_suffix("")
+            try:
+                meta = json.loads(meta_file.read_text())
+                st = data_file.stat()
+            except (OSError, ValueError):
+                meta_file.unlink(missing_ok=True)
+                data_file.unlink(missing_ok=True)
+                continue
+            found.append((st.st_atime, meta["path"], UploadEntry(data_file, st.st_size, meta["etag"], meta["ctype"])))
+        for tmp in self.root.glob("*.part"):
+            tmp.unlink(missing_ok=True)
+        return sorted(found, key=lambda x: x[0])
+
+    async def start(self):
+        try:
+            for _, path, entry in await asyncio.to_thread(self._scan):
+                self._index[path] = entry
+                self._bytes += entry.size
+            self.enabled = True
+            print(f"[UPLOADS] cache dir={self.root} objects={len(self._index)} bytes={self._bytes}")
+        except OSError as e:
+            # без каталога кэша сервис работает как чистый потоковый прокси
+            print(f"[UPLOADS] cache disabled: {e}")
+
+    def get(self, path: str) -> Optional[UploadEntry]:
+        entry = self._index.get(path)
+        if entry is not None:
+            self._index.move_to_end(path)
+        return entry
+
+    def is_too_large(self, path: str) -> bool:
+        return path in self._too_large
+
+    def _put(self, path: str, entry: UploadEntry) -> None:
+        old = self._index.pop(path, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._index[path] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            _, evicted = self._index.popitem(last=False)
+            self._bytes -= evicted.size
+            # открытые на чтение файлы дочитываются: unlink на POSIX их не обрывает
+            evicted.file.with_suffix(".meta").unlink(missing_ok=True)
+            evicted.file.unlink(missing_ok=True)
+
+    async def fetch(self, path: str):
+        """UploadEntry из кэша (скачав при необходимости), TOO_LARGE или MISSING."""
+        entry = self.get(path)
+        if entry is not None:
+            return entry
+        task = self._inflight.get(path)
+        if task is None:
+            task = asyncio.create_task(self._download(path))
+            self._inflight[path] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(path, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, path: str):
+        target = self._file_for(path)
+        tmp = target.with_suffix(".part")
+        async with http.s3.stream("GET", build_s3_url(path)) as r:
+            if r.status_code >= 400:
+                return self.MISSING
+            size = int(r.headers.get("content-length") or 0)
+            if size > self.max_object:
+                self._too_large.add(path)
+                return self.TOO_LARGE
+            ctype = r.headers.get("content-type") or (mimetypes.guess_type(path)[0] or "application/octet-stream")
+            etag = r.headers.get("etag") or ""
+            written = 0
+            try:
+                async with await anyio.open_file(tmp, "wb") as f:
+                    async for chunk in r.aiter_bytes(UPLOAD_CHUNK):
+                        written += len(chunk)
+                        if written > self.max_object:
+                            break   # Content-Length не было или он соврал
+                        await f.write(chunk)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+        if written > self.max_object:
+            tmp.unlink(missing_ok=True)
+            self._too_large.add(path)
+            return self.TOO_LARGE
+        if not etag:
+            etag = '"' + hashlib.sha256(f"{path}:{written}".encode()).hexdigest()[:32] + '"'
+        meta = json.dumps({"path": path, "etag": etag, "ctype": ctype})
+        await asyncio.to_thread(target.with_suffix(".meta").write_text, meta)
+        os.replace(tmp, target)
+        entry = UploadEntry(target, written, etag, ctype)
+        self._put(path, entry)
+        return entry
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "objects": len(self._index), "bytes": self._bytes,
+                "max_bytes": self.max_bytes, "inflight": len(self._inflight)}
+
+
+upload_cache = UploadCache(UPLOAD_CACHE_DIR, UPLOAD_CACHE_MAX_BYTES, UPLOAD_CACHE_MAX_OBJECT)
+
+
+def _parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """Один диапазон bytes=a-b / a- / -n → (start, end) включительно; None — отдать целиком."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[6:].strip().partition("-")
+    try:
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+        else:
+            start = max(size - int(end_s), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError("unsatisfiable")
+    return start, min(end, size - 1)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == bare for t in if_none_match.split(","))
+
+
+async def _file_slice(file: Path, start: int, length: int):
+    async with await anyio.open_file(file, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _serve_cached(entry: UploadEntry, request: Request) -> Response:
+    headers = {
+        "ETag": entry.etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"public, max-age={CACHE_SEC}",
+        "X-Cache": "HIT",
+    }
+    if _etag_matches(request.headers.get("if-none-match", ""), entry.etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        rng = _parse_range(request.headers.get("range", ""), entry.size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{entry.size}"})
+    if rng is None:
+        # целиком — FileResponse (sendfile там, где сервер его поддерживает)
+        return FileResponse(entry.file, media_type=entry.ctype, headers=headers)
+
+    start, end = rng
+    length = end - start + 1
+    headers.update({"Content-Range": f"bytes {start}-{end}/{entry.size}", "Content-Length": str(length)})
+    return StreamingResponse(_file_slice(entry.file, start, length), status_code=206,
+                             media_type=entry.ctype, headers=headers)
+
+
+def _head_cached(entry: UploadEntry, request: Request) -> Response:
+    """HEAD по объекту из кэша — только заголовки из метаданных, файл не читается."""
+    headers = {
+        "ETag": entry.etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"public, max-age={CACHE_SEC}",
+        "X-Cache": "HIT",
+    }
+    if _etag_matches(request.headers.get("if-none-match", ""), entry.etag):
+        return Response(status_code=304, headers=headers)
+    headers.update({"Content-Type": entry.ctype, "Content-Length": str(entry.size)})
+    return Response(status_code=200, headers=headers)
+
+
+_PASS_REQUEST_HEADERS = ("range", "if-none-match", "if-range")
+_PASS_RESPONSE_HEADERS = ("content-length", "content-range", "etag", "accept-ranges", "last-modified")
+
+
+async def _stream_from_s3(path: str, request: Request) -> Response:
+    """Кэш недоступен или объект слишком большой — поток из S3 с пробросом Range/ETag."""
     s3_url = build_s3_url(path)
-    method = "HEAD" if request.method == "HEAD" else "GET"
+    fwd = {k: v for k, v in request.headers.items() if k.lower() in _PASS_REQUEST_HEADERS}
+    r = await http.s3.send(http.s3.build_request("GET", s3_url, headers=fwd), stream=True)
+    if r.status_code >= 400 and r.status_code != 416:
+        await r.aclose()
+        return Response(status_code=404)
+
+    headers = {k: v for k, v in r.headers.items() if k.lower() in _PASS_RESPONSE_HEADERS}
+    headers["Cache-Control"] = f"public, max-age={CACHE_SEC}"
+    headers["X-Cache"] = "MISS"
+    ctype = r.headers.get("content-type") or (mimetypes.guess_type(path)[0] or "application/octet-stream")
+    return StreamingResponse(r.aiter_bytes(UPLOAD_CHUNK), status_code=r.status_code, media_type=ctype,
+                             headers=headers, background=BackgroundTask(r.aclose))
 
-    # Тянем файл с S3 (или только заголовки, если HEAD)
-    async with httpx.AsyncClient(follow_redirects=True, timeout=30.0) as client:
-        r = await client.request(method, s3_url)
 
-    # Если S3 вернул ошибку — маппим её на 404 (чтобы Telegram не строил карточки-ошибки)
-    status = 200 if r.status_code < 400 else 404
+async def _head_from_s3(path: str, request: Request) -> Response:
+    """HEAD без копии в кэше — HEAD в S3, тело объекта не запрашивается."""
+    fwd = {k: v for k, v in request.headers.items() if k.lower() in _PASS_REQUEST_HEADERS}
+    r = await http.s3.head(build_s3_url(path), headers=fwd)
+    if r.status_code >= 400:
+        return Response(status_code=404)
+    headers = {k: v for k, v in r.headers.items() if k.lower() in _PASS_RESPONSE_HEADERS}
+    headers["Content-Type"] = r.headers.get("content-type") or (mimetypes.guess_type(path)[0] or "application/octet-stream")
+    headers["Cache-Control"] = f"public, max-age={CACHE_SEC}"
+    headers["X-Cache"] = "MISS"
+    return Response(status_code=r.status_code, headers=headers)
 
-    # Тело отдаём только для GET
-    content = b"" if method == "HEAD" else (r.content or b"")
 
-    # Корректный Content-Type
-    ctype = r.headers.get("content-type") or (mimetypes.guess_type(path)[0] or "application/octet-stream")
+@app.api_route("/uploads/{path:path}", methods=["GET", "HEAD"])
+async def uploads(path: str, request: Request):
+    """
+    Отдаём ИМЕННО медиа-файл для всех клиентов (и для ботов тоже),
+    без OG-HTML — чтобы в Telegram не появлялись title/description.
+    Повторные запросы обслуживаются с диска, не обращаясь к S3; память на
+    запрос — один чанк, а не весь файл. HEAD не скачивает объект и не наполняет кэш.
+    """
+    if request.method == "HEAD":
+        entry = upload_cache.get(path) if upload_cache.enabled else None
+        if entry is not None:
+            return _head_cached(entry, request)
+        return await _head_from_s3(path, request)
+
+    if upload_cache.enabled and not upload_cache.is_too_large(path):
+        try:
+            result = await upload_cache.fetch(path)
+        except Exception as e:
+            print(f"[UPLOADS] cache fill failed for {path}: {type(e).__name__}: {e}")
+            result = None
+        if result is UploadCache.MISSING:
+            # ошибку S3 маппим на 404 (чтобы Telegram не строил карточки-ошибки)
+            return Response(status_code=404)
+        if isinstance(result, UploadEntry):
+            return _serve_cached(result, request)
 
-    resp = Response(content=content, status_code=status, media_type=ctype)
+    return await _stream_from_s3(path, request)
 
-    # Пробрасываем длину файла (для GET). Для HEAD тело пустое — длину не ставим.
-    if method == "GET" and "content-length" in r.headers:
-        resp.headers["Content-Length"] = r.headers["content-length"]
 
-    # Кэш и отладка
-    resp.headers["Cache-Control"] = f"public, max-age={CACHE_SEC}"
-    resp.headers["X-Proxy-From"] = s3_url
-    return resp
+@app.get("/api/debug/uploads_cache")
+async def uploads_cache_stats():
+    return JSONResponse({"ok": True, "cache": upload_cache.stats()})
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Fallback: принять ЛЮБОЙ HEAD на любом пути → 200 OK без тела
@@ -1073,41 +1484,33 @@ async def debug_full_check(req: Request):
 
     # Получаем каналы для розыгрыша
     try:
-        with _db() as db:
-            rows = db.execute("""
-                SELECT gc.chat_id, gc.title, oc.username
-                FROM giveaway_channels gc
-                LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
-                WHERE gc.giveaway_id=?
-                ORDER BY gc.id
-            """, (gid,)).fetchall()
-            channels = [{"chat_id": r["chat_id"], "title": r["title"], "username": r["username"]} for r in rows]
+        channels = await storage.giveaway_channels(gid)
     except Exception as e:
         return JSONResponse({"ok": False, "error": f"db_error: {e}"}, status_code=500)
 
     results = []
-    async with AsyncClient(timeout=10.0) as client:
-        for ch in channels:
-            chat_id = ch.get("chat_id")
-            title = ch.get("title") or "канал"
-            
-            try:
-                # Проверяем через Telegram API
-                ok_api, dbg, status = await tg_get_chat_member(client, int(chat_id), int(user_id))
-                results.append({
-                    "channel": title,
-                    "chat_id": chat_id,
-                    "status": status,
-                    "is_member": ok_api,
-                    "debug": dbg,
-                    "allowed": status in {"creator", "administrator", "member"}
-                })
-            except Exception as e:
-                results.append({
-                    "channel": title,
-                    "chat_id": chat_id,
-                    "error": str(e)
-                })
+    client = http.telegram
+    for ch in channels:
+        chat_id = ch.get("chat_id")
+        title = ch.get("title") or "канал"
+        
+        try:
+            # Проверяем через Telegram API
+            ok_api, dbg, status = await tg_get_chat_member(client, int(chat_id), int(user_id))
+            results.append({
+                "channel": title,
+                "chat_id": chat_id,
+                "status": status,
+                "is_member": ok_api,
+                "debug": dbg,
+                "allowed": status in {"creator", "administrator", "member"}
+            })
+        except Exception as e:
+            results.append({
+                "channel": title,
+                "chat_id": chat_id,
+                "error": str(e)
+            })
 
     return JSONResponse({"ok": True, "user_id": user_id, "gid": gid, "results": results})
 
@@ -1125,18 +1528,18 @@ async def debug_check_membership(req: Request):
     if not user_id or (not chat_id and not username):
         return JSONResponse({"ok": False, "error": "bad_args"}, status_code=400)
 
-    async with AsyncClient(timeout=10.0) as client:
-        # a) resolve @username -> chat_id при необходимости
-        if chat_id is None and username:
-            try:
-                info = await tg_get_chat(client, username)   # используем существующий helper
-                chat_id = int(info["id"])
-            except Exception as e:
-                return JSONResponse({"ok": True, "result": {"resolve_error": f"{type(e).__name__}: {e}"}}, status_code=200)
-
-         # b) membership
+    client = http.telegram
+    # a) resolve @username -> chat_id при необходимости
+    if chat_id is None and username:
         try:
-            ok, dbg, status = await tg_get_chat_member(client, int(chat_id), int(user_id))
-            return JSONResponse({"ok": True, "result": {"is_member": ok, "debug": dbg, "status": status, "chat_id": int(chat_id)}})
+            info = await tg_get_chat(client, username)   # используем существующий helper
+            chat_id = int(info["id"])
         except Exception as e:
-            return JSONResponse({"ok": False, "error": f"{type(e).__name__}: {e}"}, status_code=500)
\ No newline at end of file
+            return JSONResponse({"ok": True, "result": {"resolve_error": f"{type(e).__name__}: {e}"}}, status_code=200)
+
+     # b) membership
+    try:
+        ok, dbg, status = await tg_get_chat_member(client, int(chat_id), int(user_id))
+        return JSONResponse({"ok": True, "result": {"is_member": ok, "debug": dbg, "status": status, "chat_id": int(chat_id)}})
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": f"{type(e).__name__}: {e}"}, status_code=500)
\ No newline at end of file
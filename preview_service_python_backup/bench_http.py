@@ -0,0 +1,89 @@
+"""
+Бенчмарк задержек preview-сервиса: p50/p99 для /uploads/* и /api/check.
+
+Запускается против работающего сервиса — один раз на старой ревизии
+(клиент httpx на каждый запрос), один раз на новой (общие клиенты), и
+результаты сравниваются:
+
+    python bench_http.py --base http://127.0.0.1:8000 \\
+        --upload giveaways/42/cover.jpg --gid 42 --init-data "$INIT_DATA" \\
+        -n 500 -c 20
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def _percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    idx = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+async def _run(client: httpx.AsyncClient, make_request, n: int, concurrency: int):
+    latencies: list[float] = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with sem:
+            started = time.perf_counter()
+            try:
+                r = await make_request(client)
+                await r.aread()
+                if r.status_code >= 500:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one() for _ in range(n)))
+    return sorted(latencies), errors
+
+
+def _report(label: str, latencies: list[float], errors: int) -> None:
+    ms = [x * 1000 for x in latencies]
+    print(
+        f"{label:<10} {len(ms):>6} {errors:>6} "
+        f"{_percentile(ms, 50):>9.1f} {_percentile(ms, 99):>9.1f} "
+        f"{(statistics.fmean(ms) if ms else float('nan')):>9.1f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base", default="http://127.0.0.1:8000")
+    parser.add_argument("--upload", help="путь внутри /uploads/, например giveaways/1/cover.jpg")
+    parser.add_argument("--gid", type=int, help="розыгрыш для /api/check")
+    parser.add_argument("--init-data", default="", help="Telegram WebApp initData для /api/check")
+    parser.add_argument("-n", type=int, default=200, help="запросов на эндпоинт")
+    parser.add_argument("-c", type=int, default=10, help="одновременных запросов")
+    args = parser.parse_args()
+
+    targets = []
+    if args.upload:
+        targets.append(("uploads", lambda c: c.get(f"/uploads/{args.upload.lstrip('/')}")))
+    if args.gid:
+        targets.append(("api/check", lambda c: c.post(
+            "/api/check", json={"gid": args.gid, "init_data": args.init_data}
+        )))
+    if not targets:
+        parser.error("укажите --upload и/или --gid")
+
+    limits = httpx.Limits(max_connections=args.c, max_keepalive_connections=args.c)
+    async with httpx.AsyncClient(base_url=args.base, limits=limits, timeout=60.0) as client:
+        print(f"{'endpoint':<10} {'ok':>6} {'errors':>6} {'p50, ms':>9} {'p99, ms':>9} {'mean, ms':>9}")
+        for label, make_request in targets:
+            await make_request(client)   # прогрев: DNS, соединение, кэши сервиса
+            latencies, errors = await _run(client, make_request, args.n, args.c)
+            _report(label, latencies, errors)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
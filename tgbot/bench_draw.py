@@ -0,0 +1,49 @@
+"""
+Бенчмарк выбора победителей: deterministic_draw (без удаления из пула)
+против исходной реализации на list.pop.
+
+Запуск:  python bench_draw.py [--winners 100] [--sizes 1000,100000,1000000]
+"""
+import argparse
+import random
+import time
+
+from draw_engine import deterministic_draw, deterministic_draw_legacy
+
+
+def _best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--winners", type=int, default=100)
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    print(f"{'participants':>12} {'input':>9} {'legacy, ms':>12} {'new, ms':>12} {'speedup':>8}  same")
+    for n in (int(x) for x in args.sizes.split(",")):
+        shuffled = rnd.sample(range(10**6, 10**10), n)
+        # finalize выбирает участников с ORDER BY user_id — пул приходит уже отсортированным
+        for label, user_ids in (("random", shuffled), ("sorted", sorted(shuffled))):
+            k = min(args.winners, n)
+
+            legacy = deterministic_draw_legacy("giveaway_secret", 1, user_ids, k)
+            new = deterministic_draw("giveaway_secret", 1, user_ids, k)
+
+            t_legacy = _best_of(lambda: deterministic_draw_legacy("giveaway_secret", 1, user_ids, k), args.repeat)
+            t_new = _best_of(lambda: deterministic_draw("giveaway_secret", 1, user_ids, k), args.repeat)
+            print(
+                f"{n:>12} {label:>9} {t_legacy * 1000:>12.1f} {t_new * 1000:>12.1f} "
+                f"{t_legacy / t_new:>7.2f}x  {legacy == new}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,10 @@ import uuid
 import mimetypes
 import boto3
 import asyncio, os, hashlib, random, string
+import heapq, itertools
+from contextvars import ContextVar
 from datetime import datetime, timezone, timedelta
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
 from io import BytesIO
 from html import escape
@@ -16,9 +18,10 @@ import time
 import json
 
 from functools import lru_cache
+from collections import OrderedDict
 
 from aiogram.enums import ChatType
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
 from aiogram.types import ChatMemberUpdated, ChatJoinRequest
 from aiogram import Bot, Dispatcher, F
 import aiogram.types as types
@@ -32,18 +35,21 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemo
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.types import LinkPreviewOptions
 
 from sqlalchemy import text as _sqltext
 from sqlalchemy import text as stext
 from sqlalchemy import (text, String, Integer, BigInteger,
-                        Boolean, DateTime, ForeignKey)
+                        Boolean, DateTime, ForeignKey, event)
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.asyncio import (create_async_engine, async_sessionmaker)
 
 from html.parser import HTMLParser
 from aiogram.types import MessageEntity
 
+from draw_engine import deterministic_draw_async
+
 # 🔧 ПРИНУДИТЕЛЬНАЯ ЗАГРУЗКА ASYNCPG ДЛЯ ИЗБЕЖАНИЯ КОНФЛИКТА
 import sys
 venv_path = "/root/telegram-giveaway-prizeme-bot/venv/lib/python3.12/site-packages"
@@ -57,6 +63,7 @@ except ImportError as e:
     sys.exit(1)
 
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.orm import Session as SyncSession
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.date import DateTrigger
@@ -1458,33 +1465,260 @@ DB_URL = _db_url.replace("postgresql://", "postgresql+asyncpg://", 1)
 import sqlalchemy.dialects.postgresql.asyncpg
 print("✅ asyncpg драйвер принудительно зарегистрирован в SQLAlchemy")
 
-engine = create_async_engine(DB_URL, echo=True, future=True)
+# --- Профиль движка БД (всё настраивается через .env) ---
+# DB_ECHO=1 включает лог каждого SQL — только для отладки, в проде это заметная доля CPU.
+# За PgBouncer в transaction-режиме кэши подготовленных выражений нужно выключить:
+# DB_PREPARED_CACHE_SIZE=0 и DB_STATEMENT_CACHE_SIZE=0.
+DB_ECHO = os.getenv("DB_ECHO", "0").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))        # кэш скомпилированного SQL в SQLAlchemy
+DB_PREPARED_CACHE_SIZE = int(os.getenv("DB_PREPARED_CACHE_SIZE", "500"))   # prepared statements диалекта asyncpg
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500")) # собственный кэш asyncpg-соединения
+
+if DB_URL and "prepared_statement_cache_size" not in DB_URL:
+    DB_URL += ("&" if "?" in DB_URL else "?") + f"prepared_statement_cache_size={DB_PREPARED_CACHE_SIZE}"
+
+engine = create_async_engine(
+    DB_URL,
+    echo=DB_ECHO,
+    future=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    query_cache_size=DB_QUERY_CACHE_SIZE,
+    connect_args={"statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+)
 Session = async_sessionmaker(engine, expire_on_commit=False)
 
+
+def db_pool_stats() -> dict:
+    """Текущее состояние пула соединений — для подбора DB_POOL_SIZE под нагрузку."""
+    pool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout": DB_POOL_TIMEOUT,
+        "status": pool.status(),
+    }
+
+# ============================================================================
+# IN-PROCESS КЭШ С TTL И ОГРАНИЧЕНИЕМ РАЗМЕРА
+# ============================================================================
+
+class TTLCache:
+    """
+    Ограниченный по размеру кэш: TTL на каждую запись + вытеснение самых давних (LRU).
+    Методы синхронные (без await внутри), поэтому в asyncio лок не нужен.
+    """
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()   # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key, self._MISSING)
+        if item is not self._MISSING:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            # просроченную запись не удаляем: она пригодится get_stale при ошибке источника,
+            # а место освободит LRU-вытеснение или следующий set
+        self.misses += 1
+        return default
+
+    def get_stale(self, key, default=None):
+        """Значение без учёта TTL — запасной ответ, когда источник недоступен."""
+        item = self._data.get(key, self._MISSING)
+        return default if item is self._MISSING else item[1]
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate) -> int:
+        keys = [k for k in self._data if predicate(k)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+# --- Кэш подписок (chat_id, user_id) -> bool ---
+# Положительный ответ живёт дольше: отписка ловится chat_member-апдейтом и финальной проверкой.
+# Отрицательный — коротко, чтобы пользователь, только что подписавшийся, не ждал.
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+MEMBERSHIP_CACHE_POS_TTL = float(os.getenv("MEMBERSHIP_CACHE_POS_TTL", "300"))
+MEMBERSHIP_CACHE_NEG_TTL = float(os.getenv("MEMBERSHIP_CACHE_NEG_TTL", "15"))
+
+_membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_POS_TTL)
+
+
+def remember_membership(chat_id: int, user_id: int, is_member: bool) -> None:
+    _membership_cache.set(
+        (int(chat_id), int(user_id)), bool(is_member),
+        MEMBERSHIP_CACHE_POS_TTL if is_member else MEMBERSHIP_CACHE_NEG_TTL
+    )
+
+
+def forget_membership(chat_id: int, user_id: int) -> None:
+    _membership_cache.invalidate((int(chat_id), int(user_id)))
+
+
 async def mark_membership(chat_id: int, user_id: int) -> None:
     async with Session() as s:
         async with s.begin():
             await s.execute(
                 _sqltext(
                     "INSERT INTO channel_memberships(chat_id, user_id) "
-                    "VALUES (:c, :u) ON CONFLICT (chat_id, user_id) DO NOTHING"
+                    "VALUES (:c, :u) ON CONFLICT (chat_id, user_id) "
+                    "DO UPDATE SET left_at = NULL, joined_at = CURRENT_TIMESTAMP "
+                    "WHERE channel_memberships.left_at IS NOT NULL"
                 ),
                 {"c": chat_id, "u": user_id},
             )
+    remember_membership(chat_id, user_id, True)
 
 # --- Проверяет подписку пользователя в локальной базе данных ---
-async def is_member_local(chat_id: int, user_id: int) -> bool:
+async def is_member_local(chat_id: int, user_id: int) -> bool | None:
+    """
+    True — подписан по channel_memberships, False — известен выход (left_at),
+    None — записи нет или БД недоступна: ответ неизвестен, нужен API.
+    """
     try:
         async with session_scope() as s:
-            # 🔧 ИСПРАВЛЕННЫЙ SQL ДЛЯ POSTGRESQL
             res = await s.execute(
-                text("SELECT 1 FROM channel_memberships WHERE chat_id = :chat_id AND user_id = :user_id"),
+                text("SELECT left_at IS NULL FROM channel_memberships WHERE chat_id = :chat_id AND user_id = :user_id"),
                 {"chat_id": chat_id, "user_id": user_id}
             )
-            return res.scalar() is not None
+            return res.scalar()
     except Exception as e:
-        print(f"⚠️ Ошибка проверки локальной подписки: {e}")
-        return False
+        logging.warning(f"⚠️ Ошибка проверки локальной подписки chat={chat_id} user={user_id}: {e}")
+        return None
+
+
+async def get_membership(bot, chat_id: int, user_id: int) -> tuple[bool, str]:
+    """
+    Read-through проверка подписки: кэш → channel_memberships → get_chat_member.
+    Возвращает (is_member, источник/статус). Ошибки API не кэшируются.
+    """
+    chat_id, user_id = int(chat_id), int(user_id)
+    cached = _membership_cache.get((chat_id, user_id))
+    if cached is not None:
+        return cached, "cache"
+
+    local = await is_member_local(chat_id, user_id)
+    if local is not None:
+        remember_membership(chat_id, user_id, local)
+        return local, "local" if local else "left"
+
+    try:
+        m = await bot.get_chat_member(chat_id, user_id)
+    except Exception as e:
+        logging.warning(f"[CHK] chat={chat_id} user={user_id} err={e}")
+        return False, "unknown"
+    ok = _member_status_ok(m)
+    remember_membership(chat_id, user_id, ok)
+    return ok, (m.status or "").lower()
+
+# --- Приём chat_member-апдейтов в channel_memberships ---
+# События копятся в словаре (последнее событие по паре побеждает) и пишутся
+# фоновым флашером пачкой: два запроса на пачку вместо запроса на событие.
+MEMBERSHIP_FLUSH_INTERVAL = float(os.getenv("MEMBERSHIP_FLUSH_INTERVAL", "1.0"))
+MEMBERSHIP_FLUSH_BATCH = 500
+
+_membership_events: dict[tuple[int, int], bool] = {}
+_membership_flush_now = asyncio.Event()
+
+
+def queue_membership_event(chat_id: int, user_id: int, joined: bool) -> None:
+    _membership_events[(int(chat_id), int(user_id))] = bool(joined)
+    if len(_membership_events) >= MEMBERSHIP_FLUSH_BATCH:
+        _membership_flush_now.set()
+
+
+async def flush_membership_events() -> int:
+    global _membership_events
+    if not _membership_events:
+        return 0
+    batch, _membership_events = _membership_events, {}
+    joins = [k for k, joined in batch.items() if joined]
+    leaves = [k for k, joined in batch.items() if not joined]
+    try:
+        async with session_scope() as s:
+            if joins:
+                await s.execute(
+                    text("""
+                        INSERT INTO channel_memberships(chat_id, user_id)
+                        SELECT * FROM unnest(CAST(:chats AS BIGINT[]), CAST(:users AS BIGINT[]))
+                        ON CONFLICT (chat_id, user_id) DO UPDATE
+                        SET left_at = NULL, joined_at = CURRENT_TIMESTAMP
+                        WHERE channel_memberships.left_at IS NOT NULL
+                    """),
+                    {"chats": [c for c, _ in joins], "users": [u for _, u in joins]}
+                )
+            if leaves:
+                await s.execute(
+                    text("""
+                        INSERT INTO channel_memberships(chat_id, user_id, left_at)
+                        SELECT c, u, CURRENT_TIMESTAMP
+                        FROM unnest(CAST(:chats AS BIGINT[]), CAST(:users AS BIGINT[])) AS t(c, u)
+                        ON CONFLICT (chat_id, user_id) DO UPDATE SET left_at = CURRENT_TIMESTAMP
+                    """),
+                    {"chats": [c for c, _ in leaves], "users": [u for _, u in leaves]}
+                )
+    except Exception as e:
+        # не теряем события: возвращаем в буфер, более свежие (пришедшие за время записи) важнее
+        logging.error(f"[MEMBERSHIP] flush failed ({len(batch)} events): {e}")
+        _membership_events = {**batch, **_membership_events}
+        return 0
+    return len(batch)
+
+
+async def membership_flusher() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_membership_flush_now.wait(), MEMBERSHIP_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _membership_flush_now.clear()
+        written = await flush_membership_events()
+        if written:
+            logging.debug(f"[MEMBERSHIP] flushed {written} events")
 
 # создать все таблицы по ORM-моделям (если их ещё нет)
 async def init_db():
@@ -1532,6 +1766,60 @@ async def ensure_schema():
             PRIMARY KEY (chat_id, user_id)
         );
         """)
+        # left_at заполняется по chat_member-апдейтам: NULL — подписан, иначе — известный выход
+        await conn.exec_driver_sql("""
+        ALTER TABLE channel_memberships ADD COLUMN IF NOT EXISTS left_at TIMESTAMP;
+        """)
+        # 6) Общая очередь исходящих сообщений (рассылки, уведомления о розыгрышах, промо).
+        #    status: pending → sending → sent | blocked | dead
+        await conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS outbox_messages (
+            id              BIGSERIAL   PRIMARY KEY,
+            batch_key       TEXT        NOT NULL,
+            chat_id         BIGINT      NOT NULL,
+            text            TEXT        NOT NULL,
+            reply_markup    JSONB,
+            options         JSONB       NOT NULL DEFAULT '{}'::jsonb,
+            priority        SMALLINT    NOT NULL DEFAULT 100,
+            status          TEXT        NOT NULL DEFAULT 'pending',
+            attempts        INTEGER     NOT NULL DEFAULT 0,
+            last_error      TEXT,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_at       TIMESTAMPTZ,
+            created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at         TIMESTAMPTZ,
+            UNIQUE (batch_key, chat_id)
+        );
+        """)
+        await conn.exec_driver_sql("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+        ON outbox_messages(priority, id) WHERE status = 'pending';
+        """)
+        await conn.exec_driver_sql("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_sending
+        ON outbox_messages(locked_at) WHERE status = 'sending';
+        """)
+        # 5) Снимок прошедших финальную проверку — чтобы перерозыгрыш не проверял всех заново
+        await conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS giveaway_eligibility (
+            giveaway_id INTEGER     PRIMARY KEY,
+            user_ids    BIGINT[]    NOT NULL,
+            verified_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """)
+
+    # 7) Уникальность билетов — на ней держится ON CONFLICT в issue_ticket.
+    #    Каждый индекс в своей транзакции: если в старых данных есть дубли,
+    #    создание упадёт, но остальная схема и второй индекс не пострадают.
+    for ddl in (
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_entries_gid_uid ON entries(giveaway_id, user_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_entries_gid_ticket ON entries(giveaway_id, ticket_code)",
+    ):
+        try:
+            async with engine.begin() as conn:
+                await conn.exec_driver_sql(ddl)
+        except Exception as e:
+            logging.error(f"[SCHEMA] {ddl}: {e}")
 
 @asynccontextmanager
 async def session_scope():
@@ -1543,11 +1831,190 @@ async def session_scope():
             await s.rollback()
             raise
 
+# ============================================================================
+# КЭШ РОЗЫГРЫШЕЙ (giveaway + каналы) С ВЕРСИЯМИ
+# ============================================================================
+
+# TTL — только страховка: основное устаревание идёт через invalidate_giveaway после коммита
+GIVEAWAY_CACHE_SIZE = int(os.getenv("GIVEAWAY_CACHE_SIZE", "5000"))
+GIVEAWAY_CACHE_TTL = float(os.getenv("GIVEAWAY_CACHE_TTL", "30"))
+
+
+class GiveawaySnapshot:
+    """
+    Снимок розыгрыша для read-only путей: отсоединённый Giveaway
+    и каналы в виде кортежей (chat_id, title, username) в порядке прикрепления.
+    Объект общий для всех читателей — менять его нельзя.
+    """
+    __slots__ = ("gw", "channels", "version")
+
+    def __init__(self, gw: "Giveaway", channels: tuple, version: int):
+        self.gw = gw
+        self.channels = channels
+        self.version = version
+
+    def channel_pairs(self) -> list[tuple]:
+        """(title, chat_id) — формат check_membership_on_all."""
+        return [(title, chat_id) for chat_id, title, _ in self.channels]
+
+
+_giveaway_cache = TTLCache(GIVEAWAY_CACHE_SIZE, GIVEAWAY_CACHE_TTL)
+_giveaway_versions: dict[int, int] = {}           # gid -> номер последней инвалидации
+_giveaway_inflight: dict[int, asyncio.Future] = {}
+
+
+def invalidate_giveaway(gid: int) -> None:
+    """Сбрасывает снимок; загрузка, начатая до вызова, в кэш уже не попадёт."""
+    gid = int(gid)
+    _giveaway_versions[gid] = _giveaway_versions.get(gid, 0) + 1
+    _giveaway_cache.invalidate(gid)
+    _giveaway_inflight.pop(gid, None)
+
+
+def mark_giveaway_dirty(s, gid: int) -> None:
+    """
+    Для изменений сырым SQL (stext): розыгрыш будет сброшен из кэша после коммита сессии.
+    ORM-изменения Giveaway/GiveawayChannel отслеживаются автоматически (см. ниже).
+    """
+    s.info.setdefault("dirty_giveaways", set()).add(int(gid))
+
+
+@event.listens_for(SyncSession, "after_flush")
+def _collect_dirty_giveaways(session, flush_context):
+    # после flush у новых объектов уже есть id, а new/dirty/deleted ещё в состоянии до flush
+    dirty = session.info.setdefault("dirty_giveaways", set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Giveaway) and obj.id is not None:
+            dirty.add(obj.id)
+        elif isinstance(obj, GiveawayChannel) and obj.giveaway_id is not None:
+            dirty.add(obj.giveaway_id)
+
+
+@event.listens_for(SyncSession, "after_commit")
+def _invalidate_committed_giveaways(session):
+    for gid in session.info.pop("dirty_giveaways", ()):
+        invalidate_giveaway(gid)
+
+
+@event.listens_for(SyncSession, "after_rollback")
+def _discard_dirty_giveaways(session):
+    session.info.pop("dirty_giveaways", None)
+
+
+async def _load_giveaway_snapshot(gid: int, version: int) -> GiveawaySnapshot | None:
+    async with Session() as s:
+        gw = await s.get(Giveaway, gid)
+        if not gw:
+            return None
+        res = await s.execute(stext("""
+            SELECT gc.chat_id, gc.title, oc.username
+            FROM giveaway_channels gc
+            LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
+            WHERE gc.giveaway_id = :g
+            ORDER BY gc.id
+        """), {"g": gid})
+        channels = tuple(tuple(r) for r in res.all())
+    return GiveawaySnapshot(gw, channels, version)
+
+
+async def get_giveaway_snapshot(gid: int) -> GiveawaySnapshot | None:
+    """
+    Розыгрыш и его каналы из кэша; промахи по одному gid схлопываются в один запрос.
+    None — розыгрыша нет (не кэшируется: он может появиться сразу после создания).
+    """
+    gid = int(gid)
+    snap = _giveaway_cache.get(gid)
+    if snap is not None:
+        return snap
+
+    fut = _giveaway_inflight.get(gid)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _giveaway_inflight[gid] = fut
+    version = _giveaway_versions.get(gid, 0)
+    try:
+        snap = await _load_giveaway_snapshot(gid, version)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    else:
+        if snap is not None and version == _giveaway_versions.get(gid, 0):
+            _giveaway_cache.set(gid, snap)
+        fut.set_result(snap)
+        return snap
+    finally:
+        if _giveaway_inflight.get(gid) is fut:
+            del _giveaway_inflight[gid]
+
+
+def giveaway_cache_stats() -> dict:
+    return {**_giveaway_cache.stats(), "inflight": len(_giveaway_inflight)}
+
 # ----------------- HELPERS -----------------
 ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 def gen_ticket_code(): return "".join(random.choices(ALPHABET, k=6))
 def utcnow(): return datetime.now(timezone.utc)
 
+
+# --- Выдача билета: один запрос вместо проверки, source_channel, INSERT и цикла по каналам ---
+_ISSUE_TICKET_SQL = text("""
+    WITH existing AS (
+        SELECT ticket_code FROM entries WHERE giveaway_id = :gid AND user_id = :uid
+    ),
+    ins AS (
+        INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at, source_channel_id)
+        SELECT :gid, :uid, :code, true, :ts,
+               (SELECT chat_id FROM giveaway_channels WHERE giveaway_id = :gid ORDER BY id LIMIT 1)
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT DO NOTHING
+        RETURNING ticket_code
+    ),
+    subs AS (
+        INSERT INTO entry_subscriptions(giveaway_id, user_id, channel_id, was_subscribed)
+        SELECT :gid, :uid, gc.chat_id, :was
+        FROM giveaway_channels gc, ins
+        WHERE gc.giveaway_id = :gid
+        ON CONFLICT(giveaway_id, user_id, channel_id) DO NOTHING
+    )
+    SELECT ticket_code, true AS is_new FROM ins
+    UNION ALL
+    SELECT ticket_code, false AS is_new FROM existing
+""")
+
+async def issue_ticket(giveaway_id: int, user_id: int, was_subscribed: bool = False) -> tuple[str | None, bool]:
+    """
+    Выдаёт билет участнику (или возвращает уже выданный) за один round trip:
+    entries + entry_subscriptions по всем каналам розыгрыша в одной транзакции.
+    Возвращает (ticket_code, is_new). (None, False) — если выдать не удалось.
+
+    Пустой результат бывает только при гонке: совпал ticket_code или параллельный
+    запрос того же пользователя успел вставить строку — тогда повторяем,
+    и следующая попытка либо вставит новый код, либо увидит существующий билет.
+    """
+    for attempt in range(5):
+        code = gen_ticket_code()
+        try:
+            async with session_scope() as s:
+                res = await s.execute(_ISSUE_TICKET_SQL, {
+                    "gid": giveaway_id, "uid": user_id, "code": code,
+                    "ts": utcnow(), "was": was_subscribed,
+                })
+                row = res.first()
+            if row:
+                return row.ticket_code, bool(row.is_new)
+        except Exception as e:
+            logging.error(
+                f"❌ Ticket insert failed gid={giveaway_id} uid={user_id} attempt={attempt+1}: {e}",
+                exc_info=True
+            )
+    return None, False
+
 async def ensure_user(user_id: int, username: str | None):
     username = (username or "").strip() or None
 
@@ -1603,9 +2070,9 @@ async def ensure_bot_user(user_id: int, username: str | None = None, first_name:
             bot_user.is_active = True
             logging.info(f"✅ Данные пользователя бота обновлены: {user_id}")
         
-        # Проверяем членство в премиум-группе и PRIME-канале
-        await check_and_update_premium_status(bot_user, s)
-        await check_and_update_prime_status(bot_user, s)
+        # Статусы premium/PRIME берём из кэша уровней; живая проверка членства
+        # в премиум-группе и PRIME-канале идёт в фоне и не задерживает ответ
+        tier_service.apply_to(bot_user)
         await s.commit()  # КОММИТ после обновлений
         return bot_user
 
@@ -1746,6 +2213,10 @@ async def get_user_status(user_id: int) -> str:
     Возвращает статус пользователя (standard/premium)
     Если пользователя нет в базе - регистрирует со статусом standard
     """
+    cached = tier_service.get(user_id)
+    if cached is not None:
+        return cached[0]
+
     async with session_scope() as s:
         bot_user = await s.get(BotUser, user_id)
         
@@ -1773,10 +2244,321 @@ async def get_user_status(user_id: int) -> str:
                     updated_at=datetime.now(timezone.utc)
                 )
                 s.add(bot_user)
-        
+
+        tier_service.apply_to(bot_user)
         return bot_user.user_status
 
 
+# ============================================================================
+# КЭШ УРОВНЕЙ ПОЛЬЗОВАТЕЛЕЙ (premium / PRIME)
+# ============================================================================
+# user_id → (user_status, is_prime, checked_at). Свежая запись отдаётся из памяти,
+# устаревшая — тоже из памяти, но с фоновым обновлением через существующие
+# check_and_update_premium_status / check_and_update_prime_status.
+# Дополнительно запись обновляют chat_member-события премиум-группы и PRIME-канала,
+# а периодический sweeper с низким приоритетом освежает активных пользователей.
+
+TIER_CACHE_TTL = float(os.getenv("TIER_CACHE_TTL", "600"))
+TIER_CACHE_SIZE = int(os.getenv("TIER_CACHE_SIZE", "100000"))
+TIER_IDLE_EVICT = 6 * 3600     # сек без обращений — запись выбрасывается sweeper'ом
+TIER_SWEEP_BATCH = 200         # обновлений за один проход sweeper'а
+TIER_ERROR_RETRY = 30          # сек до повторной проверки, если Telegram не ответил
+
+
+async def _tier_membership(chat_id: int, user_id: int) -> bool | None:
+    """Членство для TierService: True / False, None — Telegram не ответил (таймаут, 429, сеть)."""
+    try:
+        return _member_status_ok(await bot.get_chat_member(chat_id=chat_id, user_id=user_id))
+    except TelegramBadRequest as e:
+        if any(marker in str(e).lower() for marker in _NOT_A_MEMBER_ERRORS):
+            return False
+        logging.warning(f"[TIER] chat={chat_id} user={user_id} bad request: {e}")
+        return None
+    except Exception as e:
+        logging.warning(f"[TIER] chat={chat_id} user={user_id} err={e}")
+        return None
+
+
+class TierService:
+    def __init__(self):
+        # user_id -> [user_status, is_prime, checked_at, last_access]; времена — time.monotonic()
+        self._entries: OrderedDict = OrderedDict()
+        self._refreshing: set[int] = set()
+
+    @staticmethod
+    def _age_to_monotonic(checked_at: datetime | None) -> float:
+        """Переводит время проверки из БД в шкалу monotonic (None — «давно»)."""
+        if not checked_at:
+            return 0.0
+        if checked_at.tzinfo is None:
+            checked_at = checked_at.replace(tzinfo=timezone.utc)
+        return time.monotonic() - max(0.0, (utcnow() - checked_at).total_seconds())
+
+    def _put(self, user_id: int, status: str, is_prime: bool, checked_at: float) -> None:
+        self._entries[user_id] = [status, bool(is_prime), checked_at, time.monotonic()]
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > TIER_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    def get(self, user_id: int) -> tuple[str, bool] | None:
+        """(user_status, is_prime) из памяти; устаревшая запись запускает фоновое обновление."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        entry[3] = time.monotonic()
+        if entry[3] - entry[2] > TIER_CACHE_TTL:
+            self.schedule_refresh(user_id)
+        return entry[0], entry[1]
+
+    def apply_to(self, bot_user: BotUser) -> None:
+        """
+        Синхронизирует ORM-объект с кэшем: известный уровень переносится в bot_user,
+        неизвестный — берётся из БД как устаревший и обновляется в фоне.
+        """
+        uid = bot_user.user_id
+        entry = self._entries.get(uid)
+        if entry is None:
+            checked = min(self._age_to_monotonic(bot_user.last_group_check),
+                          self._age_to_monotonic(bot_user.last_prime_check))
+            self._put(uid, bot_user.user_status or 'standard', bool(bot_user.is_prime), checked)
+        else:
+            bot_user.user_status, bot_user.is_prime = entry[0], entry[1]
+        self.get(uid)
+
+    def apply_event(self, user_id: int, *, status: str | None = None, is_prime: bool | None = None) -> None:
+        """chat_member-событие премиум-группы / PRIME-канала — точное значение без запроса к API."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            # второе поле неизвестно — запись сразу устаревшая, его добьёт фоновое обновление
+            self._put(user_id, status or 'standard', bool(is_prime), 0.0)
+        else:
+            if status is not None:
+                entry[0] = status
+            if is_prime is not None:
+                entry[1] = is_prime
+        asyncio.create_task(self._persist(user_id, status, is_prime))
+
+    def schedule_refresh(self, user_id: int) -> None:
+        if user_id in self._refreshing:
+            return
+        self._refreshing.add(user_id)
+        asyncio.create_task(self._refresh(user_id))
+
+    async def _refresh(self, user_id: int) -> None:
+        """
+        Ошибка API — «неизвестно», а не «не состоит»: прежнее значение остаётся
+        в кэше и в БД, повторная проверка — через TIER_ERROR_RETRY, а не через TTL.
+        """
+        try:
+            with api_priority_scope(API_PRIORITY_BACKGROUND):
+                in_group = await _tier_membership(PREMIUM_GROUP_ID, user_id)
+                in_prime = await _tier_membership(PRIME_CHANNEL_ID, user_id)
+            status = None if in_group is None else ('premium' if in_group else 'standard')
+
+            entry = self._entries.get(user_id)
+            complete = in_group is not None and in_prime is not None
+            if entry is None and not complete:
+                return  # прежнего значения нет — запись поднимется из БД при следующем обращении
+            checked_at = time.monotonic() if complete else time.monotonic() - TIER_CACHE_TTL + TIER_ERROR_RETRY
+            self._put(
+                user_id,
+                status if status is not None else entry[0],
+                in_prime if in_prime is not None else entry[1],
+                checked_at,
+            )
+            if status is not None or in_prime is not None:
+                await self._persist(user_id, status, in_prime)
+        except Exception as e:
+            logging.warning(f"[TIER] refresh failed for {user_id}: {e}")
+        finally:
+            self._refreshing.discard(user_id)
+
+    async def _persist(self, user_id: int, status: str | None, is_prime: bool | None) -> None:
+        try:
+            async with session_scope() as s:
+                if status is not None:
+                    await s.execute(
+                        text("UPDATE bot_users SET user_status = :st, last_group_check = NOW(), updated_at = NOW() "
+                             "WHERE user_id = :uid"),
+                        {"st": status, "uid": user_id}
+                    )
+                if is_prime is not None:
+                    await s.execute(
+                        text("UPDATE bot_users SET is_prime = :p, last_prime_check = NOW(), updated_at = NOW() "
+                             "WHERE user_id = :uid"),
+                        {"p": is_prime, "uid": user_id}
+                    )
+        except Exception as e:
+            logging.warning(f"[TIER] persist failed for {user_id}: {e}")
+
+    async def sweep(self) -> None:
+        """Фоновая задача: выбрасывает давно неактивных, освежает устаревшие записи активных."""
+        now = time.monotonic()
+        idle = [uid for uid, e in self._entries.items() if now - e[3] > TIER_IDLE_EVICT]
+        for uid in idle:
+            self._entries.pop(uid, None)
+        stale = [uid for uid, e in self._entries.items() if now - e[2] > TIER_CACHE_TTL]
+        for uid in stale[:TIER_SWEEP_BATCH]:
+            self.schedule_refresh(uid)
+        if idle or stale:
+            logging.info(f"[TIER] sweep: evicted={len(idle)} stale={len(stale)} size={len(self._entries)}")
+
+
+tier_service = TierService()
+
+
+# ============================================================================
+# WRITE-BEHIND ЗАПИСЬ АКТИВНОСТИ ПОЛЬЗОВАТЕЛЕЙ
+# ============================================================================
+# Нажатие «Участвовать» раньше стоило трёх транзакций (bot_users, users,
+# giveaway_clicks) до любой полезной работы. Теперь данные копятся в памяти
+# и раз в USER_ACTIVITY_FLUSH_INTERVAL пишутся одной транзакцией через executemany.
+# Повторы одного пользователя схлопываются (побеждает последнее значение).
+
+USER_ACTIVITY_FLUSH_INTERVAL = float(os.getenv("USER_ACTIVITY_FLUSH_INTERVAL", "0.3"))
+# Сколько раз подряд пачка может не записаться целиком, прежде чем писать её построчно
+USER_ACTIVITY_MAX_ATTEMPTS = int(os.getenv("USER_ACTIVITY_MAX_ATTEMPTS", "5"))
+# Потолок буфера (на пользователей и на клики отдельно): при переполнении теряются самые старые
+USER_ACTIVITY_MAX_BUFFER = int(os.getenv("USER_ACTIVITY_MAX_BUFFER", "50000"))
+USER_ACTIVITY_MAX_BACKOFF = 30.0
+
+_UPSERT_BOT_USERS_SQL = text("""
+    INSERT INTO bot_users(user_id, username, first_name, user_status, created_at, updated_at, is_active, is_prime)
+    VALUES (:uid, :uname, :fname, 'standard', NOW(), NOW(), true, false)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username   = COALESCE(EXCLUDED.username, bot_users.username),
+        first_name = COALESCE(EXCLUDED.first_name, bot_users.first_name),
+        updated_at = NOW(),
+        is_active  = true
+""")
+_UPSERT_USERS_SQL = text("""
+    INSERT INTO users(user_id, username, is_premium, language_code, first_name)
+    VALUES (:uid, :uname, :premium, :lang, :fname)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username      = COALESCE(EXCLUDED.username, users.username),
+        is_premium    = EXCLUDED.is_premium,
+        language_code = COALESCE(EXCLUDED.language_code, users.language_code),
+        first_name    = COALESCE(EXCLUDED.first_name, users.first_name)
+""")
+_INSERT_CLICKS_SQL = text("""
+    INSERT INTO giveaway_clicks(giveaway_id, user_id, clicked_at)
+    VALUES (:gid, :uid, NOW())
+    ON CONFLICT(giveaway_id, user_id) DO NOTHING
+""")
+
+
+class UserActivityCollector:
+    def __init__(self):
+        self._users: dict[int, dict] = {}
+        self._clicks: dict[tuple[int, int], None] = {}   # упорядоченное множество (gid, uid)
+        self._failures = 0      # подряд неудачных записей текущей пачки
+        self.dropped = 0
+
+    def _trim(self, buf: dict, what: str) -> None:
+        excess = len(buf) - USER_ACTIVITY_MAX_BUFFER
+        if excess <= 0:
+            return
+        for key in list(itertools.islice(buf, excess)):
+            del buf[key]
+        self.dropped += excess
+        logging.warning(f"[ACTIVITY] buffer full, dropped {excess} oldest {what}")
+
+    def record_join(self, tg_user: types.User, giveaway_id: int) -> None:
+        # pop + вставка переносит пользователя в конец: вытесняются действительно самые старые
+        self._users.pop(tg_user.id, None)
+        self._users[tg_user.id] = {
+            "uid":     tg_user.id,
+            "uname":   tg_user.username,
+            "premium": bool(getattr(tg_user, 'is_premium', False)),
+            "lang":    getattr(tg_user, 'language_code', None),
+            "fname":   tg_user.first_name,
+        }
+        self._clicks[(giveaway_id, tg_user.id)] = None
+        self._trim(self._users, "users")
+        self._trim(self._clicks, "clicks")
+
+    @staticmethod
+    async def _write(users: list[dict], clicks: list[tuple[int, int]]) -> None:
+        async with session_scope() as s:
+            if users:
+                await s.execute(_UPSERT_BOT_USERS_SQL, users)
+                await s.execute(_UPSERT_USERS_SQL, users)
+            if clicks:
+                await s.execute(_INSERT_CLICKS_SQL, [{"gid": gid, "uid": uid} for gid, uid in clicks])
+
+    @staticmethod
+    async def _db_alive() -> bool:
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    async def _write_one_by_one(self, users: dict, clicks: dict) -> tuple[dict, dict]:
+        """
+        Построчная запись пачки, которая не пишется целиком. Строка, упавшая при живой БД, —
+        «ядовитая»: логируется и отбрасывается. Если БД недоступна, построчная запись
+        прекращается, и всё незаписанное возвращается в буфер.
+        """
+        pending = [("user", uid, row) for uid, row in users.items()] + [("click", key, None) for key in clicks]
+        dropped = []
+        for i, (kind, key, row) in enumerate(pending):
+            try:
+                if kind == "user":
+                    await self._write([row], [])
+                else:
+                    await self._write([], [key])
+            except Exception as e:
+                if not await self._db_alive():
+                    rest = pending[i:]
+                    return ({k: r for kind_, k, r in rest if kind_ == "user"},
+                            {k: None for kind_, k, _ in rest if kind_ == "click"})
+                dropped.append(key)
+                logging.error(f"[ACTIVITY] dropped unwritable {kind} {key}: {e}")
+        self.dropped += len(dropped)
+        return {}, {}
+
+    async def flush(self) -> bool:
+        """True — буфер записан (или пуст), False — данные остались в буфере."""
+        if not (self._users or self._clicks):
+            return True
+        users, self._users = self._users, {}
+        clicks, self._clicks = self._clicks, {}
+        try:
+            await self._write(list(users.values()), list(clicks))
+        except Exception as e:
+            self._failures += 1
+            logging.error(
+                f"[ACTIVITY] flush failed (attempt {self._failures}, users={len(users)}, "
+                f"clicks={len(clicks)}): {e}"
+            )
+            if self._failures >= USER_ACTIVITY_MAX_ATTEMPTS:
+                users, clicks = await self._write_one_by_one(users, clicks)
+                if not (users or clicks):
+                    self._failures = 0
+                    return True
+            # возвращаем в буфер перед пришедшими за время записи: они свежее и вытесняются последними
+            self._users = {**users, **self._users}
+            self._clicks = {**clicks, **self._clicks}
+            self._trim(self._users, "users")
+            self._trim(self._clicks, "clicks")
+            return False
+        self._failures = 0
+        logging.debug(f"[ACTIVITY] flushed users={len(users)} clicks={len(clicks)}")
+        return True
+
+    async def run(self) -> None:
+        while True:
+            # при ошибках БД — экспоненциальная пауза, а не лог раз в USER_ACTIVITY_FLUSH_INTERVAL
+            delay = min(USER_ACTIVITY_FLUSH_INTERVAL * 2 ** min(self._failures, 10), USER_ACTIVITY_MAX_BACKOFF)
+            await asyncio.sleep(delay)
+            await self.flush()
+
+
+user_activity = UserActivityCollector()
+
+
 # ============================================================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С ДОПОЛНИТЕЛЬНЫМИ МЕХАНИКАМИ
 # ============================================================================
@@ -1899,92 +2681,73 @@ async def remove_giveaway_mechanic(giveaway_id: int, mechanic_type: str) -> bool
                 {"gid": giveaway_id, "type": mechanic_type}
             )
             mechanics_logger.info(f"✅ Удалена механика {mechanic_type} для розыгрыша {giveaway_id}")
-            return True
+        await clear_mechanics_cache(giveaway_id)
+        return True
     except Exception as e:
         mechanics_logger.error(f"❌ Ошибка удаления механики {mechanic_type} для розыгрыша {giveaway_id}: {e}")
         return False
 
 # --- Возвращает список всех механик для розыгрыша с поддержкой кэширования ---
-# ГЛОБАЛЬНЫЙ КЭШ ДЛЯ МЕХАНИК
-_mechanics_cache = {}
-_cache_lock = asyncio.Lock()
+# ГЛОБАЛЬНЫЙ КЭШ ДЛЯ МЕХАНИК (LRU + TTL, пустые результаты тоже кэшируются)
 _CACHE_TTL = 60  # Время жизни кэша в секундах (1 минута)
 _MAX_CACHE_SIZE = 1000  # Максимальное количество записей в кэше
+_mechanics_cache = TTLCache(_MAX_CACHE_SIZE, _CACHE_TTL)
+
+# Чтение кэша — без блокировок: TTLCache синхронный, между await его никто не меняет.
+# Промахи по одному ключу схлопываются (single-flight): N одновременных запросов
+# к холодному розыгрышу дают один запрос к БД, остальные ждут его результат.
+_mechanics_inflight: dict[str, asyncio.Future] = {}
+_mechanics_generation = 0   # растёт при каждой инвалидации; устаревшая загрузка не пишет в кэш
+
+
+async def _mechanics_single_flight(cache_key: str, loader):
+    fut = _mechanics_inflight.get(cache_key)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    # исключение забирается здесь, чтобы не было "Future exception was never retrieved"
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _mechanics_inflight[cache_key] = fut
+    generation = _mechanics_generation
+    try:
+        result = await loader()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    else:
+        if generation == _mechanics_generation:
+            _mechanics_cache.set(cache_key, result)
+        fut.set_result(result)
+        return result
+    finally:
+        if _mechanics_inflight.get(cache_key) is fut:
+            del _mechanics_inflight[cache_key]
 
 async def get_giveaway_mechanics(giveaway_id: int, use_cache: bool = True) -> list:
     """Получает список механик для розыгрыша с правильным парсингом JSON"""
     
     cache_key = f"mechanics_{giveaway_id}"
-    current_time = time.time()
     
     # Проверка кэша
     if use_cache:
-        async with _cache_lock:
-            if cache_key in _mechanics_cache:
-                cached_data, timestamp = _mechanics_cache[cache_key]
-                if current_time - timestamp < _CACHE_TTL:
-                    mechanics_logger.debug(f"🔄 Используем кэшированные механики для розыгрыша {giveaway_id}")
-                    return cached_data.copy()
+        cached_data = _mechanics_cache.get(cache_key)
+        if cached_data is not None:
+            mechanics_logger.debug(f"🔄 Используем кэшированные механики для розыгрыша {giveaway_id}")
+            return cached_data.copy()
     
     try:
-        async with session_scope() as s:
-            # 🔥 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: правильный SQL запрос
-            result = await s.execute(
-                text("""
-                    SELECT 
-                        id,
-                        mechanic_type, 
-                        is_active, 
-                        config,
-                        created_at
-                    FROM giveaway_mechanics 
-                    WHERE giveaway_id = :gid
-                    ORDER BY created_at DESC
-                """),
-                {"gid": giveaway_id}
+        if use_cache:
+            # в кэш попадает (в том числе пустой) список — это самый частый случай
+            mechanics_list = await _mechanics_single_flight(
+                cache_key, lambda: _load_giveaway_mechanics(giveaway_id)
             )
-            rows = result.fetchall()
-            
-            mechanics_list = []
-            for row in rows:
-                try:
-                    # 🔥 ИСПРАВЛЕНИЕ: правильно получаем значения из row
-                    mechanic_id = row[0]
-                    mechanic_type = row[1]
-                    is_active = bool(row[2])
-                    config_str = row[3] if row[3] else '{}'
-                    
-                    # 🔥 ПРАВИЛЬНО ПАРСИМ JSON
-                    config_dict = {}
-                    if config_str and config_str != '{}':
-                        try:
-                            config_dict = json.loads(config_str)
-                        except json.JSONDecodeError:
-                            config_dict = {}
-                    
-                    mechanics_list.append({
-                        "id": mechanic_id,
-                        "type": mechanic_type,
-                        "is_active": is_active,
-                        "config": config_dict,
-                        "created_at": row[4].isoformat() if hasattr(row[4], 'isoformat') else str(row[4]),
-                        "has_config": bool(config_dict)
-                    })
-                    
-                    mechanics_logger.debug(f"📝 Механика прочитана: type={mechanic_type}, active={is_active}, config_len={len(config_str)}")
-                    
-                except Exception as row_error:
-                    mechanics_logger.error(f"❌ Ошибка обработки строки механики: {row_error}, row={row}")
-                    continue
-            
-            mechanics_logger.info(f"📊 Получено {len(mechanics_list)} механик для розыгрыша {giveaway_id}")
-            
-            # Обновляем кэш
-            if use_cache and mechanics_list:
-                async with _cache_lock:
-                    _mechanics_cache[cache_key] = (mechanics_list.copy(), current_time)
-            
-            return mechanics_list
+        else:
+            mechanics_list = await _load_giveaway_mechanics(giveaway_id)
+        return mechanics_list.copy()
             
     except Exception as e:
         mechanics_logger.error(f"❌ Ошибка получения механик для розыгрыша {giveaway_id}: {e}")
@@ -1992,81 +2755,142 @@ async def get_giveaway_mechanics(giveaway_id: int, use_cache: bool = True) -> li
         # При ошибке возвращаем пустой список
         return []
 
-# --- Очищает кэш механик (Если передан giveaway_id - очищает только для этого розыгрыша) ---
-async def clear_mechanics_cache(giveaway_id: int = None):
-
-    async with _cache_lock:
-        if giveaway_id:
-            cache_key = f"mechanics_{giveaway_id}"
-            if cache_key in _mechanics_cache:
-                del _mechanics_cache[cache_key]
-                mechanics_logger.info(f"🧹 Очищен кэш механик для розыгрыша {giveaway_id}")
-        else:
-            _mechanics_cache.clear()
-            mechanics_logger.info("🧹 Очищен весь кэш механик")
-
-
-# --- Проверяет, активна ли конкретная механика для розыгрыша с кэшированием ---
-async def is_mechanic_active(giveaway_id: int, mechanic_type: str, use_cache: bool = True) -> bool:
 
-    cache_key = f"active_{giveaway_id}_{mechanic_type}"
-    current_time = time.time()
-    
-    # ПРОВЕРКА КЭША
-    if use_cache:
-        async with _cache_lock:
-            if cache_key in _mechanics_cache:
-                cached_result, timestamp = _mechanics_cache[cache_key]
-                if current_time - timestamp < _CACHE_TTL:
-                    mechanics_logger.debug(f"🔄 Используем кэшированный статус активности для {mechanic_type} розыгрыша {giveaway_id}")
-                    return cached_result
-    
-    try:
-        async with session_scope() as s:
-            # ОЧИСТКА КЭША SQLAlchemy ПЕРЕД ЗАПРОСОМ
-            s.expire_all()
-            
-            # УЛУЧШЕННЫЙ ЗАПРОС С БОЛЬШЕЙ ИНФОРМАЦИЕЙ
-            result = await s.execute(
-                text("""
-                    SELECT is_active, config 
-                    FROM giveaway_mechanics 
-                    WHERE giveaway_id = :gid AND mechanic_type = :type
-                """),
-                {"gid": giveaway_id, "type": mechanic_type}
+async def _load_giveaway_mechanics(giveaway_id: int) -> list:
+    """Читает механики розыгрыша из БД (без кэша)."""
+    async with session_scope() as s:
+        # 🔥 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: правильный SQL запрос
+        result = await s.execute(
+            text("""
+                SELECT 
+                    id,
+                    mechanic_type, 
+                    is_active, 
+                    config,
+                    created_at
+                FROM giveaway_mechanics 
+                WHERE giveaway_id = :gid
+                ORDER BY created_at DESC
+            """),
+            {"gid": giveaway_id}
+        )
+        rows = result.fetchall()
+        
+        mechanics_list = []
+        for row in rows:
+            try:
+                # 🔥 ИСПРАВЛЕНИЕ: правильно получаем значения из row
+                mechanic_id = row[0]
+                mechanic_type = row[1]
+                is_active = bool(row[2])
+                config_str = row[3] if row[3] else '{}'
+                
+                # 🔥 ПРАВИЛЬНО ПАРСИМ JSON
+                config_dict = {}
+                if config_str and config_str != '{}':
+                    try:
+                        config_dict = json.loads(config_str)
+                    except json.JSONDecodeError:
+                        config_dict = {}
+                
+                mechanics_list.append({
+                    "id": mechanic_id,
+                    "type": mechanic_type,
+                    "is_active": is_active,
+                    "config": config_dict,
+                    "created_at": row[4].isoformat() if hasattr(row[4], 'isoformat') else str(row[4]),
+                    "has_config": bool(config_dict)
+                })
+                
+                mechanics_logger.debug(f"📝 Механика прочитана: type={mechanic_type}, active={is_active}, config_len={len(config_str)}")
+                
+            except Exception as row_error:
+                mechanics_logger.error(f"❌ Ошибка обработки строки механики: {row_error}, row={row}")
+                continue
+        
+        mechanics_logger.info(f"📊 Получено {len(mechanics_list)} механик для розыгрыша {giveaway_id}")
+        return mechanics_list
+
+# --- Очищает кэш механик (Если передан giveaway_id - очищает только для этого розыгрыша) ---
+async def clear_mechanics_cache(giveaway_id: int = None):
+    global _mechanics_generation
+
+    # загрузки, начатые до инвалидации, не должны вернуть старые данные в кэш
+    _mechanics_generation += 1
+    if giveaway_id:
+        # список механик и все флаги active_{gid}_{type} этого розыгрыша
+        active_prefix = f"active_{giveaway_id}_"
+        belongs = lambda k: k == f"mechanics_{giveaway_id}" or k.startswith(active_prefix)
+        removed = _mechanics_cache.invalidate_where(belongs)
+        for k in [k for k in _mechanics_inflight if belongs(k)]:
+            del _mechanics_inflight[k]
+        if removed:
+            mechanics_logger.info(f"🧹 Очищен кэш механик для розыгрыша {giveaway_id} ({removed} записей)")
+    else:
+        _mechanics_cache.clear()
+        _mechanics_inflight.clear()
+        mechanics_logger.info("🧹 Очищен весь кэш механик")
+
+
+# --- Проверяет, активна ли конкретная механика для розыгрыша с кэшированием ---
+async def is_mechanic_active(giveaway_id: int, mechanic_type: str, use_cache: bool = True) -> bool:
+
+    cache_key = f"active_{giveaway_id}_{mechanic_type}"
+    
+    # ПРОВЕРКА КЭША
+    if use_cache:
+        cached_result = _mechanics_cache.get(cache_key)
+        if cached_result is not None:
+            mechanics_logger.debug(f"🔄 Используем кэшированный статус активности для {mechanic_type} розыгрыша {giveaway_id}")
+            return cached_result
+    
+    try:
+        if use_cache:
+            return await _mechanics_single_flight(
+                cache_key, lambda: _load_mechanic_active(giveaway_id, mechanic_type)
             )
-            row = result.first()
-            
-            is_active = bool(row and row[0])
-            
-            # ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ДЛЯ ЛОГИРОВАНИЯ
-            if row:
-                config = row[1] if len(row) > 1 else None
-                mechanics_logger.debug(f"🔍 Проверка активности: giveaway_id={giveaway_id}, "
-                            f"type={mechanic_type}, active={is_active}, "
-                            f"config_present={bool(config)}")
-            else:
-                mechanics_logger.debug(f"🔍 Механика {mechanic_type} не найдена для розыгрыша {giveaway_id}")
-            
-            # 🔄 ОБНОВЛЕНИЕ КЭША
-            if use_cache:
-                async with _cache_lock:
-                    _mechanics_cache[cache_key] = (is_active, current_time)
-            
-            return is_active
+        return await _load_mechanic_active(giveaway_id, mechanic_type)
             
     except Exception as e:
         mechanics_logger.error(f"❌ Ошибка проверки активности механики {mechanic_type} для розыгрыша {giveaway_id}: {e}")
         
         # ПРИ ОШИБКЕ ПРОБУЕМ ВЕРНУТЬ КЭШИРОВАННЫЙ РЕЗУЛЬТАТ
-        if use_cache and cache_key in _mechanics_cache:
+        stale = _mechanics_cache.get_stale(cache_key) if use_cache else None
+        if stale is not None:
             mechanics_logger.warning(f"⚠️ Используем устаревший кэш статуса из-за ошибки БД")
-            cached_result, _ = _mechanics_cache[cache_key]
-            return cached_result
+            return stale
         
         return False
 
 
+async def _load_mechanic_active(giveaway_id: int, mechanic_type: str) -> bool:
+    """Читает флаг активности механики из БД (без кэша)."""
+    async with session_scope() as s:
+        # УЛУЧШЕННЫЙ ЗАПРОС С БОЛЬШЕЙ ИНФОРМАЦИЕЙ
+        result = await s.execute(
+            text("""
+                SELECT is_active, config 
+                FROM giveaway_mechanics 
+                WHERE giveaway_id = :gid AND mechanic_type = :type
+            """),
+            {"gid": giveaway_id, "type": mechanic_type}
+        )
+        row = result.first()
+        
+        is_active = bool(row and row[0])
+        
+        # ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ДЛЯ ЛОГИРОВАНИЯ
+        if row:
+            config = row[1] if len(row) > 1 else None
+            mechanics_logger.debug(f"🔍 Проверка активности: giveaway_id={giveaway_id}, "
+                        f"type={mechanic_type}, active={is_active}, "
+                        f"config_present={bool(config)}")
+        else:
+            mechanics_logger.debug(f"🔍 Механика {mechanic_type} не найдена для розыгрыша {giveaway_id}")
+        
+        return is_active
+
+
 # ============================================================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С CLOUDFLARE TURNSTILE CAPTCHA
 # ============================================================================
@@ -2166,16 +2990,15 @@ async def process_simple_captcha_participation(user_id: int, giveaway_id: int, c
             return {"ok": False, "message": captcha_result["message"], "ticket_code": None, "already_participating": False}
         
         # 2. Проверяем активность розыгрыша
-        async with session_scope() as s:
-            gw = await s.get(Giveaway, giveaway_id)
-            if gw.status != GiveawayStatus.ACTIVE:
-                return {"ok": False, "message": "Розыгрыш не активен.", "ticket_code": None, "already_participating": False}
+        snap = await get_giveaway_snapshot(giveaway_id)
+        if not snap or snap.gw.status != GiveawayStatus.ACTIVE:
+            return {"ok": False, "message": "Розыгрыш не активен.", "ticket_code": None, "already_participating": False}
         
         logging.info(f"[DB][captcha] DATABASE_URL env = {os.getenv('DATABASE_URL')}")
         logging.info(f"[DB][captcha] DB_PATH env = {os.getenv('DB_PATH')}")
 
         # 2.5 Проверяем подписки ДО выдачи билета (как в обычном user_join)
-        ok, details = await check_membership_on_all(bot, user_id, giveaway_id)
+        ok, _ = await check_membership_on_all(bot, user_id, giveaway_id, detailed=False)
         if not ok:
             logging.info(f"🚫 [SIMPLE-CAPTCHA] Membership not ok for user={user_id}, giveaway={giveaway_id}")
             return {
@@ -2186,98 +3009,30 @@ async def process_simple_captcha_participation(user_id: int, giveaway_id: int, c
                 "need_subscription_required": True
             }
 
-        # 3. Выдаем билет
-        async with session_scope() as s:
-
-            try:
-                bind = s.get_bind()
-                logging.info(f"[DB][captcha] SQLAlchemy bind = {bind}")
-            except Exception as e:
-                logging.error(f"[DB][captcha] Cannot get bind: {e}")
-
-            # Проверяем, участвует ли уже пользователь
-            res = await s.execute(
-                text("SELECT ticket_code FROM entries WHERE giveaway_id=:gid AND user_id=:u"),
-                {"gid": giveaway_id, "u": user_id}
-            )
-            row = res.first()
-            
-            if row:
-                # Уже участвует - возвращаем существующий билет
-                return {
-                    "ok": True, 
-                    "message": "Вы уже участвуете в этом розыгрыше!", 
-                    "ticket_code": row[0],
-                    "already_participating": True
-                }
-            else:
-                # Выдаем новый билет
-                for attempt in range(5):
-                    code = gen_ticket_code()
-                    try:
-                        # source_channel
-                        src_res = await s.execute(
-                            text("SELECT chat_id FROM giveaway_channels WHERE giveaway_id=:gid ORDER BY id LIMIT 1"),
-                            {"gid": giveaway_id}
-                        )
-                        src_row = src_res.first()
-                        source_channel_id = src_row[0] if src_row else None
+        # 3. Выдаем билет. Подписка на все каналы только что подтверждена,
+        #    поэтому was_subscribed=true без отдельного get_chat_member на канал.
+        code, is_new = await issue_ticket(giveaway_id, user_id, was_subscribed=True)
+        if code is None:
+            return {"ok": False, "message": "Ошибка при выдаче билета. Попробуйте еще раз.", "ticket_code": None, "already_participating": False}
 
-                        await s.execute(
-                            text("""
-                                INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at, source_channel_id)
-                                VALUES (:gid, :u, :code, :prelim_ok, :ts, :src)
-                            """),
-                            {
-                                "gid": giveaway_id, "u": user_id, "code": code,
-                                "prelim_ok": True, "ts": datetime.utcnow(), "src": source_channel_id
-                            }
-                        )
+        if not is_new:
+            # Уже участвует - возвращаем существующий билет
+            return {
+                "ok": True,
+                "message": "Вы уже участвуете в этом розыгрыше!",
+                "ticket_code": code,
+                "already_participating": True
+            }
 
-                        # entry_subscriptions
-                        try:
-                            ch_res = await s.execute(
-                                text("SELECT chat_id FROM giveaway_channels WHERE giveaway_id=:gid"),
-                                {"gid": giveaway_id}
-                            )
-                            for (ch_id,) in ch_res.fetchall():
-                                try:
-                                    member = await bot.get_chat_member(ch_id, user_id)
-                                    already_was = member.status not in ("left", "kicked", "banned")
-                                except Exception:
-                                    already_was = True
-                                await s.execute(
-                                    text("""
-                                        INSERT INTO entry_subscriptions(giveaway_id, user_id, channel_id, was_subscribed)
-                                        VALUES (:gid, :uid, :chid, :was)
-                                        ON CONFLICT(giveaway_id, user_id, channel_id) DO NOTHING
-                                    """),
-                                    {"gid": giveaway_id, "uid": user_id, "chid": ch_id, "was": already_was}
-                                )
-                        except Exception as _e:
-                            logging.warning(f"[captcha] entry_subscriptions failed: {_e}")
-
-                        await s.commit()
-                        # Проверяем порог для публикации в PRIME
-                        asyncio.create_task(_check_and_publish_prime(giveaway_id))
-
-                        return {
-                            "ok": True,
-                            "message": "✅ Вы успешно участвуете в розыгрыше!",
-                            "ticket_code": code,
-                            "already_participating": False
-                        }
+        # Проверяем порог для публикации в PRIME
+        asyncio.create_task(_check_and_publish_prime(giveaway_id))
+        return {
+            "ok": True,
+            "message": "✅ Вы успешно участвуете в розыгрыше!",
+            "ticket_code": code,
+            "already_participating": False
+        }
 
-                    except Exception as e:
-                        logging.error(
-                            f"❌ Ticket insert failed (captcha) gid={giveaway_id} uid={user_id} attempt={attempt+1} code={code}: {e}",
-                            exc_info=True
-                        )
-                        await s.rollback()
-                        continue
-                    
-                return {"ok": False, "message": "Ошибка при выдаче билета. Попробуйте еще раз.", "ticket_code": None, "already_participating": False}
-                
     except Exception as e:
         logging.error(f"Ошибка в process_simple_captcha_participation: {e}")
         return {"ok": False, "message": "Внутренняя ошибка сервера.", "ticket_code": None, "already_participating": False}
@@ -2518,47 +3273,260 @@ async def is_user_admin_of_chat(bot: Bot, chat_id: int, user_id: int) -> bool:
     except Exception:
         return False
 
-async def check_membership_on_all(bot, user_id:int, giveaway_id:int, channels:list=None):
+async def check_membership_on_all(bot, user_id:int, giveaway_id:int, channels:list=None,
+                                  detailed: bool = True):
+    """
+    Проверяет подписку на все каналы розыгрыша параллельно (задержка = самый медленный канал,
+    а не сумма). detailed=True — (all_ok, [(title (status=..), ok), ...]) для экрана проверки;
+    detailed=False — (all_ok, []): ответ приходит на первом же канале без подписки,
+    остальные проверки отменяются.
+    """
     # channels передаём снаружи чтобы не делать N запросов к БД
     if channels is None:
+        snap = await get_giveaway_snapshot(giveaway_id)
+        channels = snap.channel_pairs() if snap else []
+
+    if detailed:
+        results = await asyncio.gather(
+            *(get_membership(bot, chat_id, user_id) for _, chat_id in channels)
+        )
+        details = [(f"{title} (status={status})", ok)
+                   for (title, _), (ok, status) in zip(channels, results)]
+        return all(ok for _, ok in details), details
+
+    if len(channels) == 1:
+        ok, _ = await get_membership(bot, channels[0][1], user_id)
+        return ok, []
+    tasks = [asyncio.create_task(get_membership(bot, chat_id, user_id)) for _, chat_id in channels]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            ok, _ = await fut
+            if not ok:
+                return False, []
+        return True, []
+    finally:
+        for t in tasks:
+            t.cancel()
+
+# ============================================================================
+# ПАКЕТНАЯ ПРОВЕРКА ПОДПИСОК ДЛЯ ФИНАЛИЗАЦИИ
+# ============================================================================
+
+# Параллелизм запросов get_chat_member при финальной проверке
+MEMBERSHIP_CHECK_CONCURRENCY = int(os.getenv("MEMBERSHIP_CHECK_CONCURRENCY", "50"))
+# Бюджет запросов к одному чату (запросов в секунду); 0 — без лимита: скорость
+# ограничивает MEMBERSHIP_CHECK_CONCURRENCY, а flood-wait ставит чат на паузу
+MEMBERSHIP_CHECK_CHAT_RPS = float(os.getenv("MEMBERSHIP_CHECK_CHAT_RPS", "0"))
+# Сколько секунд финальная проверка может ждать Telegram (flood-wait, сетевые сбои)
+FINAL_CHECK_DEADLINE = float(os.getenv("FINAL_CHECK_DEADLINE", "600"))
+# Что делать с участником, подписку которого так и не удалось проверить до дедлайна:
+#   keep — оставить (он уже прошёл предварительную проверку prelim_ok),
+#   drop — исключить из розыгрыша
+FINAL_CHECK_UNKNOWN_POLICY = os.getenv("FINAL_CHECK_UNKNOWN_POLICY", "keep").strip().lower()
+if FINAL_CHECK_UNKNOWN_POLICY not in ("keep", "drop"):
+    logging.warning(f"[BULK_CHK] unknown FINAL_CHECK_UNKNOWN_POLICY={FINAL_CHECK_UNKNOWN_POLICY!r}, using 'keep'")
+    FINAL_CHECK_UNKNOWN_POLICY = "keep"
+
+
+class TokenBucket:
+    """
+    Простой асинхронный token bucket.
+    rate — сколько токенов пополняется в секунду (<= 0 — без ограничения),
+    capacity — размер «всплеска».
+    pause(seconds) — принудительная пауза (например, после flood-wait от Telegram).
+    """
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.unlimited = float(rate) <= 0
+        self.rate = max(float(rate), 0.001)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1.0))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + float(seconds))
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.unlimited:
+                    return
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+# Бакеты по chat_id живут весь процесс — общий бюджет для всех финализаций
+_chat_check_buckets: dict[int, TokenBucket] = {}
+
+def _chat_check_bucket(chat_id: int) -> TokenBucket:
+    bucket = _chat_check_buckets.get(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(MEMBERSHIP_CHECK_CHAT_RPS)
+        _chat_check_buckets[chat_id] = bucket
+    return bucket
+
+
+def _member_status_ok(m) -> bool:
+    status = (m.status or "").lower()
+    return (
+        status in {"member", "administrator", "creator"} or
+        (status == "restricted" and getattr(m, "is_member", False))
+    )
+
+
+# Ответы Telegram, означающие «пользователя в чате нет» — это окончательное «нет»
+_NOT_A_MEMBER_ERRORS = ("user not found", "member not found", "participant_id_invalid", "user_not_participant")
+
+
+async def _get_chat_member_budgeted(bot, chat_id: int, user_id: int, deadline: float) -> bool | None:
+    """
+    get_chat_member с учётом бюджета чата и flood-wait (RetryAfter).
+    Три исхода: True — подписан, False — Telegram ответил, что не подписан,
+    None — проверить не удалось до deadline (time.monotonic()): flood-wait,
+    сеть, бот потерял доступ к чату. Решение по None принимает вызывающий код.
+    """
+    bucket = _chat_check_bucket(chat_id)
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            await asyncio.wait_for(bucket.acquire(), timeout=remaining)
+        except asyncio.TimeoutError:
+            return None
+        attempt += 1
+        try:
+            with api_own_retry_scope():
+                m = await bot.get_chat_member(chat_id, user_id)
+            return _member_status_ok(m)
+        except TelegramRetryAfter as e:
+            logging.warning(f"[BULK_CHK] flood-wait chat={chat_id}: {e.retry_after}s (attempt {attempt})")
+            if time.monotonic() + e.retry_after >= deadline:
+                return None
+            bucket.pause(e.retry_after)
+        except TelegramBadRequest as e:
+            if any(marker in str(e).lower() for marker in _NOT_A_MEMBER_ERRORS):
+                return False
+            logging.warning(f"[BULK_CHK] chat={chat_id} user={user_id} bad request: {e}")
+            return None  # чат недоступен боту — о подписке пользователя это ничего не говорит
+        except TelegramForbiddenError as e:
+            logging.warning(f"[BULK_CHK] chat={chat_id} user={user_id} forbidden: {e}")
+            return None
+        except Exception as e:
+            # сеть / 5xx — повторяем с растущей паузой, пока есть время
+            delay = min(2 ** min(attempt, 4), 15)
+            logging.warning(f"[BULK_CHK] chat={chat_id} user={user_id} err={e}, retry in {delay}s")
+            if time.monotonic() + delay >= deadline:
+                return None
+            await asyncio.sleep(delay)
+
+
+async def verify_membership_bulk(bot, giveaway_id: int, user_ids: list[int], channels: list) -> set[int]:
+    """
+    Пакетная финальная проверка подписок для всего розыгрыша.
+      1) одним запросом берём из channel_memberships все известные пары (user, chat)
+         для участников розыгрыша (entries JOIN giveaway_channels);
+      2) к Telegram API идём только за неизвестными парами — с ограничением
+         параллелизма и бюджетом запросов на каждый чат.
+    Возвращает множество user_id, подписанных на все каналы. Участники, которых
+    не удалось проверить до FINAL_CHECK_DEADLINE, включаются или исключаются
+    по FINAL_CHECK_UNKNOWN_POLICY.
+    """
+    user_ids = [int(u) for u in user_ids]
+    chat_ids = [int(chat_id) for _, chat_id in channels]
+    if not user_ids:
+        return set()
+    if not chat_ids:
+        return set(user_ids)
+
+    # 1) Локально известные подписки и выходы — один set-based запрос
+    known: set[tuple[int, int]] = set()
+    left_users: set[int] = set()
+    try:
         async with session_scope() as s:
             res = await s.execute(
-                text("SELECT title, chat_id FROM giveaway_channels WHERE giveaway_id = :gid"),
-                {"gid": giveaway_id}
+                text("""
+                    SELECT e.user_id, gc.chat_id, cm.left_at IS NULL AS is_member
+                    FROM entries e
+                    JOIN giveaway_channels gc ON gc.giveaway_id = e.giveaway_id
+                    JOIN channel_memberships cm ON cm.chat_id = gc.chat_id AND cm.user_id = e.user_id
+                    WHERE e.giveaway_id = :gid
+                      AND e.user_id = ANY(CAST(:uids AS BIGINT[]))
+                """),
+                {"gid": giveaway_id, "uids": user_ids}
             )
-            channels = res.all()
-    details = []; all_ok = True
-    for title, chat_id in channels:
-        ok = await is_member_local(int(chat_id), int(user_id))
-        status = "local" if ok else "unknown"
-        if not ok:
-            try:
-                m = await bot.get_chat_member(chat_id, user_id)
-                status = (m.status or "").lower()
-                ok = (
-                    status in {"member", "administrator", "creator"} or
-                    (status == "restricted" and getattr(m, "is_member", False))
-                )
-            except Exception as e:
-                logging.warning(f"[CHK] chat={chat_id} user={user_id} err={e}")
-        details.append((f"{title} (status={status})", ok))
-        all_ok = all_ok and ok
-    return all_ok, details
-
-def commit_hash(secret:str, gid:int)->str:
-    return hashlib.sha256((secret+str(gid)).encode()).hexdigest()
-
-def deterministic_draw(secret:str, gid:int, user_ids:list[int], k:int):
-    h = hashlib.sha256((secret+str(gid)).encode()).digest()
-    pool = list(sorted(user_ids))
-    winners=[]; rank=1
-    while pool and len(winners)<k:
-        idx = int.from_bytes(h,"big") % len(pool)
-        uid = pool.pop(idx)
-        winners.append((uid, rank, hashlib.sha256(h).hexdigest()))
-        h = hashlib.sha256(h).digest()
-        rank+=1
-    return winners
+            for u, c, is_member in res.all():
+                if is_member:
+                    known.add((int(u), int(c)))
+                else:
+                    left_users.add(int(u))   # известный выход — без обращения к API
+    except Exception as e:
+        logging.warning(f"[BULK_CHK] gid={giveaway_id} local lookup failed, fallback to API: {e}")
+
+    # 2) Для каждого пользователя — список каналов, которых нет в локальной базе
+    pending: dict[int, list[int]] = {}
+    eligible: set[int] = set()
+    for uid in user_ids:
+        if uid in left_users:
+            continue
+        unknown = [c for c in chat_ids if (uid, c) not in known]
+        if unknown:
+            pending[uid] = unknown
+        else:
+            eligible.add(uid)
+
+    api_calls = 0
+    unresolved: set[int] = set()
+    semaphore = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+    started = time.monotonic()
+    deadline = started + FINAL_CHECK_DEADLINE
+
+    async def check_user(uid: int, unknown: list[int]) -> None:
+        nonlocal api_calls
+        async with semaphore:
+            undecided = False
+            for chat_id in unknown:
+                api_calls += 1
+                ok = await _get_chat_member_budgeted(bot, chat_id, uid, deadline)
+                if ok is False:
+                    return  # достаточно одного канала без подписки
+                if ok is None:
+                    undecided = True  # остальные каналы всё равно проверяем: там может быть «нет»
+            if undecided:
+                unresolved.add(uid)
+            else:
+                eligible.add(uid)
+
+    with api_priority_scope(API_PRIORITY_BACKGROUND):
+        await asyncio.gather(*[check_user(uid, unknown) for uid, unknown in pending.items()])
+
+    if unresolved:
+        logging.warning(
+            f"[BULK_CHK] gid={giveaway_id} unresolved={len(unresolved)} after {FINAL_CHECK_DEADLINE:.0f}s, "
+            f"policy={FINAL_CHECK_UNKNOWN_POLICY}"
+        )
+        if FINAL_CHECK_UNKNOWN_POLICY == "keep":
+            eligible |= unresolved
+
+    logging.info(
+        f"[BULK_CHK] gid={giveaway_id} users={len(user_ids)} channels={len(chat_ids)} "
+        f"local_pairs={len(known)} local_left={len(left_users)} api_users={len(pending)} api_calls={api_calls} "
+        f"unresolved={len(unresolved)} eligible={len(eligible)} took={time.monotonic() - started:.2f}s"
+    )
+    return eligible
+
+# commit_hash / deterministic_draw / deterministic_draw_async — см. draw_engine.py
 
 #--- Клавиатура для предпросмотра С медиа ---
 def kb_media_preview_with_memory(media_on_top: bool, giveaway_id: int = None) -> InlineKeyboardMarkup:
@@ -2751,8 +3719,247 @@ class EditFlow(StatesGroup):
     EDIT_WINNERS = State()         # Редактирование кол-ва победителей
     CONFIRM_EDIT = State()         # Подтверждение изменений
 
+# ============================================================================
+# БЮДЖЕТ ЗАПРОСОВ К TELEGRAM API (middleware сессии бота)
+# ============================================================================
+# Каждый вызов Bot API проходит через ApiBudgetMiddleware:
+#   - отправка/редактирование сообщений — общий бюджет на бот + бюджет на чат;
+#     чтения (get_chat_member и т.п.) бюджетом не ограничиваются, их сдерживает
+#     вызывающий код и retry_after от Telegram;
+#   - очередь по приоритету: хендлеры пользователей раньше фоновых задач;
+#   - retry_after от Telegram ставит на паузу нужный бюджет и повторяет запрос,
+#     если вызывающий код не обрабатывает его сам (api_own_retry_scope());
+#   - метрики по методам: число вызовов, ошибки, гистограмма задержек.
+# Фоновые задачи помечают себя через api_priority_scope(API_PRIORITY_BACKGROUND).
+
+API_GLOBAL_RPS = float(os.getenv("API_GLOBAL_RPS", "40"))        # отправка/редактирование на весь бот
+API_CHAT_SEND_RPS = float(os.getenv("API_CHAT_SEND_RPS", "1"))   # отправка/редактирование в один чат
+API_RETRY_AFTER_MAX = float(os.getenv("API_RETRY_AFTER_MAX", "30"))  # дольше — отдаём ошибку вызывающему
+API_MAX_RETRIES = 2
+
+API_PRIORITY_INTERACTIVE = 0
+API_PRIORITY_BACKGROUND = 10
+
+api_priority: ContextVar[int] = ContextVar("api_priority", default=API_PRIORITY_INTERACTIVE)
+# True — вызывающий код сам ждёт retry_after (свой бакет, свои повторы), middleware не повторяет
+api_own_retry: ContextVar[bool] = ContextVar("api_own_retry", default=False)
+
+_CHAT_SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendAnimation", "sendDocument", "sendMediaGroup",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption",
+    "editMessageMedia", "editMessageReplyMarkup",
+}
+_LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000)
+
+
+@contextmanager
+def api_priority_scope(priority: int):
+    """Задаёт приоритет API-вызовов для текущей задачи (и задач, созданных внутри)."""
+    token = api_priority.set(priority)
+    try:
+        yield
+    finally:
+        api_priority.reset(token)
+
+
+@contextmanager
+def api_own_retry_scope():
+    """TelegramRetryAfter пробрасывается вызывающему сразу, без повторов в middleware."""
+    token = api_own_retry.set(True)
+    try:
+        yield
+    finally:
+        api_own_retry.reset(token)
+
+
+class PriorityTokenBucket:
+    """
+    Token bucket, который при нехватке токенов отдаёт их ожидающим в порядке
+    (priority, очередь): фоновые вызовы не задерживают интерактивные.
+    """
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(float(rate), 0.001)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1.0))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list = []          # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self._pump_task: asyncio.Task | None = None
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + float(seconds))
+        self._tokens = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = API_PRIORITY_INTERACTIVE) -> None:
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until:
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():          # ожидающий отменён
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+
+
+class ApiMetrics:
+    """Счётчики по методам Bot API: вызовы, ошибки по типам, гистограмма задержек."""
+
+    def __init__(self):
+        self._methods: dict[str, dict] = {}
+
+    def _slot(self, method: str) -> dict:
+        slot = self._methods.get(method)
+        if slot is None:
+            slot = self._methods[method] = {
+                "calls": 0, "errors": {}, "retry_after": 0,
+                "latency_sum_ms": 0.0, "latency_buckets": [0] * (len(_LATENCY_BUCKETS_MS) + 1),
+            }
+        return slot
+
+    def observe(self, method: str, elapsed_ms: float, error: Exception | None = None) -> None:
+        slot = self._slot(method)
+        slot["calls"] += 1
+        slot["latency_sum_ms"] += elapsed_ms
+        i = 0
+        while i < len(_LATENCY_BUCKETS_MS) and elapsed_ms > _LATENCY_BUCKETS_MS[i]:
+            i += 1
+        slot["latency_buckets"][i] += 1
+        if error is not None:
+            name = type(error).__name__
+            slot["errors"][name] = slot["errors"].get(name, 0) + 1
+            if isinstance(error, TelegramRetryAfter):
+                slot["retry_after"] += 1
+
+    def snapshot(self) -> dict:
+        labels = [f"le_{b}" for b in _LATENCY_BUCKETS_MS] + ["inf"]
+        return {
+            method: {
+                "calls": m["calls"],
+                "errors": dict(m["errors"]),
+                "retry_after": m["retry_after"],
+                "avg_ms": round(m["latency_sum_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+                "latency_ms": dict(zip(labels, m["latency_buckets"])),
+            }
+            for method, m in sorted(self._methods.items())
+        }
+
+
+class ApiBudgetMiddleware(BaseRequestMiddleware):
+    def __init__(self):
+        self.global_bucket = PriorityTokenBucket(API_GLOBAL_RPS)
+        self._chat_buckets = TTLCache(maxsize=50000, ttl=600)
+        self.metrics = ApiMetrics()
+
+    def _chat_bucket(self, chat_id) -> PriorityTokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = PriorityTokenBucket(API_CHAT_SEND_RPS, capacity=3)
+        # продлеваем TTL при каждом обращении, иначе активный чат потеряет свою паузу
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        chat_id = getattr(method, "chat_id", None)
+        send = name in _CHAT_SEND_METHODS
+        chat_bucket = self._chat_bucket(chat_id) if send and chat_id is not None else None
+        priority = api_priority.get()
+        own_retry = api_own_retry.get()
+
+        for attempt in range(API_MAX_RETRIES + 1):
+            if send:
+                if chat_bucket is not None:
+                    await chat_bucket.acquire(priority)
+                await self.global_bucket.acquire(priority)
+            started = time.monotonic()
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.metrics.observe(name, (time.monotonic() - started) * 1000, e)
+                if send:
+                    (chat_bucket or self.global_bucket).pause(e.retry_after)
+                logging.warning(f"[API] {name} chat={chat_id}: retry_after={e.retry_after}s (attempt {attempt + 1})")
+                if own_retry or attempt >= API_MAX_RETRIES or e.retry_after > API_RETRY_AFTER_MAX:
+                    raise
+                if not send:
+                    await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                self.metrics.observe(name, (time.monotonic() - started) * 1000, e)
+                raise
+            self.metrics.observe(name, (time.monotonic() - started) * 1000)
+            return result
+
+
+api_budget = ApiBudgetMiddleware()
+
 # ----------------- BOT -----------------
 bot = Bot(BOT_TOKEN, parse_mode="HTML")
+bot.session.middleware(api_budget)
+
+
+class BotIdentity:
+    """
+    Кто мы (id, username) — единственное место, где вызывается bot.get_me().
+    Заполняется при старте, дальше обновляется в фоне; остальной код берёт
+    значение из памяти через await bot_identity.get().
+    """
+    REFRESH_INTERVAL = 3600  # username бота меняется крайне редко
+
+    def __init__(self):
+        self.me: types.User | None = None
+        self.fetched_at: float = 0.0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> types.User:
+        global BOT_USERNAME
+        me = await bot.get_me()
+        self.me = me
+        self.fetched_at = time.monotonic()
+        BOT_USERNAME = me.username
+        return me
+
+    async def get(self) -> types.User:
+        if self.me is None:
+            async with self._lock:
+                if self.me is None:
+                    await self.refresh()
+        return self.me
+
+    async def run_refresher(self) -> None:
+        while True:
+            await asyncio.sleep(self.REFRESH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"[IDENTITY] get_me refresh failed, keeping @{BOT_USERNAME}: {e}")
+
+
+bot_identity = BotIdentity()
 dp = Dispatcher()
 scheduler = AsyncIOScheduler()
 
@@ -2930,7 +4137,7 @@ async def on_chat_shared(m: Message, state: FSMContext):
     try:
         # Получаем информацию о чате
         chat = await bot.get_chat(chat_id)
-        me = await bot.get_me()
+        me = await bot_identity.get()
         
         # Проверяем права бота в чате
         try:
@@ -3711,7 +4918,7 @@ async def dbg_scan(m: types.Message):
         """))
         rows = res.all()
 
-    me = await bot.get_me()
+    me = await bot_identity.get()
     lines = [f"Всего в БД по chat_id: {len(rows)}"]
     for row_id, chat_id, title in rows:
         try:
@@ -3945,7 +5152,7 @@ async def cb_admin_promo_approve(cb: CallbackQuery):
                 WHERE id = :pid
             """), {"now": now_utc, "pid": promo_id})
             await s.commit()
-            await _publish_giveaway_to_bot(row.giveaway_id)
+            await _publish_giveaway_to_bot(row.giveaway_id, f"promo:{promo_id}")
 
             # Уведомляем создателя розыгрыша
             try:
@@ -4121,7 +5328,7 @@ async def cb_admin_promo_pub_now(cb: CallbackQuery):
         """), {"now": datetime.now(timezone.utc), "pid": promo_id})
         await s.commit()
 
-    await _publish_giveaway_to_bot(row.giveaway_id)
+    await _publish_giveaway_to_bot(row.giveaway_id, f"promo:{promo_id}")
     await cb.message.edit_text(
         f"✅ Розыгрыш <b>#{row.giveaway_id}</b> опубликован в боте!",
         parse_mode="HTML",
@@ -4337,8 +5544,11 @@ async def cb_admin_promo_manual_pub(cb: CallbackQuery):
 
 
 # ── Вспомогательная функция публикации розыгрыша в бот ───────────────────
-async def _publish_giveaway_to_bot(giveaway_id: int):
-    """Публикует пост розыгрыша в личку всем пользователям бота."""
+async def _publish_giveaway_to_bot(giveaway_id: int, batch_key: str | None = None):
+    """
+    Публикует пост розыгрыша в личку всем пользователям бота — через outbox.
+    batch_key защищает от повторной рассылки одной и той же публикации.
+    """
     async with Session() as s:
         gw_result = await s.execute(stext("""
             SELECT g.id, g.internal_title, g.end_at_utc, g.owner_user_id,
@@ -4403,27 +5613,12 @@ async def _publish_giveaway_to_bot(giveaway_id: int):
             url=preview_url,
         )
 
-    sent = 0
-    failed = 0
-    for uid in user_ids:
-        try:
-            if lp:
-                await bot.send_message(
-                    chat_id=uid, text=full_text,
-                    parse_mode="HTML", reply_markup=markup,
-                    link_preview_options=lp
-                )
-            else:
-                await bot.send_message(
-                    chat_id=uid, text=full_text,
-                    parse_mode="HTML", reply_markup=markup
-                )
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            logging.warning(f"[PROMO_PUB] uid={uid} error: {e}")
-            failed += 1
-    logging.info(f"[PROMO_PUB] #{giveaway_id}: отправлено {sent}, ошибок {failed}")
+    options = {"link_preview_options": lp} if lp else {}
+    tpl = MessageTemplate(full_text, markup, **options)
+    messages = [tpl.render(uid) for uid in user_ids]
+    batch_key = batch_key or f"promo:{giveaway_id}:{int(time.time())}"
+    await enqueue_broadcast(batch_key, messages, priority=OUTBOX_PRIORITY_LOW)
+    logging.info(f"[PROMO_PUB] #{giveaway_id}: в очереди {len(messages)} сообщений ({batch_key})")
 
 # ── Планировщик запланированных публикаций ────────────────────────────────
 async def check_scheduled_promotions():
@@ -4449,7 +5644,7 @@ async def check_scheduled_promotions():
             await s.commit()
 
         for row in due:
-            await _publish_giveaway_to_bot(row.giveaway_id)
+            await _publish_giveaway_to_bot(row.giveaway_id, f"promo:{row.id}")
             logging.info(f"[PROMO_SCHED] Опубликован #{row.giveaway_id}")
 
     except Exception as e:
@@ -6977,6 +8172,7 @@ async def ev_confirm_delete(cq: CallbackQuery):
         # Удаляем розыгрыш и связанные данные
         await s.execute(stext("DELETE FROM giveaways WHERE id=:gid"), {"gid": gid})
         await s.execute(stext("DELETE FROM giveaway_channels WHERE giveaway_id=:gid"), {"gid": gid})
+        mark_giveaway_dirty(s, gid)
     
     # Показываем сообщение об успешном удалении
     text = f"Черновик розыгрыша <b>{title}</b> успешно удалён"
@@ -7478,6 +8674,7 @@ async def cb_attach_channel(cq: CallbackQuery):
                       "VALUES(:g, :c, :chat, :t)"),
                 {"g": event_id, "c": oc_id, "chat": chat_id, "t": title}
             )
+        mark_giveaway_dirty(s, event_id)
 
         # пересобираем данные для перерисовки
         res = await s.execute(
@@ -8496,62 +9693,16 @@ async def user_join(cq: CallbackQuery):
     user_id = cq.from_user.id
     
     # ПРОВЕРКА 1: Активен ли розыгрыш
-    async with session_scope() as s:
-        gw = await s.get(Giveaway, gid)
-        if gw.status != GiveawayStatus.ACTIVE:
-            await cq.answer("Розыгрыш не активен.", show_alert=True)
-            return
-
-    # Проверяем подписки ДО Captcha!
-    # Регистрируем пользователя при участии
-    try:
-        await ensure_bot_user(cq.from_user.id, cq.from_user.username, cq.from_user.first_name)
-        # Обновляем Telegram Premium статус и язык в таблице users
-        try:
-            async with session_scope() as _s:
-                await _s.execute(
-                    text("""
-                        INSERT INTO users(user_id, username, is_premium, language_code, first_name)
-                        VALUES (:uid, :uname, :premium, :lang, :fname)
-                        ON CONFLICT(user_id) DO UPDATE SET
-                            username      = COALESCE(EXCLUDED.username, users.username),
-                            is_premium    = EXCLUDED.is_premium,
-                            language_code = COALESCE(EXCLUDED.language_code, users.language_code),
-                            first_name    = COALESCE(EXCLUDED.first_name, users.first_name)
-                    """),
-                    {
-                        "uid":     cq.from_user.id,
-                        "uname":   cq.from_user.username,
-                        "premium": bool(getattr(cq.from_user, 'is_premium', False)),
-                        "lang":    getattr(cq.from_user, 'language_code', None),
-                        "fname":   cq.from_user.first_name,
-                    }
-                )
-                await _s.commit()
-        except Exception as _e:
-            logging.warning(f"[user_join] users upsert failed: {_e}")
-
-        # Записываем клик (уникальный на пользователя)
-        try:
-            async with session_scope() as _s:
-                await _s.execute(
-                    text("""
-                        INSERT INTO giveaway_clicks(giveaway_id, user_id, clicked_at)
-                        VALUES (:gid, :uid, NOW())
-                        ON CONFLICT(giveaway_id, user_id) DO NOTHING
-                    """),
-                    {"gid": gid, "uid": user_id}
-                )
-                await _s.commit()
-        except Exception as _e:
-            logging.warning(f"[user_join] click insert failed: {_e}")
+    snap = await get_giveaway_snapshot(gid)
+    if not snap or snap.gw.status != GiveawayStatus.ACTIVE:
+        await cq.answer("Розыгрыш не активен.", show_alert=True)
+        return
 
-        logging.info(f"✅ Пользователь {cq.from_user.id} зарегистрирован при участии в розыгрыше")
-    except Exception as e:
-        logging.error(f"❌ Ошибка регистрации при участии: {e}")
+    # Регистрируем пользователя и клик при участии — в фоне, пачкой (см. UserActivityCollector)
+    user_activity.record_join(cq.from_user, gid)
 
-    # Проверяем подписки
-    ok, details = await check_membership_on_all(bot, cq.from_user.id, gid)
+    # Проверяем подписки (нужен только итог — до первого канала без подписки)
+    ok, _ = await check_membership_on_all(bot, cq.from_user.id, gid, detailed=False)
     if not ok:
         await cq.answer("Подпишитесь на все каналы и попробуйте снова.", show_alert=True)
         return
@@ -8596,74 +9747,136 @@ async def user_join(cq: CallbackQuery):
         return
     
     # НЕТ CAPTCHA: стандартный процесс участия
-    # Выдаем билет
-    async with session_scope() as s:
-        res = await s.execute(
-            text("SELECT ticket_code FROM entries WHERE giveaway_id=:gid AND user_id=:u"),
-            {"gid": gid, "u": user_id}
-        )
-        row = res.first()
-        
-        if row:
-            code = row[0]
-            await cq.message.answer(f"✅ Вы уже участвуете в этом розыгрыше!\n\nВаш билет: <b>{code}</b>", disable_notification=False)
-        else:
-            for _ in range(5):
-                code = gen_ticket_code()
-                try:
-                    # Определяем source_channel — берём первый канал розыгрыша из которого пришёл пост
-                    src_ch_res = await s.execute(
-                        text("SELECT chat_id FROM giveaway_channels WHERE giveaway_id=:gid ORDER BY id LIMIT 1"),
-                        {"gid": gid}
-                    )
-                    src_ch_row = src_ch_res.first()
-                    source_channel_id = src_ch_row[0] if src_ch_row else None
+    # Выдаем билет. was_subscribed=false: считаем, что подписался ради розыгрыша (новый подписчик)
+    code, is_new = await issue_ticket(gid, user_id)
+    if code is None:
+        await cq.answer("Не удалось выдать билет. Попробуйте еще раз.", show_alert=True)
+        return
+    if not is_new:
+        await cq.message.answer(f"✅ Вы уже участвуете в этом розыгрыше!\n\nВаш билет: <b>{code}</b>", disable_notification=False)
+    else:
+        await cq.message.answer(f"✅ Вы успешно участвуете в розыгрыше!\n\nВаш билет: <b>{code}</b>", disable_notification=False, parse_mode="HTML")
+        # Проверяем порог для публикации в PRIME
+        asyncio.create_task(_check_and_publish_prime(gid))
+    
+    await cq.answer()
 
-                    await s.execute(
-                        text("""
-                            INSERT INTO entries(giveaway_id, user_id, ticket_code, prelim_ok, prelim_checked_at, source_channel_id)
-                            VALUES (:gid, :u, :code, :prelim_ok, :ts, :src)
-                            ON CONFLICT DO NOTHING
-                        """),
-                        {"gid": gid, "u": user_id, "code": code, "prelim_ok": True,
-                         "ts": datetime.utcnow(), "src": source_channel_id}
-                    )
 
-                    # Записываем статус подписки ПЕРЕД выдачей билета (was_subscribed = был ли подписан ДО нажатия)
-                    # Для user_join подписка уже проверена и ОК, поэтому смотрим историю через entry_subscriptions
-                    # Если записи нет — значит подписался специально ради розыгрыша (новый подписчик)
-                    try:
-                        channels_res = await s.execute(
-                            text("SELECT chat_id FROM giveaway_channels WHERE giveaway_id=:gid"),
-                            {"gid": gid}
-                        )
-                        all_channels = [r[0] for r in channels_res.fetchall()]
-                        for ch_id in all_channels:
-                            # was_subscribed = False означает: подписался ради розыгрыша (новый подписчик)
-                            # Мы не можем знать был ли подписан раньше, поэтому:
-                            # - если это первое участие → записываем was_subscribed=False (новый подписчик)
-                            # - дубликаты игнорируются через ON CONFLICT DO NOTHING
-                            await s.execute(
-                                text("""
-                                    INSERT INTO entry_subscriptions(giveaway_id, user_id, channel_id, was_subscribed)
-                                    VALUES (:gid, :uid, :chid, false)
-                                    ON CONFLICT(giveaway_id, user_id, channel_id) DO NOTHING
-                                """),
-                                {"gid": gid, "uid": user_id, "chid": ch_id}
-                            )
-                    except Exception as _e:
-                        logging.warning(f"[user_join] entry_subscriptions insert failed: {_e}")
+# --- Сохранение результатов розыгрыша (winners + final_ok) set-based запросами ---
+# Хуки замера времени фаз розыгрыша: hook(phase, giveaway_id, seconds)
+DRAW_TIMING_HOOKS: list = []
 
-                    await cq.message.answer(f"✅ Вы успешно участвуете в розыгрыше!\n\nВаш билет: <b>{code}</b>", disable_notification=False, parse_mode="HTML")
-                    # Проверяем порог для публикации в PRIME
-                    asyncio.create_task(_check_and_publish_prime(gid))
-                    break
+@asynccontextmanager
+async def draw_phase_timer(phase: str, giveaway_id: int):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        logging.info(f"[DRAW][TIMING] gid={giveaway_id} phase={phase} took={elapsed * 1000:.1f}ms")
+        for hook in DRAW_TIMING_HOOKS:
+            try:
+                hook(phase, giveaway_id, elapsed)
+            except Exception as e:
+                logging.warning(f"[DRAW][TIMING] hook {hook!r} failed: {e}")
 
-                except Exception as e:
-                    logging.error(f"❌ Ticket insert failed (gid={gid}, uid={user_id}): {e}", exc_info=True)
-                    continue
-    
-    await cq.answer()
+
+async def persist_draw_results(s, giveaway_id: int, winners_tuples: list, ts: datetime) -> None:
+    """
+    Перезаписывает победителей и final_ok за три запроса независимо от числа победителей:
+      DELETE winners → один INSERT ... SELECT FROM unnest(...) → один UPDATE entries.
+    winners_tuples — результат deterministic_draw: [(user_id, rank, hash_used), ...]
+    Коммит остаётся за вызывающим кодом.
+    """
+    uids = [int(w[0]) for w in winners_tuples]
+    ranks = [int(w[1]) for w in winners_tuples]
+    hashes = [str(w[2]) for w in winners_tuples]
+
+    async with draw_phase_timer("persist", giveaway_id):
+        await s.execute(
+            text("DELETE FROM winners WHERE giveaway_id = :gid"),
+            {"gid": giveaway_id}
+        )
+        if uids:
+            await s.execute(
+                text("""
+                    INSERT INTO winners (giveaway_id, user_id, rank, hash_used)
+                    SELECT :gid, w.uid, w.rank, w.hash_used
+                    FROM unnest(
+                        CAST(:uids AS BIGINT[]),
+                        CAST(:ranks AS INTEGER[]),
+                        CAST(:hashes AS TEXT[])
+                    ) AS w(uid, rank, hash_used)
+                """),
+                {"gid": giveaway_id, "uids": uids, "ranks": ranks, "hashes": hashes}
+            )
+        # final_ok = true только у победителей, false у всех остальных — одним UPDATE
+        await s.execute(
+            text("""
+                UPDATE entries
+                SET final_ok = (user_id = ANY(CAST(:uids AS BIGINT[]))),
+                    final_checked_at = :ts
+                WHERE giveaway_id = :gid
+            """),
+            {"gid": giveaway_id, "uids": uids, "ts": ts}
+        )
+
+
+# --- Финальная проверка участников — общий конвейер для finalize и redraw ---
+# Сколько секунд снимок финальной проверки считается свежим для перерозыгрыша
+ELIGIBILITY_SNAPSHOT_TTL = int(os.getenv("ELIGIBILITY_SNAPSHOT_TTL", "1800"))
+
+
+async def _load_draw_channels(s, giveaway_id: int) -> list:
+    res = await s.execute(
+        text("SELECT title, chat_id FROM giveaway_channels WHERE giveaway_id = :gid"),
+        {"gid": giveaway_id}
+    )
+    return res.all()
+
+
+async def save_eligibility_snapshot(s, giveaway_id: int, user_ids: list[int]) -> None:
+    """Сохраняет список прошедших проверку (коммит — за вызывающим кодом)."""
+    await s.execute(
+        text("""
+            INSERT INTO giveaway_eligibility (giveaway_id, user_ids, verified_at)
+            VALUES (:gid, CAST(:uids AS BIGINT[]), NOW())
+            ON CONFLICT (giveaway_id) DO UPDATE
+            SET user_ids = EXCLUDED.user_ids, verified_at = EXCLUDED.verified_at
+        """),
+        {"gid": giveaway_id, "uids": [int(u) for u in user_ids]}
+    )
+
+
+async def load_fresh_eligibility_snapshot(s, giveaway_id: int) -> set[int] | None:
+    """Возвращает множество user_id из снимка, если он моложе ELIGIBILITY_SNAPSHOT_TTL, иначе None."""
+    res = await s.execute(
+        text("""
+            SELECT user_ids
+            FROM giveaway_eligibility
+            WHERE giveaway_id = :gid
+              AND verified_at > NOW() - make_interval(secs => :ttl)
+        """),
+        {"gid": giveaway_id, "ttl": ELIGIBILITY_SNAPSHOT_TTL}
+    )
+    row = res.first()
+    return set(row[0]) if row else None
+
+
+async def collect_eligible_entries(s, bot, giveaway_id: int, all_entries: list) -> list[tuple[int, str]]:
+    """
+    all_entries — строки (user_id, ticket_code) с prelim_ok = true.
+    Каналы читаются один раз в сессии вызывающего кода, подписки проверяются
+    пакетно через verify_membership_bulk. Возвращает [(user_id, ticket_code)]
+    прошедших проверку в исходном порядке.
+    """
+    channels = await _load_draw_channels(s, giveaway_id)
+
+    async with draw_phase_timer("verify", giveaway_id):
+        eligible_ids = await verify_membership_bulk(
+            bot, giveaway_id, [row[0] for row in all_entries], channels
+        )
+    return [(row[0], row[1]) for row in all_entries if row[0] in eligible_ids]
 
 
 async def finalize_and_draw_job(giveaway_id: int):
@@ -8671,9 +9884,6 @@ async def finalize_and_draw_job(giveaway_id: int):
     ФИКСИРОВАННАЯ ВЕРСИЯ: убрана передача bot как параметра
     """
     print(f"🎯 FINALIZE_AND_DRAW_JOB ► старт для розыгрыша {giveaway_id}")
-
-    # Получаем бот из глобального контекста
-    from bot import bot  # Импортируем глобальный экземпляр бота
     
     async with Session() as s:
         # ---------- 1. Загружаем розыгрыш ----------
@@ -8696,6 +9906,7 @@ async def finalize_and_draw_job(giveaway_id: int):
                 FROM entries
                 WHERE giveaway_id = :gid
                   AND prelim_ok = true
+                ORDER BY user_id
             """),
             {"gid": gw.id}
         )
@@ -8707,53 +9918,16 @@ async def finalize_and_draw_job(giveaway_id: int):
         # Если вообще нет билетов — сразу фиксируем "без победителей"
         if not all_entries:
             print(f"⚠️ Для розыгрыша {gw.id} нет ни одного предварительного билета")
-            # Чистим winners на всякий случай
-            await s.execute(
-                text("DELETE FROM winners WHERE giveaway_id = :gid"),
-                {"gid": gw.id}
-            )
-            # Обновляем final_ok
-            await s.execute(
-                text("""
-                    UPDATE entries
-                    SET final_ok = false,
-                        final_checked_at = :ts
-                    WHERE giveaway_id = :gid
-                """),
-                {"gid": gw.id, "ts": now_utc}
-            )
-            gw.status = GiveawayStatus.FINISHED
-            await s.commit()
+            # Чистим winners на всякий случай и сбрасываем final_ok
+            async with draw_phase_timer("lock_window", gw.id):
+                await persist_draw_results(s, gw.id, [], now_utc)
+                gw.status = GiveawayStatus.FINISHED
+                await s.commit()
             print(f"✅ Розыгрыш {gw.id} завершён без победителей (не было участников)")
             return
 
-        # ---------- 3. Финальная проверка подписок — параллельно (concurrency=50) ----------
-        # Загружаем каналы ОДИН РАЗ для всех участников
-        async with session_scope() as s:
-            ch_res = await s.execute(
-                text("SELECT title, chat_id FROM giveaway_channels WHERE giveaway_id = :gid"),
-                {"gid": gw.id}
-            )
-            channels = ch_res.all()
-
-        CONCURRENCY = 50
-        semaphore = asyncio.Semaphore(CONCURRENCY)
-
-        async def check_one(row):
-            user_id = row[0]
-            ticket_code = row[1]
-            async with semaphore:
-                is_ok, debug_reason = await check_membership_on_all(
-                    bot, user_id, gw.id, channels=channels
-                )
-            logging.info(
-                f"   • user={user_id} ticket={ticket_code} -> "
-                f"{'OK' if is_ok else 'FAIL'} ({debug_reason})"
-            )
-            return (user_id, ticket_code) if is_ok else None
-
-        results = await asyncio.gather(*[check_one(row) for row in all_entries])
-        eligible_entries = [r for r in results if r is not None]
+        # ---------- 3. Финальная проверка подписок — пакетно (локальная база + API для неизвестных) ----------
+        eligible_entries = await collect_eligible_entries(s, bot, gw.id, all_entries)
 
         print(f"✅ Подтверждено участников после финальной проверки: {len(eligible_entries)}")
 
@@ -8761,24 +9935,11 @@ async def finalize_and_draw_job(giveaway_id: int):
         if not eligible_entries:
             print(f"⚠️ Для розыгрыша {gw.id} не осталось участников, подписанных на все каналы — победителей нет")
 
-            # Чистим winners
-            await s.execute(
-                text("DELETE FROM winners WHERE giveaway_id = :gid"),
-                {"gid": gw.id}
-            )
-            # Все final_ok = false
-            await s.execute(
-                text("""
-                    UPDATE entries
-                    SET final_ok = false,
-                        final_checked_at = :ts
-                    WHERE giveaway_id = :gid
-                """),
-                {"gid": gw.id, "ts": now_utc}
-            )
-
-            gw.status = GiveawayStatus.FINISHED
-            await s.commit()
+            # Чистим winners, все final_ok = false
+            async with draw_phase_timer("lock_window", gw.id):
+                await persist_draw_results(s, gw.id, [], now_utc)
+                gw.status = GiveawayStatus.FINISHED
+                await s.commit()
             print(f"✅ Розыгрыш {gw.id} завершён без победителей (никто не прошёл финальную проверку)")
             return
 
@@ -8787,57 +9948,15 @@ async def finalize_and_draw_job(giveaway_id: int):
         winners_to_pick = min(gw.winners_count or 1, len(user_ids))
         print(f"🎲 Определяем {winners_to_pick} победителей из {len(user_ids)} участников")
 
-        winners_tuples = deterministic_draw("giveaway_secret", gw.id, user_ids, winners_to_pick)
-
-        # ---------- 6. Перезаписываем таблицу winners ----------
-        await s.execute(
-            text("DELETE FROM winners WHERE giveaway_id = :gid"),
-            {"gid": gw.id}
-        )
-
-        for winner_tuple in winners_tuples:
-            # ✅ РАСПАКОВЫВАЕМ КОРТЕЖ: (user_id, rank, hash_used_from_draw)
-            user_id = winner_tuple[0]
-            rank = winner_tuple[1] 
-            hash_used_from_draw = winner_tuple[2]
-            
-            # Используем хэш из deterministic_draw вместо генерации нового
-            await s.execute(
-                text("""
-                    INSERT INTO winners (giveaway_id, user_id, rank, hash_used)
-                    VALUES (:gid, :uid, :rank, :hash_used)
-                """),
-                {"gid": gw.id, "uid": user_id, "rank": rank, "hash_used": hash_used_from_draw}
-            )
-            print(f"   🏅 Победитель #{rank}: user_id={user_id}")
-
-        # ---------- 7. Обновляем final_ok: false для всех, true только для победителей ----------
-        await s.execute(
-            text("""
-                UPDATE entries
-                SET final_ok = false,
-                    final_checked_at = :ts
-                WHERE giveaway_id = :gid
-            """),
-            {"gid": gw.id, "ts": now_utc}
-        )
-
-        for winner_tuple in winners_tuples:
-            user_id = winner_tuple[0]  # Извлекаем user_id из кортежа
-            await s.execute(
-                text("""
-                    UPDATE entries
-                    SET final_ok = true,
-                        final_checked_at = :ts
-                    WHERE giveaway_id = :gid
-                    AND user_id = :uid
-                """),
-                {"gid": gw.id, "uid": user_id, "ts": now_utc}
-            )
+        async with draw_phase_timer("draw", gw.id):
+            winners_tuples = await deterministic_draw_async("giveaway_secret", gw.id, user_ids, winners_to_pick)
 
-        # ---------- 8. Фиксируем статус розыгрыша и коммит ----------
-        gw.status = GiveawayStatus.FINISHED
-        await s.commit()
+        # ---------- 6-8. Перезаписываем winners, final_ok и статус — одна короткая транзакция ----------
+        async with draw_phase_timer("lock_window", gw.id):
+            await persist_draw_results(s, gw.id, winners_tuples, now_utc)
+            await save_eligibility_snapshot(s, gw.id, user_ids)
+            gw.status = GiveawayStatus.FINISHED
+            await s.commit()
 
         print(f"✅ Розыгрыш {gw.id} успешно завершён, победителей: {len(winners_tuples)}")
 
@@ -8874,9 +9993,6 @@ async def redraw_winners(giveaway_id: int):
     Адаптированная версия finalize_and_draw_job() без изменения статуса
     """
     print(f"🎲 REDRAW_WINNERS ► старт для розыгрыша {giveaway_id}")
-
-    # Получаем бот из глобального контекста
-    from bot import bot  # Импортируем глобальный экземпляр бота
     
     async with Session() as s:
         # ---------- 1. Загружаем розыгрыш ----------
@@ -8894,6 +10010,7 @@ async def redraw_winners(giveaway_id: int):
                 FROM entries
                 WHERE giveaway_id = :gid
                   AND prelim_ok = true
+                ORDER BY user_id
             """),
             {"gid": gw.id}
         )
@@ -8904,16 +10021,15 @@ async def redraw_winners(giveaway_id: int):
             print(f"⚠️ Для розыгрыша {gw.id} нет участников")
             return False
 
-        # ---------- 3. Финальная проверка подписок для КАЖДОГО участника ----------
-        eligible_entries = []  # [(user_id, ticket_code)]
-        for row in all_entries:
-            user_id = row[0]
-            ticket_code = row[1]
-            is_ok, debug_reason = await check_membership_on_all(bot, user_id, gw.id)
-            print(f"   • user={user_id} ticket={ticket_code} -> {'OK' if is_ok else 'FAIL'}")
-
-            if is_ok:
-                eligible_entries.append((user_id, ticket_code))
+        # ---------- 3. Финальная проверка подписок ----------
+        # Свежий снимок от finalize — берём пул из него и перепроверяем только победителей,
+        # иначе — полный пакетный конвейер, как в finalize
+        snapshot = await load_fresh_eligibility_snapshot(s, gw.id)
+        if snapshot is not None:
+            eligible_entries = [(row[0], row[1]) for row in all_entries if row[0] in snapshot]
+            print(f"♻️ Используем снимок проверки: {len(eligible_entries)} участников")
+        else:
+            eligible_entries = await collect_eligible_entries(s, bot, gw.id, all_entries)
 
         print(f"✅ Подтверждено участников после проверки: {len(eligible_entries)}")
 
@@ -8922,60 +10038,49 @@ async def redraw_winners(giveaway_id: int):
             return False
 
         # ---------- 4. Определяем НОВЫХ победителей ----------
-        user_ids = [u for (u, _) in eligible_entries]
-        winners_to_pick = min(gw.winners_count or 1, len(user_ids))
-        print(f"🎲 Определяем {winners_to_pick} НОВЫХ победителей из {len(user_ids)} участников")
-
-        # Используем новый секрет для перерозыгрыша
-        winners_tuples = deterministic_draw("redraw_secret_" + str(gw.id), gw.id, user_ids, winners_to_pick)
-
-        # ---------- 5. УДАЛЯЕМ старых победителей и добавляем НОВЫХ ----------
-        await s.execute(
-            text("DELETE FROM winners WHERE giveaway_id = :gid"),
-            {"gid": gw.id}
-        )
-
-        for winner_tuple in winners_tuples:
-            user_id = winner_tuple[0]
-            rank = winner_tuple[1] 
-            hash_used_from_draw = winner_tuple[2]
-            
-            await s.execute(
-                text("""
-                    INSERT INTO winners (giveaway_id, user_id, rank, hash_used)
-                    VALUES (:gid, :uid, :rank, :hash_used)
-                """),
-                {"gid": gw.id, "uid": user_id, "rank": rank, "hash_used": hash_used_from_draw}
-            )
-            print(f"   🏅 НОВЫЙ победитель #{rank}: user_id={user_id}")
+        winners_to_pick = gw.winners_count or 1
+        channels = await _load_draw_channels(s, gw.id) if snapshot is not None else []
+        pruned = False
+        while True:
+            user_ids = [u for (u, _) in eligible_entries]
+            print(f"🎲 Определяем {min(winners_to_pick, len(user_ids))} НОВЫХ победителей из {len(user_ids)} участников")
+
+            # Используем новый секрет для перерозыгрыша
+            async with draw_phase_timer("draw", gw.id):
+                winners_tuples = await deterministic_draw_async(
+                    "redraw_secret_" + str(gw.id), gw.id, user_ids, min(winners_to_pick, len(user_ids))
+                )
+            if snapshot is None:
+                break
+
+            # Пул из снимка: живьём проверяем только выбранных победителей
+            winner_ids = [w[0] for w in winners_tuples]
+            async with draw_phase_timer("verify_winners", gw.id):
+                still_ok = await verify_membership_bulk(bot, gw.id, winner_ids, channels)
+            dropped = set(winner_ids) - still_ok
+            if not dropped:
+                break
+            print(f"⚠️ {len(dropped)} победителей больше не подписаны — исключаем и тянем заново")
+            eligible_entries = [e for e in eligible_entries if e[0] not in dropped]
+            pruned = True
+            if not eligible_entries:
+                print(f"⚠️ Для розыгрыша {gw.id} не осталось участников, подписанных на все каналы")
+                return False
 
-        # ---------- 6. Обновляем final_ok: false для всех, true только для НОВЫХ победителей ----------
+        # ---------- 5-6. Заменяем победителей и final_ok на НОВЫХ — одна короткая транзакция ----------
         now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
-        
-        await s.execute(
-            text("""
-                UPDATE entries
-                SET final_ok = false,
-                    final_checked_at = :ts
-                WHERE giveaway_id = :gid
-            """),
-            {"gid": gw.id, "ts": now_utc}
-        )
 
-        for winner_tuple in winners_tuples:
-            user_id = winner_tuple[0]
-            await s.execute(
-                text("""
-                    UPDATE entries
-                    SET final_ok = true,
-                        final_checked_at = :ts
-                    WHERE giveaway_id = :gid
-                    AND user_id = :uid
-                """),
-                {"gid": gw.id, "uid": user_id, "ts": now_utc}
-            )
-
-        await s.commit()
+        async with draw_phase_timer("lock_window", gw.id):
+            await persist_draw_results(s, gw.id, winners_tuples, now_utc)
+            if snapshot is None:
+                await save_eligibility_snapshot(s, gw.id, [u for (u, _) in eligible_entries])
+            elif pruned:
+                # Убираем отписавшихся из снимка, не продлевая его свежесть
+                await s.execute(
+                    text("UPDATE giveaway_eligibility SET user_ids = CAST(:uids AS BIGINT[]) WHERE giveaway_id = :gid"),
+                    {"gid": gw.id, "uids": [u for (u, _) in eligible_entries]}
+                )
+            await s.commit()
         print(f"✅ Перерозыгрыш {gw.id} успешно выполнен, новых победителей: {len(winners_tuples)}")
 
     # ---------- 7. После коммита — обновляем посты и уведомления ----------
@@ -9005,6 +10110,304 @@ async def redraw_winners(giveaway_id: int):
     return True
 
 
+# ============================================================================
+# OUTBOX: ОБЩАЯ ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ
+# ============================================================================
+# Все массовые отправки (уведомления о розыгрышах, промо-рассылки) сначала
+# записываются в outbox_messages, а отправляет их пул воркеров внутри бота
+# с общим лимитом скорости. Статус каждого сообщения хранится в БД:
+# после перезапуска воркеры продолжают с места остановки, повторно
+# ничего не уходит (batch_key + chat_id уникальны).
+#
+# Воркеры забирают пачки через FOR UPDATE SKIP LOCKED, поэтому не мешают
+# друг другу. Временные ошибки — повтор с экспоненциальной задержкой,
+# после OUTBOX_MAX_ATTEMPTS сообщение уходит в dead (dead-letter).
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))       # сообщений в секунду на весь бот
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_CLAIM_BATCH = int(os.getenv("OUTBOX_CLAIM_BATCH", "20"))  # сообщений за один захват воркером
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_INTERVAL = 2.0                                       # сек, если очередь пуста
+OUTBOX_MAX_FLOOD_RETRIES = 5
+OUTBOX_MAX_WAIT = 60.0          # сек ожидания лимита (в т.ч. паузы flood-wait) на одну попытку
+OUTBOX_SEND_TIMEOUT = 30        # сек на сам запрос send_message
+# 'sending' считается брошенным, только когда воркер гарантированно уже закончил бы
+# с сообщением: все попытки с максимальным ожиданием + запас на запись итога
+OUTBOX_STALE_LOCK = OUTBOX_MAX_FLOOD_RETRIES * (OUTBOX_MAX_WAIT + OUTBOX_SEND_TIMEOUT) + 60
+
+# Приоритеты: меньше — раньше
+OUTBOX_PRIORITY_HIGH = 0       # личные уведомления организаторам
+OUTBOX_PRIORITY_NORMAL = 100   # уведомления участников о результатах
+OUTBOX_PRIORITY_LOW = 200      # промо-рассылки по всей базе
+
+OUTBOX_LOG_INTERVAL = float(os.getenv("OUTBOX_LOG_INTERVAL", "15"))  # сек между сводками прогресса
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE)
+_outbox_wakeup = asyncio.Event()
+_outbox_progress = {"sent": 0, "blocked": 0, "retry": 0, "dead": 0}
+_outbox_last_log = 0.0
+_outbox_workers: list[asyncio.Task] = []
+
+
+def outbox_message(chat_id: int, text_html: str, reply_markup: InlineKeyboardMarkup | None = None, **options) -> dict:
+    """Готовит строку для enqueue_broadcast. options — доп. аргументы send_message."""
+    if isinstance(options.get("link_preview_options"), LinkPreviewOptions):
+        options["link_preview_options"] = options["link_preview_options"].model_dump(exclude_none=True)
+    return {
+        "chat_id": int(chat_id),
+        "text": text_html,
+        "reply_markup": reply_markup.model_dump_json(exclude_none=True) if reply_markup else None,
+        "options": json.dumps(options),
+    }
+
+
+class MessageTemplate:
+    """
+    Сообщение рассылки, отрендеренное один раз на всю рассылку.
+
+    Текст и кнопки сериализуются при создании; per-user поля задаются в тексте
+    маркерами field("name") и подставляются склейкой заранее разрезанных кусков —
+    без повторного форматирования HTML и без str.format (в названиях розыгрышей
+    бывают фигурные скобки).
+    """
+    _MARK = "\x00"
+
+    def __init__(self, text_html: str, reply_markup: InlineKeyboardMarkup | None = None, **options):
+        base = outbox_message(0, "", reply_markup, **options)
+        self._reply_markup = base["reply_markup"]
+        self._options = base["options"]
+        # чётные элементы — литералы, нечётные — имена полей
+        self._parts = text_html.split(self._MARK)
+
+    @classmethod
+    def field(cls, name: str) -> str:
+        return f"{cls._MARK}{name}{cls._MARK}"
+
+    def render(self, chat_id: int, **fields) -> dict:
+        parts = self._parts
+        if len(parts) == 1:
+            body = parts[0]
+        else:
+            body = "".join(p if i % 2 == 0 else str(fields[p]) for i, p in enumerate(parts))
+        return {
+            "chat_id": int(chat_id),
+            "text": body,
+            "reply_markup": self._reply_markup,
+            "options": self._options,
+        }
+
+
+def results_markup(gid: int, bot_username: str) -> InlineKeyboardMarkup:
+    """Кнопка "Результаты" — та же, что и в опубликованном посте в каналах."""
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🎲 Результаты", url=f"https://t.me/{bot_username}?startapp=results_{gid}")
+    kb.adjust(1)
+    return kb.as_markup()
+
+
+def winners_digest(winners: list) -> str:
+    """Короткий отпечаток состава победителей — для batch_key перерозыгрышей."""
+    return hashlib.sha256(",".join(str(w[0]) for w in winners).encode()).hexdigest()[:16]
+
+
+async def enqueue_broadcast(batch_key: str, messages: list[dict], priority: int = OUTBOX_PRIORITY_NORMAL) -> None:
+    """Ставит сообщения в очередь; повторная постановка того же batch_key не дублирует получателей."""
+    for i in range(0, len(messages), 1000):
+        chunk = [{**m, "key": batch_key, "prio": priority} for m in messages[i:i + 1000]]
+        async with session_scope() as s:
+            await s.execute(
+                text("""
+                    INSERT INTO outbox_messages (batch_key, chat_id, text, reply_markup, options, priority)
+                    VALUES (:key, :chat_id, :text, CAST(:reply_markup AS JSONB), CAST(:options AS JSONB), :prio)
+                    ON CONFLICT (batch_key, chat_id) DO NOTHING
+                """),
+                chunk
+            )
+    _outbox_wakeup.set()
+
+
+async def _send_outbox_row(row) -> tuple[str, str | None]:
+    """
+    Отправляет одно сообщение. Возвращает (результат, ошибка):
+    sent | blocked (бот заблокирован) | dead (запрос отклонён) | retry (временная ошибка).
+    """
+    # asyncpg без кодека отдаёт JSONB строкой
+    options = row.options or {}
+    if isinstance(options, str):
+        options = json.loads(options)
+    if options.get("link_preview_options"):
+        options["link_preview_options"] = LinkPreviewOptions.model_validate(options["link_preview_options"])
+    markup = None
+    if row.reply_markup:
+        raw = row.reply_markup
+        markup = (InlineKeyboardMarkup.model_validate_json(raw) if isinstance(raw, str)
+                  else InlineKeyboardMarkup.model_validate(raw))
+
+    for _ in range(OUTBOX_MAX_FLOOD_RETRIES):
+        try:
+            await asyncio.wait_for(_broadcast_bucket.acquire(), timeout=OUTBOX_MAX_WAIT)
+        except asyncio.TimeoutError:
+            return "retry", "broadcast limit wait timeout"
+        try:
+            with api_own_retry_scope():
+                await bot.send_message(row.chat_id, row.text, parse_mode="HTML", reply_markup=markup,
+                                       request_timeout=OUTBOX_SEND_TIMEOUT, **options)
+            return "sent", None
+        except TelegramRetryAfter as e:
+            # flood-wait касается всего бота — приостанавливаем общий лимит
+            logging.warning(f"[OUTBOX] flood-wait {e.retry_after}s")
+            _broadcast_bucket.pause(e.retry_after)
+        except TelegramForbiddenError as e:
+            return "blocked", str(e)[:500]
+        except TelegramBadRequest as e:
+            # chat not found, битая разметка и т.п. — повтор не поможет
+            return "dead", str(e)[:500]
+        except Exception as e:
+            return "retry", str(e)[:500]
+    return "retry", "flood-wait retries exhausted"
+
+
+async def _outbox_claim(limit: int) -> list:
+    """Атомарно забирает пачку готовых к отправке сообщений (в том числе брошенных упавшим воркером)."""
+    async with session_scope() as s:
+        res = await s.execute(
+            text("""
+                UPDATE outbox_messages o
+                SET status = 'sending', locked_at = NOW(), attempts = o.attempts + 1
+                FROM (
+                    SELECT id FROM outbox_messages
+                    WHERE (status = 'pending' AND next_attempt_at <= NOW())
+                       OR (status = 'sending' AND locked_at < NOW() - make_interval(secs => :stale))
+                    ORDER BY priority, id
+                    LIMIT :lim
+                    FOR UPDATE SKIP LOCKED
+                ) c
+                WHERE o.id = c.id
+                RETURNING o.id, o.batch_key, o.chat_id, o.text, o.reply_markup, o.options,
+                          o.attempts, o.priority
+            """),
+            {"lim": limit, "stale": OUTBOX_STALE_LOCK}
+        )
+        return sorted(res.fetchall(), key=lambda r: (r.priority, r.id))
+
+
+async def _outbox_complete(rows: list, results: list[tuple[str, str | None]]) -> dict:
+    """Сохраняет итоги сообщений одним UPDATE и деактивирует заблокировавших бота."""
+    counts = {"sent": 0, "blocked": 0, "retry": 0, "dead": 0}
+    ids, statuses, errs, delays, blocked = [], [], [], [], []
+    for row, (result, err) in zip(rows, results):
+        delay = 0.0
+        if result == "retry":
+            if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                result = "dead"
+            else:
+                delay = float(min(5 * 2 ** row.attempts, 900))
+        counts[result] += 1
+        if result == "blocked":
+            blocked.append(row.chat_id)
+        ids.append(row.id)
+        statuses.append("pending" if result == "retry" else result)
+        errs.append(err)
+        delays.append(delay)
+
+    async with session_scope() as s:
+        await s.execute(
+            text("""
+                UPDATE outbox_messages o
+                SET status = v.status,
+                    last_error = v.err,
+                    locked_at = NULL,
+                    next_attempt_at = NOW() + make_interval(secs => v.delay),
+                    sent_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE o.sent_at END
+                FROM unnest(CAST(:ids AS BIGINT[]), CAST(:statuses AS TEXT[]),
+                            CAST(:errs AS TEXT[]), CAST(:delays AS FLOAT8[]))
+                     AS v(id, status, err, delay)
+                WHERE o.id = v.id
+            """),
+            {"ids": ids, "statuses": statuses, "errs": errs, "delays": delays}
+        )
+        if blocked:
+            await s.execute(
+                text("UPDATE bot_users SET is_active = false WHERE user_id = ANY(CAST(:ids AS BIGINT[]))"),
+                {"ids": blocked}
+            )
+    return counts
+
+
+def _outbox_log_progress(counts: dict) -> None:
+    """Копит счётчики всех воркеров и пишет сводку не чаще раза в OUTBOX_LOG_INTERVAL."""
+    global _outbox_last_log
+    for k, v in counts.items():
+        _outbox_progress[k] += v
+    now = time.monotonic()
+    if now - _outbox_last_log < OUTBOX_LOG_INTERVAL:
+        return
+    _outbox_last_log = now
+    p = _outbox_progress
+    logging.info(
+        f"[OUTBOX] всего: sent={p['sent']} blocked={p['blocked']} "
+        f"retry={p['retry']} dead={p['dead']}"
+    )
+
+
+async def _outbox_deliver(row) -> dict:
+    """
+    Отправляет сообщение и сразу фиксирует итог: медленная строка пачки не держит
+    остальные в 'sending', а падение процесса не приводит к повторной отправке
+    уже доставленных.
+    """
+    result = await _send_outbox_row(row)
+    return await _outbox_complete([row], [result])
+
+
+async def _outbox_worker(n: int):
+    api_priority.set(API_PRIORITY_BACKGROUND)
+    while True:
+        try:
+            rows = await _outbox_claim(OUTBOX_CLAIM_BATCH)
+            if not rows:
+                try:
+                    await asyncio.wait_for(_outbox_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                _outbox_wakeup.clear()
+                continue
+
+            per_row = await asyncio.gather(*[_outbox_deliver(r) for r in rows])
+            _outbox_log_progress({k: sum(c[k] for c in per_row) for k in _outbox_progress})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"[OUTBOX] w{n}: ошибка воркера: {e}", exc_info=True)
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+def start_outbox_workers() -> None:
+    """Запускает пул воркеров outbox. Незавершённые рассылки подхватываются автоматически."""
+    if _outbox_workers:
+        return
+    for n in range(OUTBOX_WORKERS):
+        _outbox_workers.append(asyncio.create_task(_outbox_worker(n)))
+    logging.info(f"[OUTBOX] Запущено воркеров: {OUTBOX_WORKERS}, лимит {BROADCAST_RATE} msg/s")
+
+
+async def outbox_stats() -> list[dict]:
+    """Прогресс по незавершённым и недавним рассылкам."""
+    async with session_scope() as s:
+        res = await s.execute(text("""
+            SELECT batch_key, status, COUNT(*) AS cnt, MAX(COALESCE(sent_at, created_at)) AS last_at
+            FROM outbox_messages
+            WHERE created_at > NOW() - INTERVAL '7 days'
+            GROUP BY batch_key, status
+            ORDER BY batch_key, status
+        """))
+        return [
+            {"batch_key": r.batch_key, "status": r.status, "count": r.cnt,
+             "last_at": r.last_at.isoformat() if r.last_at else None}
+            for r in res.fetchall()
+        ]
+
+
 # --- Уведомление организатора о результатах розыгрыша ---
 async def notify_organizer(gid: int, winners: list, eligible_count: int, bot_instance: Bot):
     try:
@@ -9064,13 +10467,12 @@ async def notify_organizer(gid: int, winners: list, eligible_count: int, bot_ins
             kb.adjust(1)
             
             print(f"📤 Отправляем уведомление организатору {gw.owner_user_id}")
-            await bot_instance.send_message(
-                gw.owner_user_id, 
-                message_text,
-                reply_markup=kb.as_markup(),
-                disable_notification=False,
+            await enqueue_broadcast(
+                f"draw_org:{gid}",
+                [outbox_message(gw.owner_user_id, message_text, kb.as_markup(), disable_notification=False)],
+                priority=OUTBOX_PRIORITY_HIGH,
             )
-            print(f"✅ Организатор уведомлен")
+            print(f"✅ Уведомление организатору поставлено в очередь")
             
     except Exception as e:
         print(f"❌ Ошибка уведомления организатора для розыгрыша {gid}: {e}")
@@ -9137,13 +10539,13 @@ async def notify_redraw_organizer(gid: int, winners: list, eligible_count: int,
             
             kb.adjust(1)
             
-            await bot_instance.send_message(
-                gw.owner_user_id, 
-                message_text,
-                reply_markup=kb.as_markup(),
-                disable_notification=False,
-                parse_mode="HTML",
-                disable_web_page_preview=True
+            await enqueue_broadcast(
+                f"redraw_org:{gid}:{winners_digest(winners)}",
+                [outbox_message(
+                    gw.owner_user_id, message_text, kb.as_markup(),
+                    disable_notification=False, disable_web_page_preview=True,
+                )],
+                priority=OUTBOX_PRIORITY_HIGH,
             )
             
     except Exception as e:
@@ -9154,22 +10556,16 @@ async def notify_redraw_organizer(gid: int, winners: list, eligible_count: int,
 async def notify_participants(gid: int, winners: list, eligible_entries: list, bot_instance: Bot):
     try:
         print(f"📨 Уведомляем участников розыгрыша {gid}")
-        
-        # 🔄 ПОЛУЧАЕМ BOT_USERNAME из бота
-        bot_info = await bot_instance.get_me()
-        BOT_USERNAME = bot_info.username
-        print(f"🔍 DEBUG: BOT_USERNAME получен: @{BOT_USERNAME}")
-        
+
+        bot_username = (await bot_identity.get()).username
+
         async with session_scope() as s:
             gw = await s.get(Giveaway, gid)
-            gw_title_link = await format_giveaway_title_link(gid, gw.internal_title)
             if not gw:
                 print(f"❌ Розыгрыш {gid} не найден для уведомления участников")
                 return
-            
-            winner_ids = [winner[0] for winner in winners]  # winner[0] = user_id
+            gw_title_link = await format_giveaway_title_link(gid, gw.internal_title)
 
-            print(f"🔍 Получаем билеты участников для розыгрыша {gid}")
             participant_tickets = {}
             res = await s.execute(
                 text("SELECT user_id, ticket_code FROM entries WHERE giveaway_id = :gid"),
@@ -9177,91 +10573,46 @@ async def notify_participants(gid: int, winners: list, eligible_entries: list, b
             )
             for row in res.all():
                 participant_tickets[row[0]] = row[1]
-            print(f"🔍 Найдено билетов в базе: {len(participant_tickets)}")
-
-            # Список билетов победителей (без ников — для приватности)
-            winner_tickets = []
-            for winner_id in winner_ids:
-                ticket = participant_tickets.get(winner_id)
-                if ticket:
-                    winner_tickets.append(f"🎟 <b>{ticket}</b>")
-            winners_list_text = "\n".join(winner_tickets) if winner_tickets else "билеты не определены"
-            
-            # Уведомляем всех участников
-            notified_count = 0
-            for user_id, _ in eligible_entries:
-                try:
-                    ticket_code = participant_tickets.get(user_id, "неизвестен")
-                    print(f"🔍 Участник {user_id}, билет: {ticket_code}")
-                    
-                    if user_id in winner_ids:
-                        # Победитель
-                        message_text = (
-                            f"🎉 Поздравляем! Вы стали победителем в розыгрыше \"{gw_title_link}\".\n\n"
-                            f"Ваш билет <b>{ticket_code}</b> оказался выбранным случайным образом.\n\n"
-                            f"Организатор свяжется с вами для вручения приза."
-                        )
-                        
-                        # 🔄 ДОБАВЛЕНО: Кнопка "Результаты" и для победителей для consistency
-                        kb = InlineKeyboardBuilder()
-                        url = f"https://t.me/{BOT_USERNAME}?startapp=results_{gid}"
-                        kb.button(text="🎲 Результаты", url=url)
-                        kb.adjust(1)
-                        
-                        print(f"🔍 DEBUG: Создана кнопка 'Результаты' для победителя с URL: {url}")
-                        
-                        await bot_instance.send_message(
-                            user_id, 
-                            message_text, 
-                            parse_mode="HTML",
-                            reply_markup=kb.as_markup(),
-                            disable_notification=False,
-                            disable_web_page_preview=True
-                        )
-                        
-                    else:
-                        # Участник (не победитель)
-                        message_text = (
-                            f"🏁 Завершился розыгрыш \"{gw_title_link}\".\n\n"
-                            f"Ваш билет: <b>{ticket_code}</b>\n\n"
-                            f"Мы случайным образом определили победителей и, к сожалению, "
-                            f"Ваш билет не был выбран.\n\n"
-                            f"Билеты победителей:\n{winners_list_text}\n\n"
-                            f"Участвуйте в других розыгрышах!"
-                        )
-                        
-                        # Кнопка "Результаты" ДЛЯ УВЕДОМЛЕНИЯ
-                        # Используем ТОЧНО ТУ ЖЕ кнопку что и в опубликованном посте в каналах
-                        # В уведомлениях в боте мы можем использовать URL кнопку как в каналах
-                        kb = InlineKeyboardBuilder()
-                        url = f"https://t.me/{BOT_USERNAME}?startapp=results_{gid}"
-                        kb.button(text="🎲 Результаты", url=url)
-                        kb.adjust(1)
-                        
-                        print(f"🔍 DEBUG: Создана кнопка 'Результаты' с URL: {url}")
-                        
-                        print(f"📤 Отправляем уведомление пользователю {user_id}")
-                        await bot_instance.send_message(
-                            user_id, 
-                            message_text, 
-                            parse_mode="HTML",
-                            reply_markup=kb.as_markup(),
-                            disable_notification=False,
-                            disable_web_page_preview=True
-                        )
 
-                    notified_count += 1
-                    print(f"✅ Пользователь {user_id} уведомлен")
-                    
-                    # Небольшая задержка чтобы не превысить лимиты Telegram
-                    await asyncio.sleep(0.1)
-                    
-                except Exception as e:
-                    print(f"⚠️ Не удалось уведомить пользователя {user_id}: {e}")
-                    continue
-                    
-        print(f"✅ Уведомлено {notified_count} участников розыгрыша {gid}")
-        
+        winner_ids = {winner[0] for winner in winners}  # winner[0] = user_id
+
+        # Список билетов победителей (без ников — для приватности)
+        winner_tickets = []
+        for winner in winners:
+            ticket = participant_tickets.get(winner[0])
+            if ticket:
+                winner_tickets.append(f"🎟 <b>{ticket}</b>")
+        winners_list_text = "\n".join(winner_tickets) if winner_tickets else "билеты не определены"
+
+        # Оба варианта текста рендерятся один раз, билет подставляется на получателя
+        markup = results_markup(gid, bot_username)
+        ticket = MessageTemplate.field("ticket")
+        winner_tpl = MessageTemplate(
+            f"🎉 Поздравляем! Вы стали победителем в розыгрыше \"{gw_title_link}\".\n\n"
+            f"Ваш билет <b>{ticket}</b> оказался выбранным случайным образом.\n\n"
+            f"Организатор свяжется с вами для вручения приза.",
+            markup, disable_notification=False, disable_web_page_preview=True,
+        )
+        loser_tpl = MessageTemplate(
+            f"🏁 Завершился розыгрыш \"{gw_title_link}\".\n\n"
+            f"Ваш билет: <b>{ticket}</b>\n\n"
+            f"Мы случайным образом определили победителей и, к сожалению, "
+            f"Ваш билет не был выбран.\n\n"
+            f"Билеты победителей:\n{winners_list_text}\n\n"
+            f"Участвуйте в других розыгрышах!",
+            markup, disable_notification=False, disable_web_page_preview=True,
+        )
+
+        messages = [
+            (winner_tpl if user_id in winner_ids else loser_tpl).render(
+                user_id, ticket=participant_tickets.get(user_id, "неизвестен")
+            )
+            for user_id, _ in eligible_entries
+        ]
+
+        await enqueue_broadcast(f"draw:{gid}", messages)
+        print(f"✅ Поставлено в очередь {len(messages)} уведомлений участникам розыгрыша {gid}")
+
     except Exception as e:
         print(f"❌ Ошибка уведомления участников для розыгрыша {gid}: {e}")
 
@@ -9270,18 +10621,14 @@ async def notify_participants(gid: int, winners: list, eligible_entries: list, b
 async def notify_redraw_participants(gid: int, winners: list, eligible_entries: list, bot_instance: Bot):
     try:
         print(f"📨 Уведомляем участников о ПЕРЕРОЗЫГРЫШЕ {gid}")
-        
-        # Получаем BOT_USERNAME
-        bot_info = await bot_instance.get_me()
-        BOT_USERNAME = bot_info.username
-        
+
+        bot_username = (await bot_identity.get()).username
+
         async with session_scope() as s:
             gw = await s.get(Giveaway, gid)
-            gw_title_link = await format_giveaway_title_link(gid, gw.internal_title)
             if not gw:
                 return
-            
-            winner_ids = [winner[0] for winner in winners]
+            gw_title_link = await format_giveaway_title_link(gid, gw.internal_title)
 
             # Получаем билеты участников
             participant_tickets = {}
@@ -9292,65 +10639,50 @@ async def notify_redraw_participants(gid: int, winners: list, eligible_entries:
             for row in res.all():
                 participant_tickets[row[0]] = row[1]
 
-            # Список билетов победителей (без ников — для приватности)
-            winner_tickets = []
-            for winner_id in winner_ids:
-                ticket = participant_tickets.get(winner_id)
-                if ticket:
-                    winner_tickets.append(f"🎟 <b>{ticket}</b>")
-            winners_list_text = "\n".join(winner_tickets) if winner_tickets else "билеты не определены"
-            
-            # Уведомляем всех участников
-            notified_count = 0
-            for user_id, _ in eligible_entries:
-                try:
-                    ticket_code = participant_tickets.get(user_id, "неизвестен")
-                    
-                    if user_id in winner_ids:
-                        # НОВЫЙ победитель
-                        message_text = (
-                            f"🔄 <b>Проведён перерозыгрыш!</b>\n\n"
-                            f'Розыгрыш: "{gw_title_link}"\n\n'
-                            f"🎉 <b>ПОЗДРАВЛЯЕМ!</b> Вы стали победителем в перерозыгрыше!\n\n"
-                            f"Ваш билет <b>{ticket_code}</b> оказался выбранным случайным образом.\n\n"
-                            f"Организатор свяжется с вами для вручения приза."
-                        )
-                    else:
-                        # Участник (не победитель в перерозыгрыше)
-                        message_text = (
-                            f"🔄 <b>Проведён перерозыгрыш!</b>\n\n"
-                            f'Розыгрыш: "{gw_title_link}"\n\n'
-                            f"Ваш билет: <b>{ticket_code}</b>\n\n"
-                            f"Мы случайным образом определили НОВЫХ победителей и, к сожалению, "
-                            f"Ваш билет не был выбран.\n\n"
-                            f"<b>Билеты победителей:</b>\n{winners_list_text}\n\n"
-                            f"Участвуйте в других розыгрышах!"
-                        )
-                    
-                    # Кнопка "Результаты"
-                    kb = InlineKeyboardBuilder()
-                    url = f"https://t.me/{BOT_USERNAME}?startapp=results_{gid}"
-                    kb.button(text="🎲 Результаты", url=url)
-                    kb.adjust(1)
-                    
-                    await bot_instance.send_message(
-                        user_id, 
-                        message_text, 
-                        parse_mode="HTML",
-                        reply_markup=kb.as_markup(),
-                        disable_notification=False,
-                        disable_web_page_preview=True
-                    )
-                    
-                    notified_count += 1
-                    await asyncio.sleep(0.1)
-                    
-                except Exception as e:
-                    print(f"⚠️ Не удалось уведомить пользователя {user_id} о перерозыгрыше: {e}")
-                    continue
-                    
-        print(f"✅ Уведомлено {notified_count} участников о перерозыгрыше {gid}")
-        
+        winner_ids = {winner[0] for winner in winners}
+
+        # Список билетов победителей (без ников — для приватности)
+        winner_tickets = []
+        for winner in winners:
+            ticket = participant_tickets.get(winner[0])
+            if ticket:
+                winner_tickets.append(f"🎟 <b>{ticket}</b>")
+        winners_list_text = "\n".join(winner_tickets) if winner_tickets else "билеты не определены"
+
+        # Оба варианта текста рендерятся один раз, билет подставляется на получателя
+        markup = results_markup(gid, bot_username)
+        ticket = MessageTemplate.field("ticket")
+        winner_tpl = MessageTemplate(
+            f"🔄 <b>Проведён перерозыгрыш!</b>\n\n"
+            f'Розыгрыш: "{gw_title_link}"\n\n'
+            f"🎉 <b>ПОЗДРАВЛЯЕМ!</b> Вы стали победителем в перерозыгрыше!\n\n"
+            f"Ваш билет <b>{ticket}</b> оказался выбранным случайным образом.\n\n"
+            f"Организатор свяжется с вами для вручения приза.",
+            markup, disable_notification=False, disable_web_page_preview=True,
+        )
+        loser_tpl = MessageTemplate(
+            f"🔄 <b>Проведён перерозыгрыш!</b>\n\n"
+            f'Розыгрыш: "{gw_title_link}"\n\n'
+            f"Ваш билет: <b>{ticket}</b>\n\n"
+            f"Мы случайным образом определили НОВЫХ победителей и, к сожалению, "
+            f"Ваш билет не был выбран.\n\n"
+            f"<b>Билеты победителей:</b>\n{winners_list_text}\n\n"
+            f"Участвуйте в других розыгрышах!",
+            markup, disable_notification=False, disable_web_page_preview=True,
+        )
+
+        messages = [
+            (winner_tpl if user_id in winner_ids else loser_tpl).render(
+                user_id, ticket=participant_tickets.get(user_id, "неизвестен")
+            )
+            for user_id, _ in eligible_entries
+        ]
+
+        # Каждый перерозыгрыш — отдельная рассылка; ключ зависит от состава победителей,
+        # поэтому повторный вызов для того же результата не рассылает сообщения повторно
+        await enqueue_broadcast(f"redraw:{gid}:{winners_digest(winners)}", messages)
+        print(f"✅ Поставлено в очередь {len(messages)} уведомлений о перерозыгрыше {gid}")
+
     except Exception as e:
         print(f"❌ Ошибка уведомления участников о перерозыгрыше: {e}")
 
@@ -9639,9 +10971,8 @@ async def edit_giveaway_post(giveaway_id: int, bot_instance: Bot):
 async def is_giveaway_organizer(user_id: int, giveaway_id: int) -> bool:
     """Проверяет, является ли пользователь организатором розыгрыша"""
     try:
-        async with session_scope() as s:
-            gw = await s.get(Giveaway, giveaway_id)
-            return gw and gw.owner_user_id == user_id
+        snap = await get_giveaway_snapshot(giveaway_id)
+        return bool(snap and snap.gw.owner_user_id == user_id)
     except Exception as e:
         logging.error(f"Ошибка проверки организатора: {e}")
         return False
@@ -9662,15 +10993,14 @@ async def get_participant_count(giveaway_id: int) -> int:
 async def get_giveaway_title(giveaway_id: int) -> str:
     """Получает название розыгрыша для имени файла"""
     try:
-        async with session_scope() as s:
-            gw = await s.get(Giveaway, giveaway_id)
-            if gw:
-                # Очищаем название от недопустимых символов
-                title = gw.internal_title
-                # Заменяем пробелы на подчеркивания и удаляем спецсимволы
-                safe_title = "".join(c if c.isalnum() or c in " _-" else "_" for c in title)
-                safe_title = safe_title.replace(" ", "_")
-                return safe_title[:50]  # Ограничиваем длину
+        snap = await get_giveaway_snapshot(giveaway_id)
+        if snap:
+            # Очищаем название от недопустимых символов
+            title = snap.gw.internal_title
+            # Заменяем пробелы на подчеркивания и удаляем спецсимволы
+            safe_title = "".join(c if c.isalnum() or c in " _-" else "_" for c in title)
+            safe_title = safe_title.replace(" ", "_")
+            return safe_title[:50]  # Ограничиваем длину
     except Exception as e:
         logging.error(f"Ошибка получения названия розыгрыша: {e}")
     return f"розыгрыш_{giveaway_id}"
@@ -9776,6 +11106,24 @@ async def generate_csv_in_memory(giveaway_id: int):
         gc.collect()
 
 #--- Обработчик членов канала / группы ---
+@dp.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    """
+    Вступление/выход участника в чате, где бот — админ: сразу обновляем кэш подписок,
+    а в channel_memberships событие попадёт с ближайшим сбросом буфера.
+    """
+    user = event.new_chat_member.user
+    is_member = _member_status_ok(event.new_chat_member)
+    remember_membership(event.chat.id, user.id, is_member)
+    queue_membership_event(event.chat.id, user.id, is_member)
+
+    # Премиум-группа и PRIME-канал определяют уровень пользователя
+    if PREMIUM_GROUP_ID and event.chat.id == PREMIUM_GROUP_ID:
+        tier_service.apply_event(user.id, status='premium' if is_member else 'standard')
+    elif PRIME_CHANNEL_ID and event.chat.id == PRIME_CHANNEL_ID:
+        tier_service.apply_event(user.id, is_prime=is_member)
+
+
 @dp.my_chat_member()
 async def on_my_chat_member(event: ChatMemberUpdated):
     """
@@ -9784,7 +11132,7 @@ async def on_my_chat_member(event: ChatMemberUpdated):
     """
     chat = event.chat
     bot_id = event.new_chat_member.user.id
-    if bot_id != (await bot.get_me()).id:
+    if bot_id != (await bot_identity.get()).id:
         return  # событие не для нас
 
     # Важно: используем from_user.id - того, кто совершил действие с ботом
@@ -10261,13 +11609,15 @@ async def show_active_stats(message: Message, giveaway_id: int, user_id: int | N
     
     logging.info(f"🔍 [DIAGNOSTICS] show_active_stats: user_id={user_id}, giveaway_id={giveaway_id}")
     
-    async with session_scope() as s:
-        # Получаем данные розыгрыша
-        gw = await s.get(Giveaway, giveaway_id)
-        if not gw:
-            await message.answer("Розыгрыш не найден.")
-            return
+    # Получаем данные розыгрыша и подключенные каналы (из кэша снимков)
+    snap = await get_giveaway_snapshot(giveaway_id)
+    if not snap:
+        await message.answer("Розыгрыш не найден.")
+        return
+    gw = snap.gw
+    channels = [(title, username, chat_id) for chat_id, title, username in snap.channels]
 
+    async with session_scope() as s:
         # Проверяем статус пользователя НАПРЯМУЮ из БД
         bot_user = await s.get(BotUser, user_id)
         if bot_user:
@@ -10292,19 +11642,6 @@ async def show_active_stats(message: Message, giveaway_id: int, user_id: int | N
         # Количество победителей (планируемое)
         winners_count = gw.winners_count
 
-        # Подключенные каналы/группы
-        channels_res = await s.execute(
-            stext("""
-                SELECT gc.title, oc.username, gc.chat_id
-                FROM giveaway_channels gc
-                LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
-                WHERE gc.giveaway_id = :gid
-                ORDER BY gc.id
-            """),
-            {"gid": giveaway_id}
-        )
-        channels = channels_res.all()
-
     # Формируем текст статистики
     text = (
         f"📊 <b>Статистика розыгрыша</b>\n\n"
@@ -10412,8 +11749,10 @@ async def get_mechanics_stats() -> dict:
     
     try:
         # Статистика кэша
-        async with _cache_lock:
-            stats['cache_size'] = len(_mechanics_cache)
+        cache_stats = _mechanics_cache.stats()
+        stats['cache_size'] = cache_stats['size']
+        stats['cache_hits'] = cache_stats['hits']
+        stats['cache_misses'] = cache_stats['misses']
         
         # Статистика из БД
         async with session_scope() as s:
@@ -10491,6 +11830,14 @@ async def main():
         replace_existing=True,
     )
     # Публикация запланированных продвижений — каждую минуту
+    scheduler.add_job(
+        tier_service.sweep,
+        trigger='interval',
+        minutes=5,
+        id='tier_cache_sweep',
+        replace_existing=True,
+    )
+
     scheduler.add_job(
         check_scheduled_promotions,
         trigger='interval',
@@ -10556,10 +11903,9 @@ async def main():
         logging.error(f"❌ Error restoring scheduler jobs: {e}")
 
     # 3) Проверяем токен и подключение к Telegram
-    me = await bot.get_me()
-    # запомним username для deeplink-кнопок в каналах
-    global BOT_USERNAME
-    BOT_USERNAME = me.username
+    # (заодно запоминаем username для deeplink-кнопок в каналах — BOT_USERNAME)
+    me = await bot_identity.refresh()
+    asyncio.create_task(bot_identity.run_refresher())
     logging.info(f"🤖 Бот запущен как @{me.username} (ID: {me.id})")
 
     # 4) Устанавливаем команды бота
@@ -10573,11 +11919,96 @@ async def main():
     # 6) Стартуем внутренний HTTP для preview_service
     asyncio.create_task(run_internal_server())
 
-    # 7) Запускаем polling
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    # 6.5) Пул воркеров outbox — заодно дожимает рассылки, прерванные перезапуском
+    start_outbox_workers()
+
+    # 6.6) Фоновая запись chat_member-событий в channel_memberships
+    asyncio.create_task(membership_flusher())
+
+    # 6.7) Фоновая запись активности пользователей (bot_users / users / giveaway_clicks)
+    asyncio.create_task(user_activity.run())
+
+    # 7) Запускаем polling; при остановке дописываем то, что успели принять в буферы
+    try:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await user_activity.flush()
+        await flush_membership_events()
 
 # --- Внутренний HTTP для preview_service ---
 
+# Сколько розыгрышей можно запросить за раз в /api/giveaways_info
+GIVEAWAYS_INFO_MAX_GIDS = int(os.getenv("GIVEAWAYS_INFO_MAX_GIDS", "50"))
+
+
+async def resolve_memberships(bot, user_id: int, chat_ids) -> dict[int, bool]:
+    """
+    Подписка пользователя на набор чатов: каждый чат проверяется один раз,
+    все параллельно (кэш → channel_memberships → get_chat_member, см. get_membership).
+    """
+    unique = list(dict.fromkeys(int(c) for c in chat_ids))
+    semaphore = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+
+    async def one(chat_id: int) -> bool:
+        async with semaphore:
+            ok, _ = await get_membership(bot, chat_id, user_id)
+            return ok
+
+    results = await asyncio.gather(*(one(c) for c in unique))
+    return dict(zip(unique, results))
+
+
+def _giveaway_info_payload(snap: GiveawaySnapshot, ticket: str | None, members: dict[int, bool]) -> dict:
+    channels = []
+    for chat_id, title, username in snap.channels:
+        channels.append({
+            "title": title,
+            "username": username,
+            "link": f"https://t.me/{username}" if username else None,
+            "is_member": members.get(int(chat_id), False),
+        })
+    return {
+        "ok": True,
+        "ends_at": snap.gw.end_at_utc.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "channels": channels,
+        "ticket": ticket
+    }
+
+
+async def _internal_get_giveaways_info(giveaway_ids: list[int], user_id: int) -> dict[int, dict]:
+    """
+    Пакетный вариант _internal_get_giveaway_info: снимки розыгрышей из кэша,
+    билеты пользователя одним запросом, подписки — по уникальным чатам параллельно.
+    Возвращает {gid: ответ в формате _internal_get_giveaway_info}.
+    """
+    giveaway_ids = list(dict.fromkeys(giveaway_ids))
+    snaps = await asyncio.gather(*(get_giveaway_snapshot(g) for g in giveaway_ids))
+    found = {g: snap for g, snap in zip(giveaway_ids, snaps) if snap}
+
+    async def load_tickets() -> dict[int, str]:
+        if not found:
+            return {}
+        async with session_scope() as s:
+            res = await s.execute(
+                stext("SELECT giveaway_id, ticket_code FROM entries "
+                      "WHERE user_id = :u AND giveaway_id = ANY(CAST(:g AS INTEGER[]))"),
+                {"u": user_id, "g": list(found)}
+            )
+            return {int(r[0]): r[1] for r in res.all()}
+
+    chat_ids = [chat_id for snap in found.values() for chat_id, _, _ in snap.channels]
+    tickets, members = await asyncio.gather(
+        load_tickets(), resolve_memberships(bot, user_id, chat_ids)
+    )
+
+    result = {}
+    for g in giveaway_ids:
+        snap = found.get(g)
+        result[g] = (_giveaway_info_payload(snap, tickets.get(g), members) if snap
+                     else {"ok": False, "error": "not_found"})
+    return result
+
+
 async def _internal_get_giveaway_info(gid: str, user_id: int):
     """
     Возвращает данные для мини-апа:
@@ -10592,6 +12023,8 @@ async def _internal_get_giveaway_info(gid: str, user_id: int):
         ],
         "ticket": "ABC123" | null
       }
+    Подписки проверяются параллельно через кэш и channel_memberships, билет читается
+    одновременно с ними — время ответа определяет самый медленный канал.
     """
     # приводим gid к int
     try:
@@ -10599,53 +12032,8 @@ async def _internal_get_giveaway_info(gid: str, user_id: int):
     except Exception:
         return {"ok": False, "error": "bad_gid"}
 
-    # читаем розыгрыш и прикрепленные каналы
-    async with session_scope() as s:
-        gw = await s.get(Giveaway, giveaway_id)
-        if not gw:
-            return {"ok": False, "error": "not_found"}
-
-        res = await s.execute(stext("""
-            SELECT gc.chat_id, gc.title, oc.username
-            FROM giveaway_channels gc
-            LEFT JOIN organizer_channels oc ON oc.id = gc.channel_id
-            WHERE gc.giveaway_id = :g
-            ORDER BY gc.id
-        """), {"g": giveaway_id})
-        rows = res.fetchall()
-
-        # есть ли уже билет у пользователя
-        res = await s.execute(
-            stext("SELECT ticket_code FROM entries WHERE giveaway_id=:g AND user_id=:u"),
-            {"g": giveaway_id, "u": user_id}
-        )
-        row_ticket = res.first()
-        ticket = row_ticket[0] if row_ticket else None
-
-    # проверяем подписку пользователя на каждом канале
-    channels = []
-    all_ok = True
-    for chat_id, title, username in rows:
-        try:
-            m = await bot.get_chat_member(chat_id, user_id)
-            is_member = m.status in {"member", "administrator", "creator"}
-        except Exception:
-            is_member = False
-        all_ok = all_ok and is_member
-        link = f"https://t.me/{username}" if username else None
-        channels.append({
-            "title": title,
-            "username": username,
-            "link": link,
-            "is_member": is_member,
-        })
-
-    return {
-        "ok": True,
-        "ends_at": gw.end_at_utc.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "channels": channels,
-        "ticket": ticket
-    }
+    result = await _internal_get_giveaways_info([giveaway_id], user_id)
+    return result[giveaway_id]
 
 async def _internal_claim_ticket(gid: str, user_id: int):
     """
@@ -10658,10 +12046,9 @@ async def _internal_claim_ticket(gid: str, user_id: int):
         return {"ok": False, "error": "bad_gid"}
 
     # проверяем, что розыгрыш активен
-    async with session_scope() as s:
-        gw = await s.get(Giveaway, giveaway_id)
-        if not gw or gw.status != GiveawayStatus.ACTIVE:
-            return {"ok": False, "error": "not_active"}
+    snap = await get_giveaway_snapshot(giveaway_id)
+    if not snap or snap.gw.status != GiveawayStatus.ACTIVE:
+        return {"ok": False, "error": "not_active"}
 
     # проверяем подписку на все каналы (используем уже готовый хелпер)
     all_ok, details = await check_membership_on_all(bot, user_id, giveaway_id)
@@ -10671,64 +12058,14 @@ async def _internal_claim_ticket(gid: str, user_id: int):
         return {"ok": False, "need": need}
 
     # если подписка ок — выдаём (или возвращаем существующий) билет
-    async with session_scope() as s:
-        # есть уже билет?
-        res = await s.execute(
-            stext("SELECT ticket_code FROM entries WHERE giveaway_id=:g AND user_id=:u"),
-            {"g": giveaway_id, "u": user_id}
-        )
-        row = res.first()
-        if row:
-            ticket = row[0]
-        else:
-            # генерируем и сохраняем
-            is_new_entry = False
-            for _ in range(5):
-                ticket = gen_ticket_code()
-                try:
-                    # source_channel
-                    src_res = await s.execute(
-                        stext("SELECT chat_id FROM giveaway_channels WHERE giveaway_id=:gid ORDER BY id LIMIT 1"),
-                        {"gid": giveaway_id}
-                    )
-                    src_row = src_res.first()
-                    source_channel_id = src_row[0] if src_row else None
-
-                    await s.execute(stext(
-                        "INSERT INTO entries(giveaway_id,user_id,ticket_code,prelim_ok,prelim_checked_at,source_channel_id) "
-                        "VALUES (:g,:u,:code,true,:ts,:src)"
-                    ), {
-                        "g": giveaway_id,
-                        "u": user_id,
-                        "code": ticket,
-                        "ts": datetime.now(timezone.utc),
-                        "src": source_channel_id
-                    })
-
-                    # entry_subscriptions
-                    try:
-                        ch_res = await s.execute(
-                            stext("SELECT chat_id FROM giveaway_channels WHERE giveaway_id=:gid"),
-                            {"gid": giveaway_id}
-                        )
-                        for (ch_id,) in ch_res.fetchall():
-                            await s.execute(stext("""
-                                INSERT INTO entry_subscriptions(giveaway_id, user_id, channel_id, was_subscribed)
-                                VALUES (:gid, :uid, :chid, false)
-                                ON CONFLICT(giveaway_id, user_id, channel_id) DO NOTHING
-                            """), {"gid": giveaway_id, "uid": user_id, "chid": ch_id})
-                    except Exception as _e:
-                        logging.warning(f"[claim_ticket] entry_subscriptions failed: {_e}")
-
-                    is_new_entry = True
-                    break
-                except Exception:
-                    continue
-
-        logging.info(f"[claim_ticket] is_new_entry={is_new_entry}, giveaway_id={giveaway_id}")
-        if is_new_entry:
-            logging.info(f"[claim_ticket] 🚀 Запускаем _check_and_publish_prime для gid={giveaway_id}")
-            asyncio.create_task(_check_and_publish_prime(giveaway_id))
+    ticket, is_new_entry = await issue_ticket(giveaway_id, user_id)
+    if ticket is None:
+        return {"ok": False, "error": "ticket_failed"}
+
+    logging.info(f"[claim_ticket] is_new_entry={is_new_entry}, giveaway_id={giveaway_id}")
+    if is_new_entry:
+        logging.info(f"[claim_ticket] 🚀 Запускаем _check_and_publish_prime для gid={giveaway_id}")
+        asyncio.create_task(_check_and_publish_prime(giveaway_id))
     return {"ok": True, "ticket": ticket}
 
 def make_internal_app():
@@ -10743,6 +12080,24 @@ def make_internal_app():
         info = await _internal_get_giveaway_info(gid, user_id)
         return web.json_response(info)
 
+    async def giveaways_info(request: web.Request):
+        """
+        Пакетный giveaway_info для главной участника:
+        {"gids": [1, 2, ...], "user_id": ...} → {"ok": true, "giveaways": {"1": {...}, ...}}
+        """
+        data = await request.json()
+        user_id = int(data.get("user_id") or 0)
+        try:
+            gids = [int(g) for g in (data.get("gids") or [])]
+        except (TypeError, ValueError):
+            return web.json_response({"ok": False, "error": "bad_gid"}, status=400)
+        if not (gids and user_id):
+            return web.json_response({"ok": False}, status=400)
+        if len(gids) > GIVEAWAYS_INFO_MAX_GIDS:
+            return web.json_response({"ok": False, "error": "too_many_gids"}, status=400)
+        infos = await _internal_get_giveaways_info(gids, user_id)
+        return web.json_response({"ok": True, "giveaways": {str(g): info for g, info in infos.items()}})
+
     async def claim_ticket(request: web.Request):
         data = await request.json()
         gid = str(data.get("gid") or "")
@@ -10771,8 +12126,9 @@ def make_internal_app():
         # Используем существующую сессию вместо session_scope()
         async with Session() as s:
             try:
-                # 1) Получаем информацию о розыгрыше
-                gw = await s.get(Giveaway, giveaway_id)
+                # 1) Получаем информацию о розыгрыше (из кэша снимков)
+                snap = await get_giveaway_snapshot(giveaway_id)
+                gw = snap.gw if snap else None
                 if not gw:
                     return web.json_response({"ok": False, "error": "not_found"}, status=404)
 
@@ -10974,7 +12330,7 @@ def make_internal_app():
             )
 
             # Возвращаем username бота для редиректа из mini app
-            bot_info = await bot.get_me()
+            bot_info = await bot_identity.get()
             return web.json_response({"ok": True, "bot_username": bot_info.username})
 
         except Exception as e:
@@ -11107,6 +12463,23 @@ def make_internal_app():
             logging.error(f"[internal/top_placement_paid] error: {e}", exc_info=True)
             return web.json_response({"ok": False, "reason": str(e)}, status=500)
 
+    async def api_metrics_handler(request: web.Request):
+        return web.json_response({"ok": True, "methods": api_budget.metrics.snapshot()})
+
+    async def cache_stats_handler(request: web.Request):
+        return web.json_response({
+            "ok": True,
+            "membership": _membership_cache.stats(),
+            "mechanics": _mechanics_cache.stats(),
+            "giveaways": giveaway_cache_stats(),
+        })
+
+    async def pool_stats_handler(request: web.Request):
+        return web.json_response({"ok": True, "pool": db_pool_stats()})
+
+    async def outbox_stats_handler(request: web.Request):
+        return web.json_response({"ok": True, "batches": await outbox_stats()})
+
     async def notify_prime(request: web.Request):
         data = await request.json()
         gid = int(data.get("giveaway_id") or 0)
@@ -11115,6 +12488,7 @@ def make_internal_app():
         return web.json_response({"ok": True})
 
     app.router.add_post("/api/giveaway_info", giveaway_info)
+    app.router.add_post("/api/giveaways_info", giveaways_info)
     app.router.add_post("/api/claim_ticket", claim_ticket)
     app.router.add_post("/internal/notify_prime", notify_prime)
     app.router.add_post("/internal/top_placement_paid", top_placement_paid)
@@ -11123,6 +12497,10 @@ def make_internal_app():
     app.router.add_post("/api/verify_simple_captcha_and_participate", verify_simple_captcha_and_participate)
     app.router.add_post("/api/create_simple_captcha_session", create_simple_captcha_session)
     app.router.add_post("/internal/csv_export", csv_export)
+    app.router.add_get("/internal/outbox_stats", outbox_stats_handler)
+    app.router.add_get("/internal/pool_stats", pool_stats_handler)
+    app.router.add_get("/internal/cache_stats", cache_stats_handler)
+    app.router.add_get("/internal/api_metrics", api_metrics_handler)
 
     return app
 
@@ -0,0 +1,78 @@
+"""
+Детерминированный (проверяемый) выбор победителей.
+
+Алгоритм не меняется: пул user_id сортируется, на каждом шаге
+idx = int(h) % len(pool), выбранный участник удаляется из пула,
+h = sha256(h). Меняется только способ найти idx-й оставшийся элемент:
+вместо list.pop(idx) (копия и сдвиг пула) — поиск по списку выбывших
+позиций. Результат побитово совпадает с deterministic_draw_legacy.
+"""
+import asyncio
+import hashlib
+import os
+from bisect import bisect_right, insort
+
+# Начиная с какого размера пула розыгрыш считается в отдельном потоке
+DRAW_OFFLOAD_THRESHOLD = int(os.getenv("DRAW_OFFLOAD_THRESHOLD", "20000"))
+
+
+def commit_hash(secret: str, gid: int) -> str:
+    return hashlib.sha256((secret + str(gid)).encode()).hexdigest()
+
+
+def deterministic_draw_legacy(secret: str, gid: int, user_ids: list[int], k: int):
+    """Исходная реализация — оставлена как эталон для проверки и бенчмарка."""
+    h = hashlib.sha256((secret + str(gid)).encode()).digest()
+    pool = list(sorted(user_ids))
+    winners = []; rank = 1
+    while pool and len(winners) < k:
+        idx = int.from_bytes(h, "big") % len(pool)
+        uid = pool.pop(idx)
+        winners.append((uid, rank, hashlib.sha256(h).hexdigest()))
+        h = hashlib.sha256(h).digest()
+        rank += 1
+    return winners
+
+
+def deterministic_draw(secret: str, gid: int, user_ids: list[int], k: int):
+    """
+    Возвращает [(user_id, rank, hash_used), ...] — те же победители, что и
+    deterministic_draw_legacy, но без удаления из пула.
+
+    Пул сортируется один раз (в C), выбывшие позиции хранятся в маленьком
+    отсортированном списке removed (k ≤ 100). idx-й оставшийся элемент — это
+    наименьшая позиция p, для которой p - |removed ∩ [0, p]| == idx; она
+    находится итерацией p = idx + |removed ∩ [0, p]| за O(k log k).
+    Время выбора не зависит от n, кроме одной сортировки.
+    """
+    pool = sorted(user_ids)
+    n = len(pool)
+    if n == 0 or k <= 0:
+        return []
+
+    removed: list[int] = []
+    h = hashlib.sha256((secret + str(gid)).encode()).digest()
+    winners = []
+    rank = 1
+    while len(removed) < n and len(winners) < k:
+        idx = int.from_bytes(h, "big") % (n - len(removed))
+        pos = idx
+        while True:
+            shifted = idx + bisect_right(removed, pos)
+            if shifted == pos:
+                break
+            pos = shifted
+        insort(removed, pos)
+
+        # hash_used совпадает со следующим состоянием h — считаем sha256 один раз
+        h = hashlib.sha256(h).digest()
+        winners.append((pool[pos], rank, h.hex()))
+        rank += 1
+    return winners
+
+
+async def deterministic_draw_async(secret: str, gid: int, user_ids: list[int], k: int):
+    """Для больших пулов сортировка и выбор выполняются вне event loop."""
+    if len(user_ids) >= DRAW_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(deterministic_draw, secret, gid, list(user_ids), k)
+    return deterministic_draw(secret, gid, user_ids, k)